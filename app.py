@@ -1,15 +1,27 @@
 # Сначала ВСЕ импорты из стандартной библиотеки
-from functools import lru_cache 
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque, OrderedDict
+import heapq
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import tracemalloc
 
 # Потом сторонние библиотеки
 import streamlit as st
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
+import openpyxl
 import math
 import io
 from datetime import datetime, date, timedelta
 import calendar
 import json
+import csv
 import base64
 from typing import Dict, List, Tuple, Optional, Any, Callable
 import warnings
@@ -26,19 +38,12 @@ try:
     # Пробуем импортировать scipy
     import scipy
     # Проверяем, можем ли мы использовать ConvexHull
-    from scipy.spatial import ConvexHull
+    from scipy.spatial import ConvexHull, Delaunay
     SCIPY_AVAILABLE = True
     st.sidebar.success("✅ SciPy доступен")
 except:
     SCIPY_AVAILABLE = False
-    st.sidebar.info("ℹ️ Используется упрощенная генерация полигонов")
-
-# Для расчета рабочих дней с праздниками
-try:
-    from workalendar.europe import Russia
-    WORKALENDAR_AVAILABLE = True
-except ImportError:
-    WORKALENDAR_AVAILABLE = False
+    st.sidebar.info("ℹ️ SciPy не найден: полигоны строятся выпуклой оболочкой на NumPy")
 
 # НАСТРОЙКА СТРАНИЦЫ
 st.set_page_config(
@@ -81,47 +86,193 @@ if 'plan_partial' not in st.session_state:
 # ГЕОМЕТРИЧЕСКИЕ ФУНКЦИИ ДЛЯ СЕТКИ И ПОЛИГОНОВ (ИСПРАВЛЕННАЯ)
 # ==============================================
 
-from functools import lru_cache
+class PreparedPolygon:
+    """
+    Полигон, подготовленный для геометрических операций.
+    Хранит вершины (float64), bounding box и заранее посчитанные массивы ребер:
+    - для ray casting (points_in_polygon): ребра без горизонтальных по долготе, наклон dlat/dlon;
+    - для scanline-растеризации: все ребра, наклон dlon/dlat.
+    Создается через prepare_polygon(), которая кэширует результат по хэшу координат.
+    """
+    
+    def __init__(self, coords, key=None):
+        self.coords = coords
+        self.key = key
+        self.bbox = (coords[:, 0].min(), coords[:, 0].max(),
+                     coords[:, 1].min(), coords[:, 1].max())
+        
+        lat1, lon1 = coords[:, 0], coords[:, 1]
+        lat2, lon2 = np.roll(lat1, -1), np.roll(lon1, -1)
+        
+        # Ray casting: ребра с y1 == y2 никогда не дают пересечения
+        valid = lon1 != lon2
+        self.x1 = lat1[valid]
+        self.y1 = lon1[valid]
+        self.slope = (lat2[valid] - lat1[valid]) / (lon2[valid] - lon1[valid])  # dx/dy для точки пересечения луча
+        self.y_min = np.minimum(lon1, lon2)[valid]
+        self.y_max = np.maximum(lon1, lon2)[valid]
+        
+        # Scanline: все ребра, строки сетки идут по широте
+        self.lat1 = lat1
+        self.lon1 = lon1
+        self.lat_lo = np.minimum(lat1, lat2)
+        self.lat_hi = np.maximum(lat1, lat2)
+        self.lon_lo = np.minimum(lon1, lon2)
+        self.lon_hi = np.maximum(lon1, lon2)
+        d_lat = lat2 - lat1
+        self.horizontal = d_lat == 0
+        self.lon_per_lat = np.where(self.horizontal, 0.0,
+                                    (lon2 - lon1) / np.where(self.horizontal, 1.0, d_lat))
+    
+    def __len__(self):
+        return len(self.coords)
+    
+    def tolist(self):
+        return self.coords.tolist()
+
+class PreparedPolygonCache:
+    """
+    LRU-кэш подготовленных полигонов.
+    Ограничен и числом записей, и суммарным числом вершин (большие полигоны вытесняют больше).
+    Общий для всех сессий (через get_prepared_polygon_cache), поэтому защищен блокировкой.
+    """
+    
+    def __init__(self, max_entries=512, max_vertices=2_000_000):
+        self.max_entries = max_entries
+        self.max_vertices = max_vertices
+        self._items = OrderedDict()
+        self._vertices = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get_or_build(self, key, coords):
+        with self._lock:
+            prepared = self._items.get(key)
+            if prepared is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return prepared
+        
+        # Подготовка вне блокировки - другие сессии не ждут
+        prepared = PreparedPolygon(coords, key=key)
+        
+        with self._lock:
+            self.misses += 1
+            if key not in self._items:
+                self._items[key] = prepared
+                self._vertices += len(prepared)
+                while len(self._items) > 1 and (len(self._items) > self.max_entries
+                                                or self._vertices > self.max_vertices):
+                    _, evicted = self._items.popitem(last=False)
+                    self._vertices -= len(evicted)
+        return prepared
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._vertices = 0
+    
+    def stats(self):
+        return {
+            'entries': len(self._items),
+            'vertices': self._vertices,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+@st.cache_resource
+def get_prepared_polygon_cache():
+    """Кэш подготовленных полигонов, переживающий перезапуски скрипта"""
+    return PreparedPolygonCache()
 
-@lru_cache(maxsize=10000)
-def is_point_in_polygon_cached(point_tuple, polygon_tuple):
+def prepare_polygon(polygon):
     """
-    Кэшированная проверка точки внутри полигона.
+    Возвращает PreparedPolygon для списка координат [[lat, lon], ...].
+    Уже подготовленный полигон возвращается как есть; иначе ищется в кэше
+    по хэшу координат, так что один и тот же полигон готовится один раз.
+    Возвращает None, если полигон некорректный.
     """
-    if not polygon_tuple or len(polygon_tuple) < 3:
-        return False
+    if isinstance(polygon, PreparedPolygon):
+        return polygon
+    if polygon is None or len(polygon) < 3:
+        return None
     
-    x, y = point_tuple
-    inside = False
-    n = len(polygon_tuple)
+    try:
+        coords = np.ascontiguousarray(np.asarray(polygon, dtype=float)[:, :2])
+    except (ValueError, TypeError, IndexError):
+        return None
     
-    for i in range(n):
-        x1, y1 = polygon_tuple[i]
-        x2, y2 = polygon_tuple[(i + 1) % n]
-        
-        if ((y1 > y) != (y2 > y)) and \
-           (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1):
-            inside = not inside
+    if not np.isfinite(coords).all():
+        return None
     
+    key = hashlib.blake2b(coords.tobytes(), digest_size=16).hexdigest()
+    return get_prepared_polygon_cache().get_or_build(key, coords)
+
+def points_in_polygon(points, polygon):
+    """
+    Пакетная проверка точек внутри полигона (ray casting).
+    points: массив (N, 2) в том же порядке координат, что и полигон.
+    polygon: список координат или PreparedPolygon.
+    Возвращает булеву маску длины N.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    inside = np.zeros(len(points), dtype=bool)
+    
+    prepared = prepare_polygon(polygon)
+    if prepared is None or len(points) == 0:
+        return inside
+    
+    # Отсекаем точки вне bounding box - для них проверка ребер не нужна
+    min_x, max_x, min_y, max_y = prepared.bbox
+    x, y = points[:, 0], points[:, 1]
+    candidates = np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+    if len(candidates) == 0:
+        return inside
+    
+    cx, cy = x[candidates], y[candidates]
+    crossings = np.zeros(len(candidates), dtype=bool)
+    
+    n_edges = len(prepared.x1)
+    if len(candidates) < n_edges:
+        # Точек меньше, чем ребер (одиночные проверки): векторизуем по ребрам блоками точек
+        block = max(1, (1 << 20) // n_edges)
+        for start in range(0, len(candidates), block):
+            bx = cx[start:start + block, None]
+            by = cy[start:start + block, None]
+            hit = (by >= prepared.y_min) & (by < prepared.y_max)
+            hit &= bx < prepared.slope * (by - prepared.y1) + prepared.x1
+            crossings[start:start + block] = np.count_nonzero(hit, axis=1) % 2 == 1
+    else:
+        # Один проход по ребрам, каждое ребро проверяется сразу для всех точек
+        for x1, y1, slope, y_min, y_max in zip(prepared.x1, prepared.y1, prepared.slope,
+                                               prepared.y_min, prepared.y_max):
+            # (y1 > y) != (y2 > y) эквивалентно y_min <= y < y_max
+            hit = (cy >= y_min) & (cy < y_max)
+            hit &= cx < slope * (cy - y1) + x1
+            crossings ^= hit
+    
+    inside[candidates] = crossings
     return inside
 
 def is_point_in_polygon(point, polygon):
     """
-    Обертка для кэшированной функции.
+    Проверка одной точки - обертка над пакетной points_in_polygon.
     """
-    if not polygon or len(polygon) < 3:
+    if polygon is None or len(polygon) < 3:
         return False
     
-    # Преобразуем в кортежи для кэширования
     try:
-        point_tuple = (float(point[0]), float(point[1]))
-        # Убедимся что polygon - список кортежей
-        polygon_tuple = tuple((float(p[0]), float(p[1])) for p in polygon)
-        return is_point_in_polygon_cached(point_tuple, polygon_tuple)
+        point_array = np.array([[float(point[0]), float(point[1])]])
     except (ValueError, TypeError, IndexError):
         return False
+    
+    return bool(points_in_polygon(point_array, polygon)[0])
 
-def is_cell_in_polygon(cell_lat, cell_lon, grid_size, polygon_coords):
+def is_cell_in_polygon(cell_lat, cell_lon, grid_size, polygon):
     """
     Проверяет что хотя бы часть ячейки внутри полигона.
     """
@@ -134,25 +285,189 @@ def is_cell_in_polygon(cell_lat, cell_lon, grid_size, polygon_coords):
         (cell_lat + grid_size/2, cell_lon + grid_size/2)  # центр
     ]
     
-    for point in test_points:
-        if is_point_in_polygon(point, polygon_coords):
-            return True
-    return False
+    return bool(points_in_polygon(test_points, polygon).any())
 
-def create_grid_inside_polygon(polygon_coords, grid_size=0.0009):
+def rasterize_polygon_scanline(polygon, start_lat, start_lon, grid_size,
+                               height_cells, width_cells):
+    """
+    Scanline-растеризация полигона в маску ячеек (height x width).
+    Ячейка помечается, если любая ее часть внутри полигона:
+    - через ячейку проходит ребро полигона, или
+    - ячейка лежит внутри (по пересечениям ребер со средней линией строки).
+    Стоимость O(строк x ребер) вместо O(ячеек x 5 x вершин).
+    """
+    mask = np.zeros((height_cells, width_cells), dtype=bool)
+    
+    prepared = prepare_polygon(polygon)
+    if prepared is None:
+        return mask
+    
+    lat1, lon1 = prepared.lat1, prepared.lon1
+    lat_lo, lat_hi = prepared.lat_lo, prepared.lat_hi
+    horizontal = prepared.horizontal
+    slope = prepared.lon_per_lat
+    
+    # Разворачиваем каждое ребро в пары (ребро, строка), которые оно покрывает
+    row_lo = np.clip(np.floor((lat_lo - start_lat) / grid_size).astype(np.int64), 0, height_cells - 1)
+    row_hi = np.clip(np.floor((lat_hi - start_lat) / grid_size).astype(np.int64), 0, height_cells - 1)
+    rows_per_edge = row_hi - row_lo + 1
+    edge_idx = np.repeat(np.arange(len(prepared)), rows_per_edge)
+    row_starts = np.cumsum(rows_per_edge) - rows_per_edge
+    rows = row_lo[edge_idx] + (np.arange(len(edge_idx)) - row_starts[edge_idx])
+    
+    span_rows = []
+    span_lo = []
+    span_hi = []
+    
+    # 1. Ячейки, через которые проходит ребро: обрезаем ребро по полосе строки
+    band_lo = start_lat + rows * grid_size
+    clip_lo = np.maximum(lat_lo[edge_idx], band_lo)
+    clip_hi = np.minimum(lat_hi[edge_idx], band_lo + grid_size)
+    lon_a = lon1[edge_idx] + (clip_lo - lat1[edge_idx]) * slope[edge_idx]
+    lon_b = lon1[edge_idx] + (clip_hi - lat1[edge_idx]) * slope[edge_idx]
+    is_horizontal = horizontal[edge_idx]
+    lon_a = np.where(is_horizontal, prepared.lon_lo[edge_idx], lon_a)
+    lon_b = np.where(is_horizontal, prepared.lon_hi[edge_idx], lon_b)
+    span_rows.append(rows)
+    span_lo.append(np.minimum(lon_a, lon_b))
+    span_hi.append(np.maximum(lon_a, lon_b))
+    
+    # 2. Внутренние ячейки: пересечения ребер со средней линией строки (правило чет-нечет)
+    mid_lat = band_lo + grid_size / 2
+    crosses = (lat_lo[edge_idx] <= mid_lat) & (mid_lat < lat_hi[edge_idx])
+    if crosses.any():
+        cross_rows = rows[crosses]
+        cross_lon = lon1[edge_idx[crosses]] + (mid_lat[crosses] - lat1[edge_idx[crosses]]) * slope[edge_idx[crosses]]
+        order = np.lexsort((cross_lon, cross_rows))
+        cross_rows = cross_rows[order]
+        cross_lon = cross_lon[order]
+        # В каждой строке четное число пересечений - пары (0,1), (2,3), ... дают отрезки внутри
+        span_rows.append(cross_rows[0::2])
+        span_lo.append(cross_lon[0::2])
+        span_hi.append(cross_lon[1::2])
+    
+    span_rows = np.concatenate(span_rows)
+    col_lo = np.clip(np.floor((np.concatenate(span_lo) - start_lon) / grid_size).astype(np.int64), 0, width_cells - 1)
+    col_hi = np.clip(np.floor((np.concatenate(span_hi) - start_lon) / grid_size).astype(np.int64), 0, width_cells - 1)
+    
+    # Отмечаем отрезки колонок через разностный массив по каждой строке
+    diff = np.zeros((height_cells, width_cells + 1), dtype=np.int32)
+    np.add.at(diff, (span_rows, col_lo), 1)
+    np.add.at(diff, (span_rows, col_hi + 1), -1)
+    mask[:] = np.cumsum(diff, axis=1)[:, :width_cells] > 0
+    
+    return mask
+
+class PolygonGrid:
     """
-    Создает сетку ячеек внутри полигона.
+    Компактная сетка внутри полигона.
+    mask - булева маска занятости (height x width), строки - по широте, колонки - по долготе.
+    ID ячейки = row * width + col; cell_ids - отсортированный массив ID занятых ячеек.
+    Границы и центры ячеек вычисляются из ID по требованию и не хранятся.
     """
-    if not polygon_coords or len(polygon_coords) < 3:
+    
+    # Смещения соседей (row, col): север, юг, восток, запад
+    NEIGHBOR_OFFSETS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+    
+    def __init__(self, mask, start_lat, start_lon, grid_size, bbox):
+        self.mask = mask
+        self.height, self.width = mask.shape
+        self.start_lat = start_lat
+        self.start_lon = start_lon
+        self.grid_size = grid_size
+        self.bbox = bbox
+        id_dtype = np.int32 if self.height * self.width < 2**31 else np.int64
+        self.cell_ids = np.flatnonzero(mask).astype(id_dtype)
+    
+    @property
+    def n_cells(self):
+        return len(self.cell_ids)
+    
+    def __len__(self):
+        return self.n_cells
+    
+    def rows_cols(self, cell_ids=None):
+        """Строки и колонки ячеек"""
+        ids = self.cell_ids if cell_ids is None else np.asarray(cell_ids)
+        return ids // self.width, ids % self.width
+    
+    def cell_bounds(self, cell_ids=None):
+        """Границы ячеек: массив (n, 4) - lat, lon, lat_end, lon_end"""
+        rows, cols = self.rows_cols(cell_ids)
+        lat = self.start_lat + rows * self.grid_size
+        lon = self.start_lon + cols * self.grid_size
+        return np.column_stack([lat, lon, lat + self.grid_size, lon + self.grid_size])
+    
+    def cell_centers(self, cell_ids=None):
+        """Центры ячеек: массив (n, 2) - lat, lon"""
+        rows, cols = self.rows_cols(cell_ids)
+        return np.column_stack([
+            self.start_lat + (rows + 0.5) * self.grid_size,
+            self.start_lon + (cols + 0.5) * self.grid_size
+        ])
+    
+    def contains(self, cell_ids):
+        """Маска: какие из ID - занятые ячейки сетки"""
+        ids = np.asarray(cell_ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < self.height * self.width)
+        result = np.zeros(ids.shape, dtype=bool)
+        result[valid] = self.mask.ravel()[ids[valid]]
+        return result
+    
+    def locate(self, points):
+        """ID ячеек для массива точек (N, 2); -1 для точек вне сетки"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        rows = np.floor((points[:, 0] - self.start_lat) / self.grid_size)
+        cols = np.floor((points[:, 1] - self.start_lon) / self.grid_size)
+        inside = ((rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width))
+        ids = np.full(len(points), -1, dtype=np.int64)
+        ids[inside] = rows[inside].astype(np.int64) * self.width + cols[inside].astype(np.int64)
+        ids[~self.contains(ids)] = -1
+        return ids
+    
+    def position(self, cell_ids):
+        """Позиции ячеек в cell_ids (индекс в массивах сетки); -1 если ячейки нет"""
+        ids = np.asarray(cell_ids, dtype=np.int64)
+        pos = np.searchsorted(self.cell_ids, ids)
+        pos = np.minimum(pos, max(self.n_cells - 1, 0))
+        found = self.contains(ids) & (self.n_cells > 0)
+        return np.where(found, pos, -1)
+    
+    def neighbors(self, cell_ids=None):
+        """ID 4 соседей (север, юг, восток, запад) - массив (n, 4), -1 если соседа нет"""
+        rows, cols = self.rows_cols(cell_ids)
+        result = np.full((len(rows), 4), -1, dtype=np.int64)
+        for k, (d_row, d_col) in enumerate(self.NEIGHBOR_OFFSETS):
+            n_rows, n_cols = rows + d_row, cols + d_col
+            valid = (n_rows >= 0) & (n_rows < self.height) & (n_cols >= 0) & (n_cols < self.width)
+            ids = np.where(valid, n_rows * self.width + n_cols, -1)
+            result[:, k] = np.where(self.contains(ids), ids, -1)
+        return result
+    
+    def neighbor_csr(self):
+        """Граф соседства в формате CSR: (offsets, позиции соседей)"""
+        neighbor_ids = self.neighbors()
+        counts = (neighbor_ids >= 0).sum(axis=1)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        flat = neighbor_ids[neighbor_ids >= 0]
+        return offsets, self.position(flat)
+
+def create_grid_inside_polygon(polygon, grid_size=0.0009, mode='scanline'):
+    """
+    Создает сетку ячеек внутри полигона (список координат или PreparedPolygon).
+    mode='scanline' - растеризация по строкам (быстро, точная проверка пересечения);
+    mode='points' - старая проверка 5 контрольных точек на ячейку.
+    """
+    if polygon is None or len(polygon) < 3:
         return None
     
     try:
-        # Bounding box полигона
-        lats = [float(p[0]) for p in polygon_coords]
-        lons = [float(p[1]) for p in polygon_coords]
+        # Ребра и bounding box полигона берутся из кэша подготовленных полигонов
+        prepared = prepare_polygon(polygon)
+        if prepared is None:
+            return None
         
-        min_lat, max_lat = min(lats), max(lats)
-        min_lon, max_lon = min(lons), max(lons)
+        min_lat, max_lat, min_lon, max_lon = prepared.bbox
         
         # Добавляем небольшой запас
         eps = grid_size * 0.1
@@ -169,45 +484,33 @@ def create_grid_inside_polygon(polygon_coords, grid_size=0.0009):
         width_cells = int(math.ceil((max_lon - start_lon) / grid_size))
         height_cells = int(math.ceil((max_lat - start_lat) / grid_size))
         
-        cells = []
-        cell_index = {}  # Для быстрого поиска
-        
-        # Создаем все возможные ячейки в bounding box
-        for i in range(height_cells):
-            for j in range(width_cells):
-                cell_lat = start_lat + i * grid_size
-                cell_lon = start_lon + j * grid_size
-                
-                # Проверяем, что ячейка хотя бы частично внутри полигона
-                if is_cell_in_polygon(cell_lat, cell_lon, grid_size, polygon_coords):
-                    cell_data = {
-                        'grid_x': i,
-                        'grid_y': j,
-                        'center': (cell_lat + grid_size/2, cell_lon + grid_size/2),
-                        'lat': cell_lat,
-                        'lon': cell_lon,
-                        'lat_end': cell_lat + grid_size,
-                        'lon_end': cell_lon + grid_size
-                    }
-                    cells.append(cell_data)
-                    
-                    # Добавляем в индекс
-                    cell_key = f"{i}_{j}"
-                    cell_index[cell_key] = cell_data
-        
-        if not cells:
+        if mode == 'scanline':
+            cell_mask = rasterize_polygon_scanline(
+                prepared, start_lat, start_lon, grid_size, height_cells, width_cells
+            )
+        else:
+            # 5 контрольных точек ячейки (4 угла + центр) как смещения от левого нижнего угла
+            offsets = np.array([
+                [0, 0], [grid_size, 0], [0, grid_size],
+                [grid_size, grid_size], [grid_size / 2, grid_size / 2]
+            ])
+            col_lons = start_lon + np.arange(width_cells) * grid_size
+            cell_mask = np.zeros((height_cells, width_cells), dtype=bool)
+            
+            # Проверяем ячейки построчно: одна пакетная проверка на строку
+            for i in range(height_cells):
+                corners = np.column_stack([np.full(width_cells, start_lat + i * grid_size), col_lons])
+                test_points = (corners[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+                inside = points_in_polygon(test_points, prepared)
+                cell_mask[i] = inside.reshape(width_cells, 5).any(axis=1)
+        
+        if not cell_mask.any():
             return None
         
-        return {
-            'bbox': (min_lat, max_lat, min_lon, max_lon),
-            'grid_size': grid_size,
-            'cells': cells,
-            'cell_index': cell_index,  # Быстрый поиск
-            'width': width_cells,
-            'height': height_cells,
-            'start_lat': start_lat,
-            'start_lon': start_lon
-        }
+        return PolygonGrid(
+            cell_mask, start_lat, start_lon, grid_size,
+            bbox=(min_lat, max_lat, min_lon, max_lon)
+        )
         
     except Exception as e:
         print(f"Ошибка при создании сетки: {e}")
@@ -215,120 +518,418 @@ def create_grid_inside_polygon(polygon_coords, grid_size=0.0009):
 
 def assign_points_to_grid_cells(points_coords, point_ids, grid):
     """
-    Распределяет точки по ячейкам сетки.
+    Распределяет точки по ячейкам сетки (векторно, без цикла по точкам).
+    Возвращает CSR-структуру по позициям ячеек сетки (порядок grid.cell_ids):
+    - 'offsets': массив длины n_cells + 1, точки ячейки k - point_index[offsets[k]:offsets[k+1]]
+    - 'point_index': индексы точек, сгруппированные по ячейкам
+    - 'point_ids': ID точек (для перевода индексов в ID)
+    - 'outside': индексы точек вне сетки или с некорректными координатами
     """
-    if not grid or not points_coords or not point_ids:
-        return {}
+    if not grid or points_coords is None or point_ids is None or len(points_coords) == 0:
+        return None
     
     if len(points_coords) != len(point_ids):
         print(f"Предупреждение: {len(points_coords)} координат != {len(point_ids)} ID")
-        return {}
-    
-    cell_to_points = {}
-    grid_size = grid['grid_size']
-    start_lat = grid['start_lat']
-    start_lon = grid['start_lon']
-    cell_index = grid.get('cell_index', {})
+        return None
     
-    for i, (point_coord, point_id) in enumerate(zip(points_coords, point_ids)):
-        try:
-            lat, lon = float(point_coord[0]), float(point_coord[1])
-            
-            # Определяем ячейку
-            grid_x = int((lat - start_lat) / grid_size)
-            grid_y = int((lon - start_lon) / grid_size)
-            
-            cell_key = f"{grid_x}_{grid_y}"
-            
-            # Проверяем, что ячейка существует в сетке
-            if cell_key in cell_index:
-                if cell_key not in cell_to_points:
-                    cell_to_points[cell_key] = []
-                cell_to_points[cell_key].append(point_id)
-            else:
-                # Точка вне сетки (на границе или ошибка)
-                print(f"Точка {point_id} вне сетки: {lat}, {lon}")
-                
-        except (ValueError, TypeError, IndexError) as e:
-            print(f"Пропущена точка {i}: {e}")
-            continue
+    try:
+        coords = np.asarray(points_coords, dtype=float).reshape(-1, 2)
+    except (ValueError, TypeError):
+        # Есть нечисловые значения - некорректные превращаем в NaN (попадут в outside)
+        coords = pd.DataFrame(list(points_coords)).iloc[:, :2].apply(
+            pd.to_numeric, errors='coerce'
+        ).to_numpy(dtype=float)
+    
+    # Ячейка каждой точки через np.floor по всему массиву координат
+    positions = grid.position(grid.locate(coords))
+    inside = positions >= 0
+    inside_index = np.flatnonzero(inside)
+    
+    # Группировка: сортировка по позиции ячейки + bincount для смещений
+    order = np.argsort(positions[inside], kind='stable')
+    counts = np.bincount(positions[inside], minlength=grid.n_cells)
+    
+    return {
+        'offsets': np.concatenate([[0], np.cumsum(counts)]),
+        'point_index': inside_index[order],
+        'point_ids': np.asarray(point_ids),
+        'outside': np.flatnonzero(~inside)
+    }
+
+def get_cell_point_ids(assignment, grid, cell_id):
+    """Возвращает ID точек ячейки из результата assign_points_to_grid_cells"""
+    position = int(grid.position([cell_id])[0])
+    if assignment is None or position < 0:
+        return []
     
-    return cell_to_points
+    start, end = assignment['offsets'][position], assignment['offsets'][position + 1]
+    return assignment['point_ids'][assignment['point_index'][start:end]].tolist()
 
-def get_cell_neighbors(cell_key, grid):
+def get_cell_neighbors(cell_id, grid):
     """
     Возвращает 4 соседа ячейки (север, юг, восток, запад).
     Проверяет существование соседей.
     """
     try:
-        grid_x, grid_y = map(int, cell_key.split('_'))
-        cell_index = grid.get('cell_index', {})
-        
-        neighbor_keys = [
-            f"{grid_x}_{grid_y + 1}",  # север
-            f"{grid_x}_{grid_y - 1}",  # юг
-            f"{grid_x + 1}_{grid_y}",  # восток
-            f"{grid_x - 1}_{grid_y}",  # запад
-        ]
+        neighbor_ids = grid.neighbors([cell_id])[0]
         
         # Возвращаем только существующих соседей
-        valid_neighbors = []
-        for key in neighbor_keys:
-            if key in cell_index:
-                valid_neighbors.append(key)
-        
-        return valid_neighbors
+        return [int(n) for n in neighbor_ids if n >= 0]
         
     except Exception as e:
-        print(f"Ошибка при поиске соседей ячейки {cell_key}: {e}")
+        print(f"Ошибка при поиске соседей ячейки {cell_id}: {e}")
         return []
 
-# ==============================================
-# БОКОВАЯ ПАНЕЛЬ - НАСТРОЙКИ
-# ==============================================
-
-with st.sidebar:
-    st.header("⚙️ Настройки")
-    
-    # Выбор квартала и года
-    col1, col2 = st.columns(2)
-    with col1:
-        quarter = st.selectbox("Квартал", [1, 2, 3, 4], index=0, key="sidebar_quarter")
-    with col2:
-        year = st.selectbox("Год", list(range(2023, 2027)), index=2, key="sidebar_year")
-    
-    # Коэффициенты этапов
-    st.subheader("Коэффициенты нагрузки по этапам")
-    st.caption("Квартал делится на 4 этапа")
-    
-    stage1 = st.number_input("Этап 1 коэффициент", value=0.8, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage1")
-    stage2 = st.number_input("Этап 2 коэффициент", value=1.0, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage2")
-    stage3 = st.number_input("Этап 3 коэффициент", value=1.2, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage3")
-    stage4 = st.number_input("Этап 4 коэффициент", value=0.9, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage4")
-    
-    coefficients = [stage1, stage2, stage3, stage4]
-    
-    st.markdown("---")
+class QuadtreeGrid:
+    """
+    Адаптивная сетка (квадродерево) по массиву точек.
+    Ячейка делится на 4, пока в ней больше capacity точек (до max_depth),
+    поэтому число ячеек пропорционально числу точек, а не площади bbox.
+    Интерфейс совпадает с PolygonGrid: locate, position, neighbors, neighbor_csr,
+    cell_bounds, cell_centers - и работает с assign_points_to_grid_cells / get_cell_neighbors.
+    ID ячейки = индекс листа.
+    """
     
-    st.info("""
-    **Инструкция:**
-    1. Загрузите файл с данными (1 файл, 3 вкладки)
-    2. Настройте квартал и коэффициенты
-    3. Нажмите кнопку "Рассчитать план"
-    4. Используйте вкладки для анализа
+    def __init__(self, points, capacity=32, max_depth=16):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        points = points[np.isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            raise ValueError("Нет точек для построения квадродерева")
+        
+        self.capacity = capacity
+        self.max_depth = max_depth
+        self.side = 1 << max_depth  # размер корня в целых единицах самого мелкого уровня
+        
+        min_lat, min_lon = points.min(axis=0)
+        max_lat, max_lon = points.max(axis=0)
+        # Небольшой запас, чтобы точки на границе попадали внутрь
+        eps = max(max_lat - min_lat, max_lon - min_lon, 1e-6) * 1e-6
+        self.bbox = (min_lat - eps, max_lat + eps, min_lon - eps, max_lon + eps)
+        self.lat_step = (self.bbox[1] - self.bbox[0]) / self.side
+        self.lon_step = (self.bbox[3] - self.bbox[2]) / self.side
+        
+        self._build(self._int_coords(points))
+        self.cell_ids = np.arange(self.n_cells, dtype=np.int64)
+        self._neighbor_offsets, self._neighbor_positions = self._build_neighbors()
+    
+    @property
+    def n_cells(self):
+        return len(self.depth)
+    
+    def __len__(self):
+        return self.n_cells
+    
+    def _int_coords(self, points):
+        """Целочисленные координаты точек на самом мелком уровне (-1 вне корня)"""
+        rows = np.floor((points[:, 0] - self.bbox[0]) / self.lat_step)
+        cols = np.floor((points[:, 1] - self.bbox[2]) / self.lon_step)
+        inside = (rows >= 0) & (rows < self.side) & (cols >= 0) & (cols < self.side)
+        rows = np.where(inside, rows, -1).astype(np.int64)
+        cols = np.where(inside, cols, -1).astype(np.int64)
+        return rows, cols
+    
+    def _build(self, int_coords):
+        """Построение по уровням: на каждом уровне делятся все переполненные узлы сразу"""
+        rows, cols = int_coords
+        node = np.zeros(len(rows), dtype=np.int64)
+        node_r0 = np.array([0], dtype=np.int64)
+        node_c0 = np.array([0], dtype=np.int64)
+        
+        leaf_r0, leaf_c0, leaf_depth = [], [], []
+        
+        for depth in range(self.max_depth + 1):
+            counts = np.bincount(node, minlength=len(node_r0))
+            split = counts > self.capacity if depth < self.max_depth else np.zeros(len(node_r0), dtype=bool)
+            
+            leaf_r0.append(node_r0[~split])
+            leaf_c0.append(node_c0[~split])
+            leaf_depth.append(np.full(np.count_nonzero(~split), depth, dtype=np.int64))
+            
+            if not split.any():
+                break
+            
+            # Дети: квадрант = 2 * (верхняя половина) + (правая половина)
+            half = self.side >> (depth + 1)
+            split_rank = np.cumsum(split) - 1
+            parents = np.flatnonzero(split)
+            quadrants = np.arange(4)
+            node_r0 = (node_r0[parents][:, None] + (quadrants // 2) * half).ravel()
+            node_c0 = (node_c0[parents][:, None] + (quadrants % 2) * half).ravel()
+            
+            in_split = split[node]
+            rows, cols, node = rows[in_split], cols[in_split], node[in_split]
+            quadrant = ((rows & half) > 0) * 2 + ((cols & half) > 0)
+            node = split_rank[node] * 4 + quadrant
+        
+        self.r0 = np.concatenate(leaf_r0)
+        self.c0 = np.concatenate(leaf_c0)
+        self.depth = np.concatenate(leaf_depth)
+        self.size = self.side >> self.depth
+        
+        # Ключи листьев для поиска: смещение уровня + строка * 2^d + колонка
+        level_offsets = np.cumsum([0] + [4 ** d for d in range(self.max_depth + 1)])
+        self._level_offsets = level_offsets
+        keys = level_offsets[self.depth] + (self.r0 >> (self.max_depth - self.depth)) * (1 << self.depth) \
+            + (self.c0 >> (self.max_depth - self.depth))
+        self._key_order = np.argsort(keys)
+        self._sorted_keys = keys[self._key_order]
+    
+    def _build_neighbors(self):
+        """Соседи по общим ребрам листьев (север/юг/восток/запад) в формате CSR"""
+        pairs_a, pairs_b = [], []
+        r1, c1 = self.r0 + self.size, self.c0 + self.size
+        
+        # Восточные соседи: общий вертикальный край, перекрытие по строкам
+        for edge, start, end, key_main, key_sub in (
+                (c1, self.r0, r1, self.c0, self.r0),   # восток
+                (r1, self.c0, c1, self.r0, self.c0)):  # север
+            order = np.lexsort((key_sub, key_main))
+            sorted_keys = key_main[order] * self.side + key_sub[order]
+            other_end = (key_sub + self.size)[order]
+            
+            lo = np.searchsorted(sorted_keys, edge * self.side + start, side='right') - 1
+            lo_valid = (lo >= 0)
+            lo_safe = np.maximum(lo, 0)
+            # Лист, начавшийся до нашей стороны, считается, только если перекрывает ее
+            starts_inside = lo_valid & (key_main[order][lo_safe] == edge) & (other_end[lo_safe] > start)
+            lo = np.where(starts_inside, lo_safe, lo + 1)
+            hi = np.searchsorted(sorted_keys, edge * self.side + end, side='left')
+            
+            counts = np.maximum(hi - lo, 0)
+            a = np.repeat(np.arange(self.n_cells), counts)
+            local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            b = order[np.repeat(lo, counts) + local]
+            pairs_a += [a, b]
+            pairs_b += [b, a]
+        
+        a = np.concatenate(pairs_a)
+        b = np.concatenate(pairs_b)
+        order = np.lexsort((b, a))
+        a, b = a[order], b[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(a, minlength=self.n_cells))])
+        return offsets, b
+    
+    def locate(self, points):
+        """ID листьев для массива точек (N, 2); -1 для точек вне корня"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        rows, cols = self._int_coords(points)
+        result = np.full(len(points), -1, dtype=np.int64)
+        inside = rows >= 0
+        
+        # Проверяем все уровни: лист ровно один на каждую точку
+        for depth in range(self.max_depth + 1):
+            pending = inside & (result < 0)
+            if not pending.any():
+                break
+            shift = self.max_depth - depth
+            keys = self._level_offsets[depth] + (rows[pending] >> shift) * (1 << depth) + (cols[pending] >> shift)
+            slot = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+            found = self._sorted_keys[slot] == keys
+            result[np.flatnonzero(pending)[found]] = self._key_order[slot[found]]
+        
+        return result
+    
+    def position(self, cell_ids):
+        """Позиции ячеек (совпадают с ID листьев); -1 для несуществующих"""
+        ids = np.asarray(cell_ids, dtype=np.int64)
+        return np.where((ids >= 0) & (ids < self.n_cells), ids, -1)
+    
+    def contains(self, cell_ids):
+        return self.position(cell_ids) >= 0
+    
+    def cell_bounds(self, cell_ids=None):
+        """Границы листьев: массив (n, 4) - lat, lon, lat_end, lon_end"""
+        ids = self.cell_ids if cell_ids is None else np.asarray(cell_ids, dtype=np.int64)
+        lat = self.bbox[0] + self.r0[ids] * self.lat_step
+        lon = self.bbox[2] + self.c0[ids] * self.lon_step
+        return np.column_stack([lat, lon,
+                                lat + self.size[ids] * self.lat_step,
+                                lon + self.size[ids] * self.lon_step])
+    
+    def cell_centers(self, cell_ids=None):
+        """Центры листьев: массив (n, 2) - lat, lon"""
+        bounds = self.cell_bounds(cell_ids)
+        return np.column_stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2])
+    
+    def neighbor_csr(self):
+        """Граф соседства в формате CSR: (offsets, позиции соседей)"""
+        return self._neighbor_offsets, self._neighbor_positions
+    
+    def neighbors(self, cell_ids=None):
+        """ID соседей листьев - массив (n, k), дополненный -1 (у листа бывает больше 4 соседей)"""
+        ids = self.cell_ids if cell_ids is None else np.asarray(cell_ids, dtype=np.int64)
+        starts = self._neighbor_offsets[ids]
+        counts = self._neighbor_offsets[ids + 1] - starts
+        result = np.full((len(ids), max(int(counts.max(initial=0)), 1)), -1, dtype=np.int64)
+        for k in range(result.shape[1]):
+            has = counts > k
+            result[has, k] = self._neighbor_positions[starts[has] + k]
+        return result
+
+class PolygonIndex:
+    """
+    Пространственный индекс по полигонам аудиторов (результат generate_polygons).
+    Равномерная сетка корзин по bounding box полигонов отбирает кандидатов,
+    затем точная пакетная проверка points_in_polygon для каждого полигона.
+    """
     
-    *Настройки сохраняются автоматически*
-    """)
-
-    st.markdown("---")
+    # Ограничение числа корзин по каждой оси (защита от огромных полигонов)
+    MAX_BUCKETS_PER_AXIS = 256
     
-    st.subheader("🎯 Алгоритм разбиения")
-    use_enhanced_split = st.checkbox(
-        "Использовать улучшенное разбиение по неделям", 
-        value=False,
-        help="Разбивает полигоны аудиторов на компактные недельные области с балансировкой ±3 точки"
-    )
-
+    def __init__(self, polygons):
+        self.names = []
+        self.auditors = []
+        self.cities = []
+        self.prepared = []
+        bboxes = []
+        
+        for poly_name, poly_info in (polygons or {}).items():
+            prepared = prepare_polygon(poly_info.get('coordinates'))
+            if prepared is None:
+                continue
+            self.names.append(poly_name)
+            self.auditors.append(poly_info.get('auditor', 'Неизвестно'))
+            self.cities.append(poly_info.get('city', 'Неизвестно'))
+            self.prepared.append(prepared)
+            bboxes.append(prepared.bbox)
+        
+        # bbox: min_lat, max_lat, min_lon, max_lon
+        self.bboxes = np.array(bboxes, dtype=float).reshape(-1, 4)
+        self._build_buckets()
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def _build_buckets(self):
+        """Строит CSR 'корзина -> полигоны' по bounding box полигонов"""
+        if len(self) == 0:
+            self.bucket_keys = np.array([], dtype=np.int64)
+            self.bucket_offsets = np.array([0], dtype=np.int64)
+            self.bucket_polygons = np.array([], dtype=np.int64)
+            return
+        
+        min_lat, max_lat = self.bboxes[:, 0].min(), self.bboxes[:, 1].max()
+        min_lon, max_lon = self.bboxes[:, 2].min(), self.bboxes[:, 3].max()
+        
+        # Размер корзины ~ типичный размер полигона
+        extents = np.maximum(self.bboxes[:, 1] - self.bboxes[:, 0], self.bboxes[:, 3] - self.bboxes[:, 2])
+        total_extent = max(max_lat - min_lat, max_lon - min_lon)
+        bucket_size = max(float(np.median(extents)), total_extent / self.MAX_BUCKETS_PER_AXIS, 1e-6)
+        
+        self.origin = (min_lat, min_lon)
+        self.bucket_size = bucket_size
+        self.n_cols = int((max_lon - min_lon) // bucket_size) + 1
+        
+        row_lo, row_hi = self._bucket_coord(self.bboxes[:, 0], min_lat), self._bucket_coord(self.bboxes[:, 1], min_lat)
+        col_lo, col_hi = self._bucket_coord(self.bboxes[:, 2], min_lon), self._bucket_coord(self.bboxes[:, 3], min_lon)
+        
+        # Разворачиваем каждый полигон во все корзины его bbox
+        n_rows, n_cols = row_hi - row_lo + 1, col_hi - col_lo + 1
+        sizes = n_rows * n_cols
+        poly_idx = np.repeat(np.arange(len(self)), sizes)
+        local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        rows = row_lo[poly_idx] + local // n_cols[poly_idx]
+        cols = col_lo[poly_idx] + local % n_cols[poly_idx]
+        keys = rows * self.n_cols + cols
+        
+        order = np.argsort(keys, kind='stable')
+        keys, poly_idx = keys[order], poly_idx[order]
+        self.bucket_keys, starts = np.unique(keys, return_index=True)
+        self.bucket_offsets = np.append(starts, len(keys))
+        self.bucket_polygons = poly_idx
+    
+    def _bucket_coord(self, values, origin):
+        return np.floor((np.asarray(values, dtype=float) - origin) / self.bucket_size).astype(np.int64)
+    
+    def _candidate_pairs(self, points):
+        """Пары (индекс точки, индекс полигона), прошедшие фильтр корзин и bbox"""
+        empty = np.array([], dtype=np.int64)
+        if len(self) == 0 or len(points) == 0:
+            return empty, empty
+        
+        rows = self._bucket_coord(points[:, 0], self.origin[0])
+        cols = self._bucket_coord(points[:, 1], self.origin[1])
+        keys = np.where((rows >= 0) & (cols >= 0) & (cols < self.n_cols), rows * self.n_cols + cols, -1)
+        
+        slot = np.searchsorted(self.bucket_keys, keys)
+        slot = np.minimum(slot, len(self.bucket_keys) - 1)
+        found = self.bucket_keys[slot] == keys
+        
+        starts = np.where(found, self.bucket_offsets[slot], 0)
+        counts = np.where(found, self.bucket_offsets[slot + 1] - self.bucket_offsets[slot], 0)
+        point_idx = np.repeat(np.arange(len(points)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        poly_idx = self.bucket_polygons[np.repeat(starts, counts) + local]
+        
+        # Фильтр по bbox полигона
+        lat, lon = points[point_idx, 0], points[point_idx, 1]
+        bbox = self.bboxes[poly_idx]
+        keep = (lat >= bbox[:, 0]) & (lat <= bbox[:, 1]) & (lon >= bbox[:, 2]) & (lon <= bbox[:, 3])
+        return point_idx[keep], poly_idx[keep]
+    
+    def locate_all(self, points):
+        """
+        Все попадания точек в полигоны одним вызовом.
+        Возвращает (индексы точек, индексы полигонов) - точка может быть в нескольких полигонах.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        point_idx, poly_idx = self._candidate_pairs(points)
+        if len(point_idx) == 0:
+            return point_idx, poly_idx
+        
+        # Группируем кандидатов по полигону и проверяем каждую группу пакетно
+        order = np.argsort(poly_idx, kind='stable')
+        point_idx, poly_idx = point_idx[order], poly_idx[order]
+        bounds = np.flatnonzero(np.diff(poly_idx)) + 1
+        hit = np.zeros(len(point_idx), dtype=bool)
+        
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(poly_idx)]):
+            polygon = int(poly_idx[start])
+            hit[start:end] = points_in_polygon(points[point_idx[start:end]], self.prepared[polygon])
+        
+        return point_idx[hit], poly_idx[hit]
+    
+    def locate(self, points):
+        """Индекс полигона для каждой точки (первый по порядку); -1 если точка вне всех полигонов"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = np.full(len(points), len(self), dtype=np.int64)
+        point_idx, poly_idx = self.locate_all(points)
+        np.minimum.at(result, point_idx, poly_idx)
+        result[result == len(self)] = -1
+        return result
+    
+    def polygon_names(self, poly_indices):
+        """Названия полигонов по индексам (None для -1)"""
+        names = np.array(self.names + [None], dtype=object)
+        return names[np.asarray(poly_indices)]
+
+def find_polygon_overlaps(points_df, polygon_index):
+    """
+    Точки, попадающие сразу в несколько полигонов.
+    Возвращает DataFrame: ID_Точки, Город, Количество_полигонов, Полигоны.
+    """
+    columns = ['ID_Точки', 'Город', 'Количество_полигонов', 'Полигоны']
+    if points_df is None or points_df.empty or polygon_index is None or len(polygon_index) == 0:
+        return pd.DataFrame(columns=columns)
+    
+    coords = points_df[['Широта', 'Долгота']].to_numpy(dtype=float)
+    point_idx, poly_idx = polygon_index.locate_all(coords)
+    counts = np.bincount(point_idx, minlength=len(points_df))
+    overlapping = np.flatnonzero(counts > 1)
+    if len(overlapping) == 0:
+        return pd.DataFrame(columns=columns)
+    
+    hits = pd.DataFrame({
+        'point': point_idx,
+        'polygon': polygon_index.polygon_names(poly_idx)
+    })
+    hits = hits[hits['point'].isin(overlapping)]
+    names = hits.groupby('point')['polygon'].agg(lambda s: ', '.join(sorted(s)))
+    
+    result = points_df.iloc[names.index][['ID_Точки', 'Город']].reset_index(drop=True)
+    result['Количество_полигонов'] = counts[names.index]
+    result['Полигоны'] = names.values
+    return result
 
 # ==============================================
 # ФУНКЦИИ ДЛЯ СОЗДАНИЯ ШАБЛОНОВ
@@ -352,7 +953,17 @@ def create_template_auditors():
     """Создает шаблон для файла Аудиторы"""
     data = {
         'ID_Сотрудника': ['SOVIAUD10', 'SOVIAUD11', 'SOVIAUD12'],
-        'Город': ['Москва', 'Москва', 'Санкт-Петербург']
+        'Город': ['Москва', 'Москва', 'Санкт-Петербург'],
+        'Ставка': [1.0, 0.5, 1.0]
+    }
+    return pd.DataFrame(data)
+
+def create_template_absences():
+    """Создает шаблон для файла Отсутствия"""
+    data = {
+        'ID_Сотрудника': ['SOVIAUD10', 'SOVIAUD12'],
+        'Дата_начала': ['12.05.2025', '02.06.2025'],
+        'Дата_окончания': ['23.05.2025', '02.06.2025']
     }
     return pd.DataFrame(data)
 
@@ -379,17 +990,759 @@ def get_download_link(data, filename, text, mime_type='application/vnd.openxmlfo
 # ФУНКЦИИ ДЛЯ ОБРАБОТКИ ДАННЫХ
 # ==============================================
 
-def load_and_process_data(file):
-    """Загружает и обрабатывает файл с тремя вкладками"""
+# Вкладки рабочей книги, которые использует приложение
+WORKBOOK_SHEETS = ['Точки', 'Аудиторы', 'Факт_посещений', 'Отсутствия']
+# Вкладки, без которых книга считается полной
+OPTIONAL_WORKBOOK_SHEETS = ['Отсутствия']
+
+# Каталог локальных данных приложения (переопределяется переменной окружения)
+VISIT_PLAN_DATA_DIR = os.environ.get(
+    'VISIT_PLAN_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+)
+
+# ==============================================
+# СХЕМА ВКЛАДОК: ПСЕВДОНИМЫ, ТИПЫ, ДИАПАЗОНЫ
+# ==============================================
+
+# Типы точек из выгрузок -> типы плана (неизвестные значения -> default)
+POINT_TYPE_MAPPING = {
+    'Convenience': 'Мини',
+    'convenience': 'Мини',
+    'Convenience Store': 'Мини',
+    'Convenience store': 'Мини',
+    'Hypermarket': 'Гипер',
+    'hypermarket': 'Гипер',
+    'Supermarket': 'Супер',
+    'supermarket': 'Супер',
+    'Мини': 'Мини',
+    'Гипер': 'Гипер',
+    'Супер': 'Супер'
+}
+
+# Описание колонок каждой вкладки:
+# aliases - альтернативные названия, required - без колонки вкладка не загружается,
+# dtype - float/int/date/category, range - допустимый диапазон (строка вне него отклоняется),
+# not_null - пустое значение отклоняет строку, mapping/default - замена значений и значение по умолчанию,
+# default_from - колонка-источник, если колонки нет
+SHEET_SCHEMAS = {
+    'Точки': {
+        'ID_Точки': {'aliases': ['ID точки', 'ID_точки', 'Point_ID'], 'required': True, 'not_null': True},
+        'Широта': {'aliases': ['Latitude', 'Lat', 'широта'], 'required': True, 'dtype': 'float', 'range': (41, 82)},
+        'Долгота': {'aliases': ['Longitude', 'Lon', 'долгота'], 'required': True, 'dtype': 'float', 'range': (19, 180)},
+        'Город': {'aliases': ['City', 'city', 'Город работы'], 'required': True, 'dtype': 'category'},
+        'Тип': {'aliases': ['Type', 'Category', 'Тип точки'], 'required': True,
+                'mapping': POINT_TYPE_MAPPING, 'default': 'Мини'},
+        'Кол-во_посещений': {'dtype': 'int', 'default': 1},
+        'Название_Точки': {'default_from': 'ID_Точки'},
+        'Адрес': {'default': ''}
+    },
+    'Аудиторы': {
+        'ID_Сотрудника': {'aliases': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'employee_id', 'Сотрудник'],
+                          'required': True},
+        'Город': {'aliases': ['City', 'city', 'Город работы'], 'required': True, 'dtype': 'category'},
+        'Ставка': {'aliases': ['FTE', 'fte', 'Доля_ставки', 'Доля ставки'], 'dtype': 'float',
+                   'range': (0, 1), 'default': 1.0}
+    },
+    'Факт_посещений': {
+        'ID_Точки': {'aliases': ['ID точки', 'ID_точки', 'Point_ID'], 'required': True},
+        'Дата_визита': {'aliases': ['Дата визита', 'Дата', 'Date', 'Visit Date', 'Дата посещения'],
+                        'required': True, 'dtype': 'date'},
+        'ID_Сотрудника': {'aliases': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'Сотрудник'], 'required': True}
+    },
+    'Отсутствия': {
+        'ID_Сотрудника': {'aliases': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'Сотрудник'],
+                          'required': True, 'not_null': True},
+        'Дата_начала': {'aliases': ['Дата начала', 'Начало', 'С', 'Date_From'], 'required': True, 'dtype': 'date'},
+        'Дата_окончания': {'aliases': ['Дата окончания', 'Окончание', 'По', 'Date_To'], 'dtype': 'date',
+                           'default_from': 'Дата_начала'}
+    }
+}
+
+def schema_column_names(dtype):
+    """Все названия (с псевдонимами) колонок заданного типа во всех вкладках"""
+    names = set()
+    for schema in SHEET_SCHEMAS.values():
+        for column, rules in schema.items():
+            if rules.get('dtype') == dtype:
+                names.add(column)
+                names.update(rules.get('aliases', []))
+    return names
+
+def resolve_column_aliases(df, schema):
+    """Переименовывает псевдонимы в канонические названия одним rename (только для отсутствующих колонок)"""
+    renames = {}
+    for column, rules in schema.items():
+        if column in df.columns:
+            continue
+        for alias in rules.get('aliases', []):
+            if alias in df.columns and alias not in renames:
+                renames[alias] = column
+                break
+    return df.rename(columns=renames) if renames else df
+
+def to_float_column(values):
+    """Числа из ячеек, в т.ч. строки с десятичной запятой; нечисловые -> NaN"""
+    if not pd.api.types.is_numeric_dtype(values):
+        values = values.astype('string').str.replace(',', '.', regex=False)
+    return pd.to_numeric(values, errors='coerce').astype('float64')
+
+def normalize_sheet(df, sheet_name, stats=None):
+    """
+    Приводит вкладку к схеме SHEET_SCHEMAS за один векторизованный проход:
+    псевдонимы -> типы -> замены значений -> проверка всех правил сразу.
+    Возвращает (чистая таблица, таблица отклоненных строк с колонкой 'Причина', список отсутствующих колонок).
+    Если обязательных колонок нет - чистая таблица None.
+    stats (dict) дополняется статистикой форматов дат по колонкам.
+    """
+    schema = SHEET_SCHEMAS[sheet_name]
+    frame = resolve_column_aliases(df.copy(), schema)
+    
+    missing = [column for column, rules in schema.items() if rules.get('required') and column not in frame.columns]
+    if missing:
+        return None, pd.DataFrame(columns=list(frame.columns) + ['Причина']), missing
+    
+    # Недостающие необязательные колонки
+    for column, rules in schema.items():
+        if column in frame.columns:
+            continue
+        if 'default_from' in rules:
+            frame[column] = frame[rules['default_from']]
+        elif 'default' in rules:
+            frame[column] = rules['default']
+    
+    # Причины отклонения по строкам: каждое правило - одна векторная маска по всей колонке
+    reasons = np.full(len(frame), '', dtype=object)
+    
+    def reject(mask, reason):
+        nonlocal reasons
+        mask = np.asarray(mask, dtype=bool)
+        if mask.any():
+            reasons = np.where(mask, reasons + reason + '; ', reasons)
+    
+    original_values = {}
+    for column, rules in schema.items():
+        values = frame[column]
+        dtype = rules.get('dtype')
+        
+        if 'mapping' in rules:
+            values = values.astype(object).map(rules['mapping'])
+        
+        if dtype == 'float':
+            present = values.notna().to_numpy()
+            values = to_float_column(values)
+            reject(present & values.isna().to_numpy(), f"{column}: не число")
+            if 'default' in rules:
+                # Пустая ячейка необязательной колонки - значение по умолчанию
+                values = values.fillna(rules['default'])
+                empty = np.zeros(len(frame), dtype=bool)
+            else:
+                empty = ~present
+        elif dtype == 'date':
+            original_values[column] = values
+            values, date_counts, rejected_dates = parse_visit_dates(values)
+            if stats is not None:
+                stats.setdefault('date_formats', {})[column] = date_counts
+            # Пустые и нераспознанные даты - с причиной из разбора
+            date_reasons = np.full(len(frame), '', dtype=object)
+            date_reasons[frame.index.get_indexer(rejected_dates.index)] = (
+                f"{column}: " + rejected_dates['Причина'].str.lower()
+            ).to_numpy(dtype=object)
+            reject(date_reasons != '', date_reasons)
+            empty = np.zeros(len(frame), dtype=bool)
+        else:
+            if dtype == 'int':
+                values = pd.to_numeric(values, errors='coerce')
+            if 'default' in rules:
+                values = values.fillna(rules['default'])
+            if dtype == 'int':
+                values = values.astype(int)
+            empty = values.isna().to_numpy()
+        
+        if rules.get('not_null') or 'range' in rules:
+            reject(empty, f"{column}: пустое значение")
+        
+        if 'range' in rules:
+            low, high = rules['range']
+            reject(values.notna().to_numpy() & ~values.between(low, high).to_numpy(),
+                   f"{column} вне диапазона {low}–{high}")
+        
+        if dtype == 'category' and not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype('category')
+        
+        frame[column] = values
+    
+    rejected = reasons != ''
+    rejects = frame.loc[rejected].copy()
+    for column, values in original_values.items():
+        # В отклоненных строках показываем исходное значение, а не NaT
+        rejects[column] = values.loc[rejected].astype(object).to_numpy()
+    rejects.insert(0, 'Строка_файла', rejects.index + 2)
+    rejects['Причина'] = pd.Series(reasons[rejected], index=rejects.index).str.rstrip('; ')
+    
+    return frame.loc[~rejected].reset_index(drop=True), rejects.reset_index(drop=True), []
+
+def show_sheet_rejects(sheet_name, rejects):
+    """Одно сообщение и выгружаемая таблица отклоненных строк вкладки (вместо предупреждения на каждое правило)"""
+    if 'sheet_rejects' not in st.session_state:
+        st.session_state.sheet_rejects = {}
+    st.session_state.sheet_rejects[sheet_name] = rejects
+    
+    if rejects is None or rejects.empty:
+        return
+    
+    st.warning(f"⚠️ {sheet_name}: отклонено {len(rejects)} строк")
+    with st.expander(f"Отклоненные строки: {sheet_name}", expanded=False):
+        st.dataframe(rejects['Причина'].value_counts().rename('Строк'), use_container_width=True)
+        st.dataframe(rejects.head(100), use_container_width=True)
+        st.download_button(
+            "📥 Скачать отклоненные строки (CSV)",
+            data=rejects.to_csv(index=False).encode('utf-8-sig'),
+            file_name=f"отклоненные_{sheet_name}.csv",
+            mime="text/csv",
+            key=f"download_rejects_{sheet_name}"
+        )
+
+# ==============================================
+# ЧТЕНИЕ ФАЙЛОВ ДАННЫХ
+# ==============================================
+
+# Потоковое чтение: книги больше этого размера читаются через openpyxl read_only
+STREAM_MIN_BYTES = 20 * 1024 * 1024
+STREAM_CHUNK_ROWS = 50_000
+
+# Типизация колонок при потоковом чтении (названия и псевдонимы из SHEET_SCHEMAS)
+STREAM_FLOAT_COLUMNS = schema_column_names('float')
+STREAM_CATEGORY_COLUMNS = schema_column_names('category')
+STREAM_DATE_COLUMNS = schema_column_names('date')
+
+def apply_column_types(chunk):
+    """Типизирует известные колонки: координаты float64 (и с десятичной запятой), города category, даты datetime64"""
+    for col in chunk.columns:
+        if col in STREAM_FLOAT_COLUMNS:
+            chunk[col] = to_float_column(chunk[col])
+        elif col in STREAM_CATEGORY_COLUMNS:
+            chunk[col] = chunk[col].astype('category')
+        elif col in STREAM_DATE_COLUMNS:
+            values = chunk[col].dropna()
+            # Ячейки с форматом даты приходят как datetime - сразу в datetime64,
+            # строки оставляем для разбора в load_and_process_visits
+            if len(values) > 0 and values.map(lambda v: isinstance(v, (datetime, date))).all():
+                chunk[col] = pd.to_datetime(chunk[col], errors='coerce')
+    return chunk
+
+def _typed_chunk(rows, header):
+    """Пачка строк листа -> DataFrame с типизированными колонками"""
+    return apply_column_types(pd.DataFrame.from_records(rows, columns=header))
+
+def _concat_typed_chunks(chunks, header):
+    """Склеивает пачки; категории городов объединяются, чтобы колонка осталась категориальной"""
+    if not chunks:
+        return pd.DataFrame(columns=header)
+    
+    for col in header:
+        if col in STREAM_CATEGORY_COLUMNS and len(chunks) > 1:
+            categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    
+    return pd.concat(chunks, ignore_index=True)
+
+def stream_excel_sheet(source, sheet_name, chunk_rows=STREAM_CHUNK_ROWS, progress=None):
+    """
+    Читает лист xlsx потоково (openpyxl read_only + iter_rows) пачками по chunk_rows строк.
+    В памяти одновременно только одна пачка сырых строк, готовые пачки - типизированные колонки:
+    координаты float64, города category, даты datetime64.
+    progress(доля, сообщение) вызывается после каждой пачки.
+    """
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
     try:
-        # Читаем все три вкладки
-        points_df = pd.read_excel(file, sheet_name='Точки')
-        auditors_df = pd.read_excel(file, sheet_name='Аудиторы')
+        sheet = workbook[sheet_name]
+        total_rows = max((sheet.max_row or 1) - 1, 1)
+        rows = sheet.iter_rows(values_only=True)
         
-        # Для факта посещений может быть пустая вкладка
+        header_row = next(rows, None)
+        if header_row is None:
+            return pd.DataFrame()
+        header = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header_row)]
+        width = len(header)
+        
+        chunks = []
+        buffer = []
+        read_rows = 0
+        for row in rows:
+            # Пустые строки пропускаем, как pd.read_excel
+            if all(value is None for value in row):
+                continue
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            buffer.append(row[:width])
+            
+            if len(buffer) >= chunk_rows:
+                chunks.append(_typed_chunk(buffer, header))
+                read_rows += len(buffer)
+                buffer = []
+                if progress:
+                    progress(min(read_rows / total_rows, 1.0), f"{sheet_name}: прочитано {read_rows} строк")
+        
+        if buffer:
+            chunks.append(_typed_chunk(buffer, header))
+            read_rows += len(buffer)
+        if progress:
+            progress(1.0, f"{sheet_name}: прочитано {read_rows} строк")
+        
+        return _concat_typed_chunks(chunks, header)
+    finally:
+        workbook.close()
+
+# Параллельный разбор вкладок в пуле потоков: маленькие вкладки готовы, пока читается большая,
+# общее время приближается к времени самой большой вкладки
+SHEET_PARSE_WORKERS = len(WORKBOOK_SHEETS)
+
+def _workbook_source(source):
+    """Байты книги -> буфер; путь к файлу - без изменений"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+def run_sheet_job(source, sheet_name):
+    """
+    Потоковый разбор вкладки source (байты или путь) в текущем потоке.
+    Отдельные процессы не используются: fork из многопоточного сервера Streamlit
+    наследует чужие захваченные блокировки, а spawn не может импортировать скрипт приложения.
+    """
+    return stream_excel_sheet(_workbook_source(source), sheet_name)
+
+def parse_sheets_concurrently(jobs, on_sheet=None, progress=None):
+    """
+    Выполняет разбор вкладок параллельно в пуле потоков.
+    jobs - {вкладка: функция без аргументов -> DataFrame}.
+    on_sheet(вкладка, DataFrame) и progress(доля, сообщение) вызываются в главном потоке
+    по мере готовности (as_completed): маленькие вкладки обрабатываются, пока большая еще читается.
+    Возвращает ({вкладка: DataFrame}, {вкладка: секунды}).
+    """
+    def timed(job):
+        started = time.perf_counter()
+        result = job()
+        return result, time.perf_counter() - started
+    
+    sheets, timings = {}, {}
+    if not jobs:
+        return sheets, timings
+    
+    with ThreadPoolExecutor(max_workers=min(len(jobs), SHEET_PARSE_WORKERS)) as pool:
+        futures = {pool.submit(timed, job): sheet for sheet, job in jobs.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            sheet = futures[future]
+            sheets[sheet], timings[sheet] = future.result()
+            if progress:
+                progress(done / len(jobs), f"{sheet}: {len(sheets[sheet])} строк за {timings[sheet]:.1f} с")
+            if on_sheet:
+                on_sheet(sheet, sheets[sheet])
+    
+    return sheets, timings
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def parse_workbook(content_hash, _content, _progress=None):
+    """
+    Разбирает книгу Excel один раз: каждая нужная вкладка читается ровно один раз.
+    Ключ кэша - content_hash (sha256 содержимого); сами байты (_content) не хэшируются Streamlit.
+    Большие xlsx (от STREAM_MIN_BYTES) читаются потоково через stream_excel_sheet, вкладки - параллельно.
+    Возвращает {'sheet_names': [...], 'sheets': {вкладка: DataFrame}, 'timings': {вкладка: секунды}}.
+    """
+    # xlsx - это zip-архив; старый .xls потоково не читается
+    return read_workbook_sheets(_content, len(_content), _content[:2] == b'PK', progress=_progress)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def workbook_sheet_names(content_hash, _content):
+    """Названия листов xlsx (read_only - без разбора содержимого)"""
+    workbook = openpyxl.load_workbook(io.BytesIO(_content), read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+@st.cache_data(show_spinner=False, max_entries=24)
+def parse_workbook_sheet(content_hash, _content, sheet_name):
+    """Одна вкладка большой xlsx: кэш по содержимому и вкладке, потоковый разбор"""
+    return run_sheet_job(_content, sheet_name)
+
+def read_workbook_sheets(source, size, is_xlsx, progress=None, on_sheet=None):
+    """
+    Вкладки WORKBOOK_SHEETS из книги: source - байты или путь к файлу на диске.
+    xlsx от STREAM_MIN_BYTES читаются потоково и параллельно, остальные - через pd.ExcelFile
+    (книга загружается один раз, вкладки из нее - последовательно).
+    """
+    if size >= STREAM_MIN_BYTES and is_xlsx:
+        workbook = openpyxl.load_workbook(_workbook_source(source), read_only=True)
+        sheet_names = workbook.sheetnames
+        workbook.close()
+        
+        jobs = {name: partial(run_sheet_job, source, name) for name in WORKBOOK_SHEETS if name in sheet_names}
+        sheets, timings = parse_sheets_concurrently(jobs, on_sheet=on_sheet, progress=progress)
+        return {'sheet_names': sheet_names, 'sheets': sheets, 'timings': timings}
+    
+    sheets, timings = {}, {}
+    with pd.ExcelFile(_workbook_source(source)) as xl:
+        for name in WORKBOOK_SHEETS:
+            if name in xl.sheet_names:
+                started = time.perf_counter()
+                sheets[name] = xl.parse(name)
+                timings[name] = time.perf_counter() - started
+                if on_sheet:
+                    on_sheet(name, sheets[name])
+        return {'sheet_names': xl.sheet_names, 'sheets': sheets, 'timings': timings}
+
+def get_content_hash(uploaded_file):
+    """
+    sha256 содержимого загруженного файла.
+    Считается один раз на загрузку: повторные перезапуски берут хэш из session_state по file_id.
+    """
+    file_id = getattr(uploaded_file, 'file_id', None)
+    file_hashes = st.session_state.setdefault('file_hashes', {})
+    if file_id is not None and file_id in file_hashes:
+        return file_hashes[file_id]
+    
+    digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    if file_id is not None:
+        file_hashes[file_id] = digest
+    return digest
+
+def get_workbook(uploaded_file, progress=None, on_sheet=None):
+    """
+    Разобранная книга для загруженного файла (из кэша, если файл уже разбирался).
+    Большие xlsx разбираются по вкладкам параллельно, каждая вкладка кэшируется отдельно;
+    on_sheet(вкладка, DataFrame) вызывается вне кэшируемых функций, по мере готовности вкладок.
+    """
+    content = uploaded_file.getvalue()
+    content_hash = get_content_hash(uploaded_file)
+    
+    if len(content) >= STREAM_MIN_BYTES and content[:2] == b'PK':
+        sheet_names = workbook_sheet_names(content_hash, content)
+        jobs = {name: partial(parse_workbook_sheet, content_hash, content, name)
+                for name in WORKBOOK_SHEETS if name in sheet_names}
+        sheets, timings = parse_sheets_concurrently(jobs, on_sheet=on_sheet, progress=progress)
+        return {'sheet_names': sheet_names, 'sheets': sheets, 'timings': timings}
+    
+    workbook = parse_workbook(content_hash, content, _progress=progress)
+    if on_sheet:
+        for name, df in workbook['sheets'].items():
+            on_sheet(name, df)
+    return workbook
+
+# Отдельные файлы по вкладкам (быстрый путь без openpyxl)
+TABLE_FILE_TYPES = ['csv', 'txt', 'parquet', 'feather']
+
+def _sniff_csv(content):
+    """Кодировка (utf-8 / cp1251) и разделитель CSV по первым 64 КБ"""
+    sample_bytes = content[:65536]
+    try:
+        sample = sample_bytes.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        if e.start >= len(sample_bytes) - 3:
+            # Обрезали многобайтный символ на границе выборки - это все еще utf-8
+            sample = sample_bytes[:e.start].decode('utf-8-sig')
+            encoding = 'utf-8-sig'
+        else:
+            sample = sample_bytes.decode('cp1251', errors='replace')
+            encoding = 'cp1251'
+    
+    try:
+        separator = csv.Sniffer().sniff(sample, delimiters=';,\t|').delimiter
+    except csv.Error:
+        separator = ','
+    return encoding, separator
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def parse_table_file(content_hash, _content, file_name):
+    """
+    Читает одну вкладку из CSV / Parquet / Feather (формат по расширению file_name).
+    Ключ кэша - content_hash; колонки типизируются как при потоковом чтении Excel.
+    """
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    return read_table_source(io.BytesIO(_content), extension, _content)
+
+def read_table_source(source, extension, sample):
+    """
+    Таблица CSV / Parquet / Feather из буфера или пути на диске.
+    sample - первые байты файла для определения кодировки и разделителя CSV.
+    Файлы на диске читаются через memory map (CSV, Parquet).
+    """
+    on_disk = isinstance(source, str)
+    
+    if extension in ('parquet', 'feather'):
         try:
-            visits_df = pd.read_excel(file, sheet_name='Факт_посещений')
-        except:
+            if extension == 'parquet':
+                df = pd.read_parquet(source, memory_map=True) if on_disk else pd.read_parquet(source)
+            else:
+                df = pd.read_feather(source)
+        except ImportError:
+            raise ImportError("Для чтения Parquet/Feather нужен пакет pyarrow (pip install pyarrow)")
+    else:
+        encoding, separator = _sniff_csv(sample)
+        df = pd.read_csv(source, sep=separator, encoding=encoding, low_memory=False, memory_map=on_disk)
+    
+    return apply_column_types(df)
+
+def get_source_sheets(source, progress=None, on_sheet=None):
+    """
+    Вкладки источника данных {вкладка: DataFrame}.
+    source - книга Excel (загруженный файл), словарь {вкладка: файл CSV/Parquet/Feather}
+    или DropFolderWatcher (файлы из папки на сервере, уже разобранные в фоне).
+    Вкладки разбираются параллельно; on_sheet(вкладка, DataFrame) - по мере готовности каждой.
+    Время разбора вкладок сохраняется в st.session_state.sheet_timings.
+    """
+    timings = {}
+    if isinstance(source, DropFolderWatcher):
+        sheets = source.sheets()
+        if on_sheet:
+            for sheet, df in sheets.items():
+                on_sheet(sheet, df)
+    elif isinstance(source, dict):
+        # Хэши считаются в главном потоке (session_state), разбор - в пуле
+        jobs = {
+            sheet: partial(parse_table_file, get_content_hash(table_file), table_file.getvalue(), table_file.name)
+            for sheet, table_file in source.items() if table_file is not None
+        }
+        sheets, timings = parse_sheets_concurrently(jobs, on_sheet=on_sheet, progress=progress)
+    else:
+        workbook = get_workbook(source, progress=progress, on_sheet=on_sheet)
+        sheets, timings = workbook['sheets'], workbook.get('timings', {})
+    
+    st.session_state.sheet_timings = timings
+    return sheets
+
+# ==============================================
+# ПАПКА НА СЕРВЕРЕ: ФОНОВАЯ ЗАГРУЗКА ФАЙЛОВ
+# ==============================================
+
+# Папка, из которой читаются входные файлы (без загрузки через браузер)
+VISIT_PLAN_DROP_DIR = os.environ.get('VISIT_PLAN_DROP_DIR', os.path.join(VISIT_PLAN_DATA_DIR, 'inbox'))
+DROP_FOLDER_POLL_SECONDS = 5.0
+# Повторная проверка вскоре после появления нового файла: он разбирается, когда размер устоялся
+DROP_FOLDER_SETTLE_SECONDS = 1.0
+# Сколько кнопка «Проверить папку сейчас» ждет окончания разбора
+DROP_FOLDER_SCAN_WAIT_SECONDS = 60.0
+DROP_FOLDER_FILE_TYPES = ['xlsx', 'xls'] + TABLE_FILE_TYPES
+
+def drop_file_sheet(file_name):
+    """Вкладка для отдельного файла по имени: 'Точки.csv', 'точки_2025.parquet' -> 'Точки'"""
+    stem = os.path.splitext(os.path.basename(file_name))[0].lower()
+    for sheet in WORKBOOK_SHEETS:
+        if stem.startswith(sheet.lower()):
+            return sheet
+    return None
+
+class DropFolderWatcher:
+    """
+    Следит за папкой в фоновом потоке и разбирает новые и измененные файлы прямо с диска.
+    Книга Excel дает все свои вкладки, отдельный файл - вкладку по имени (drop_file_sheet).
+    Файл разбирается, когда его размер и время изменения не меняются между двумя проверками
+    (копирование завершено). Для каждой вкладки берется самый свежий файл.
+    Проверки выполняет только фоновый поток; внеочередную проверку можно запросить (request_scan).
+    """
+    
+    def __init__(self, folder, poll_seconds=DROP_FOLDER_POLL_SECONDS):
+        self.folder = folder
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._pending = {}      # путь -> (размер, mtime) с прошлой проверки
+        self._parsed = {}       # путь -> {'signature', 'sheets', 'parsed_at', 'seconds'}
+        self._errors = {}       # путь -> текст ошибки
+        self._failed = {}       # путь -> (размер, mtime), на которых разбор упал: до изменения не повторяем
+        self._in_progress = set()   # пути, которые сейчас разбираются
+        self.version = 0        # растет при каждом изменении набора вкладок
+        self._scan_count = 0    # число завершенных проверок
+        self._scanning = False
+        self._scanned = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"drop-folder:{folder}", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                self._scanning = True
+            try:
+                self.scan()
+            except OSError as e:
+                with self._lock:
+                    self._errors[self.folder] = str(e)
+            with self._lock:
+                self._scanning = False
+                self._scan_count += 1
+                unsettled = self._unsettled()
+                self._scanned.notify_all()
+            # Пока есть неустоявшиеся файлы - следующая проверка скоро
+            self._wake.wait(min(DROP_FOLDER_SETTLE_SECONDS, self.poll_seconds) if unsettled else self.poll_seconds)
+            self._wake.clear()
+    
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+    
+    def _unsettled(self):
+        """Файлы, увиденные, но еще не разобранные (вызывается под блокировкой)"""
+        return [path for path, signature in self._pending.items()
+                if self._parsed.get(path, {}).get('signature') != signature
+                and self._failed.get(path) != signature]
+    
+    def request_scan(self, timeout=None):
+        """
+        Просит фоновый поток проверить папку сейчас. С timeout ждет (не дольше timeout секунд),
+        пока проверка, начатая после запроса, завершится и неустоявшихся файлов не останется.
+        Возвращает True, если дождались.
+        """
+        with self._lock:
+            # Идущая проверка могла начаться до запроса - ждем следующую
+            target = self._scan_count + (2 if self._scanning else 1)
+        self._wake.set()
+        if timeout is None:
+            return False
+        with self._scanned:
+            return self._scanned.wait_for(
+                lambda: self._scan_count >= target and not self._unsettled(), timeout)
+    
+    def _list_files(self):
+        files = {}
+        if not os.path.isdir(self.folder):
+            return files
+        for entry in os.scandir(self.folder):
+            extension = entry.name.rsplit('.', 1)[-1].lower()
+            if not entry.is_file() or entry.name.startswith(('.', '~$')) or extension not in DROP_FOLDER_FILE_TYPES:
+                continue
+            if extension in TABLE_FILE_TYPES and drop_file_sheet(entry.name) is None:
+                continue
+            stat = entry.stat()
+            files[entry.path] = (stat.st_size, stat.st_mtime)
+        return files
+    
+    def _parse_file(self, path):
+        extension = path.rsplit('.', 1)[-1].lower()
+        if extension in ('xlsx', 'xls'):
+            with open(path, 'rb') as f:
+                is_xlsx = f.read(2) == b'PK'
+            return read_workbook_sheets(path, os.path.getsize(path), is_xlsx)['sheets']
+        
+        with open(path, 'rb') as f:
+            sample = f.read(65536)
+        return {drop_file_sheet(path): read_table_source(path, extension, sample)}
+    
+    def scan(self):
+        """Одна проверка папки: разбирает устоявшиеся новые/измененные файлы, забывает удаленные"""
+        files = self._list_files()
+        
+        with self._lock:
+            # Разбираемые сейчас пути пропускаем - их заберет та проверка, что их начала
+            stable = [path for path, signature in files.items()
+                      if self._pending.get(path) == signature
+                      and self._parsed.get(path, {}).get('signature') != signature
+                      and self._failed.get(path) != signature
+                      and path not in self._in_progress]
+            self._in_progress.update(stable)
+            removed = [path for path in self._parsed if path not in files]
+            # Ошибки удаленных файлов забываем; ошибка самой папки - по ключу self.folder
+            for path in [path for path in self._errors if path not in files and path != self.folder]:
+                self._errors.pop(path, None)
+                self._failed.pop(path, None)
+            if os.path.isdir(self.folder):
+                self._errors.pop(self.folder, None)
+            self._pending = files
+        
+        changed = False
+        for path in stable:
+            started = time.perf_counter()
+            try:
+                sheets = self._parse_file(path)
+            except Exception as e:
+                with self._lock:
+                    self._errors[path] = str(e)
+                    self._failed[path] = files[path]
+                continue
+            else:
+                with self._lock:
+                    self._parsed[path] = {
+                        'signature': files[path],
+                        'sheets': sheets,
+                        'parsed_at': datetime.now(),
+                        'seconds': time.perf_counter() - started
+                    }
+                    self._errors.pop(path, None)
+                    self._failed.pop(path, None)
+                changed = True
+            finally:
+                with self._lock:
+                    self._in_progress.discard(path)
+        
+        with self._lock:
+            for path in removed:
+                self._parsed.pop(path, None)
+                changed = True
+            if changed:
+                self.version += 1
+        return changed
+    
+    def sheets(self):
+        """Текущие вкладки {вкладка: DataFrame}: для каждой - из самого свежего файла"""
+        with self._lock:
+            entries = sorted(self._parsed.values(), key=lambda entry: entry['signature'][1])
+        sheets = {}
+        for entry in entries:
+            sheets.update(entry['sheets'])
+        return sheets
+    
+    def status(self):
+        """Состояние файлов папки для отображения"""
+        with self._lock:
+            rows = [{
+                'Файл': os.path.basename(path),
+                'Вкладки': ', '.join(entry['sheets']),
+                'Строк': sum(len(df) for df in entry['sheets'].values()),
+                'Разобран': entry['parsed_at'].strftime('%H:%M:%S'),
+                'Время_с': round(entry['seconds'], 2),
+                'Ошибка': ''
+            } for path, entry in self._parsed.items()]
+            rows += [{'Файл': os.path.basename(path), 'Вкладки': '', 'Строк': 0,
+                      'Разобран': '', 'Время_с': 0.0, 'Ошибка': error}
+                     for path, error in self._errors.items()]
+            waiting = [os.path.basename(path) for path in self._unsettled()]
+        return rows, waiting
+
+@st.cache_resource
+def _drop_folder_registry():
+    """Общий для всех сессий реестр: текущий наблюдатель и блокировка"""
+    return {'watcher': None, 'lock': threading.Lock()}
+
+def get_drop_folder_watcher():
+    """
+    Один наблюдатель (и один фоновый поток) на сервер. Папка задается только администратором
+    (VISIT_PLAN_DROP_DIR), не из интерфейса: сессии не могут читать произвольные папки сервера.
+    Если папка сменилась, прежний наблюдатель останавливается.
+    """
+    folder = os.path.abspath(VISIT_PLAN_DROP_DIR)
+    registry = _drop_folder_registry()
+    with registry['lock']:
+        watcher = registry['watcher']
+        if watcher is None or watcher.folder != folder:
+            if watcher is not None:
+                watcher.stop()
+            watcher = registry['watcher'] = DropFolderWatcher(folder)
+    return watcher
+
+def load_and_process_data(file, on_sheet=None):
+    """
+    Загружает и обрабатывает данные трех вкладок.
+    file - книга Excel, словарь {вкладка: файл CSV/Parquet/Feather} или DropFolderWatcher.
+    on_sheet(вкладка, DataFrame) вызывается, как только вкладка разобрана.
+    """
+    try:
+        # Все три вкладки берутся из кэша разобранных файлов
+        sheets = get_source_sheets(file, on_sheet=on_sheet)
+        points_df = sheets['Точки']
+        auditors_df = sheets['Аудиторы']
+        
+        # Для факта посещений может быть пустая вкладка
+        visits_df = sheets.get('Факт_посещений')
+        if visits_df is None:
             visits_df = pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
         
         return points_df, auditors_df, visits_df
@@ -398,84 +1751,36 @@ def load_and_process_data(file):
         st.error(f"❌ Ошибка при загрузке файла: {str(e)}")
         return None, None, None
 
+def show_sheet_previews(sheets):
+    """Предпросмотр загруженных вкладок: число строк и первые 5 строк"""
+    with st.expander("📋 Предпросмотр данных", expanded=False):
+        preview_tabs = st.tabs(WORKBOOK_SHEETS)
+        for tab, sheet in zip(preview_tabs, WORKBOOK_SHEETS):
+            with tab:
+                preview = sheets.get(sheet)
+                if preview is None:
+                    st.info("Вкладка не загружена")
+                    continue
+                st.write(f"{sheet}: {len(preview)} строк")
+                st.dataframe(preview.head(5), use_container_width=True)
+
 def load_and_process_points(df):
     """Обрабатывает данные из вкладки Точки"""
     try:
-        # Копируем DataFrame чтобы не изменять оригинал
-        points_df = df.copy()
+        points_df, rejects, missing_cols = normalize_sheet(df, 'Точки')
         
-        # Проверяем обязательные колонки
-        required_cols = ['ID_Точки', 'Широта', 'Долгота', 'Город', 'Тип']
-        missing_cols = [col for col in required_cols if col not in points_df.columns]
-        
-        if missing_cols:
-            # Попробуем найти альтернативные названия
-            column_mapping = {
-                'ID_Точки': ['ID точки', 'ID_точки', 'Point_ID'],
-                'Широта': ['Latitude', 'Lat', 'широта'],
-                'Долгота': ['Longitude', 'Lon', 'долгота'],
-                'Город': ['City', 'city', 'Город работы'],
-                'Тип': ['Type', 'Category', 'Тип точки']
-            }
-            
-            for required_col in missing_cols:
-                if required_col in column_mapping:
-                    for alt_name in column_mapping[required_col]:
-                        if alt_name in points_df.columns and required_col not in points_df.columns:
-                            points_df = points_df.rename(columns={alt_name: required_col})
-                            break
-        
-        # Проверяем еще раз
-        missing_cols = [col for col in required_cols if col not in points_df.columns]
         if missing_cols:
             st.error(f"❌ В файле Точки отсутствуют обязательные колонки: {', '.join(missing_cols)}")
             return None
         
-        # Конвертируем типы точек
-        type_mapping = {
-            'Convenience': 'Мини',
-            'convenience': 'Мини',
-            'Convenience Store': 'Мини',
-            'Convenience store': 'Мини',
-            'Hypermarket': 'Гипер',
-            'hypermarket': 'Гипер',
-            'Supermarket': 'Супер',
-            'supermarket': 'Супер',
-            'Мини': 'Мини',
-            'Гипер': 'Гипер',
-            'Супер': 'Супер'
-        }
-        
-        if 'Тип' in points_df.columns:
-            points_df['Тип'] = points_df['Тип'].map(type_mapping).fillna('Мини')
-        
-        # Обрабатываем количество посещений
-        if 'Кол-во_посещений' in points_df.columns:
-            points_df['Кол-во_посещений'] = pd.to_numeric(points_df['Кол-во_посещений'], errors='coerce').fillna(1).astype(int)
-        else:
-            points_df['Кол-во_посещений'] = 1
-        
-        # Добавляем недостающие колонки
-        if 'Название_Точки' not in points_df.columns:
-            points_df['Название_Точки'] = points_df['ID_Точки']
-        if 'Адрес' not in points_df.columns:
-            points_df['Адрес'] = ''
-        
-        # Валидация координат
-        valid_coords = points_df[
-            (points_df['Широта'] >= 41) & (points_df['Широта'] <= 82) &
-            (points_df['Долгота'] >= 19) & (points_df['Долгота'] <= 180)
-        ]
-        
-        invalid_coords = points_df[~points_df.index.isin(valid_coords.index)]
-        if len(invalid_coords) > 0:
-            st.warning(f"⚠️ Пропущено {len(invalid_coords)} точек с некорректными координатами (только Россия: широта 41-82, долгота 19-180)")
+        # Некорректные координаты (только Россия: широта 41-82, долгота 19-180) и пустые ID
+        show_sheet_rejects('Точки', rejects)
         
-        if len(valid_coords) == 0:
+        if len(points_df) == 0:
             st.error("❌ Нет точек с корректными координатами")
             return None
         
-        return valid_coords.reset_index(drop=True)
+        return points_df
         
     except Exception as e:
         st.error(f"❌ Ошибка при обработке данных Точки: {str(e)}")
@@ -484,93 +1789,290 @@ def load_and_process_points(df):
 def load_and_process_auditors(df):
     """Обрабатывает данные из вкладки Аудиторы"""
     try:
-        # Копируем DataFrame
-        auditors_df = df.copy()
-        
-        # Стандартизируем названия колонок
-        column_mapping = {
-            'ID_Сотрудника': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'employee_id', 'Сотрудник'],
-            'Город': ['City', 'city', 'Город работы']
-        }
-        
-        for target_col, alt_names in column_mapping.items():
-            if target_col not in auditors_df.columns:
-                for alt_name in alt_names:
-                    if alt_name in auditors_df.columns:
-                        auditors_df = auditors_df.rename(columns={alt_name: target_col})
-                        break
-        
-        # Проверяем обязательные колонки
-        required_cols = ['ID_Сотрудника', 'Город']
-        missing_cols = [col for col in required_cols if col not in auditors_df.columns]
+        auditors_df, rejects, missing_cols = normalize_sheet(df, 'Аудиторы')
         
         if missing_cols:
             st.error(f"❌ В файле Аудиторы отсутствуют обязательные колонки: {', '.join(missing_cols)}")
             return None
         
+        show_sheet_rejects('Аудиторы', rejects)
+        
         return auditors_df
         
     except Exception as e:
         st.error(f"❌ Ошибка при обработке данных Аудиторы: {str(e)}")
         return None
 
-def load_and_process_visits(df):
-    """Обрабатывает данные из вкладки Факт_посещений"""
+def load_and_process_absences(df):
+    """Обрабатывает необязательную вкладку Отсутствия (отпуска, больничные: период по сотруднику)"""
     try:
-        if df.empty:
-            return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
+        absences_df, rejects, missing_cols = normalize_sheet(df, 'Отсутствия')
         
-        # Копируем DataFrame
-        visits_df = df.copy()
+        if missing_cols:
+            st.warning(f"⚠️ Вкладка Отсутствия не учтена: нет колонок {', '.join(missing_cols)}")
+            return None
         
-        # Стандартизируем названия колонок
-        column_mapping = {
-            'ID_Точки': ['ID точки', 'ID_точки', 'Point_ID'],
-            'Дата_визита': ['Дата визита', 'Дата', 'Date', 'Visit Date', 'Дата посещения'],
-            'ID_Сотрудника': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'Сотрудник']
-        }
+        # Период с окончанием раньше начала - тоже в отклоненные
+        reversed_period = (absences_df['Дата_окончания'] < absences_df['Дата_начала']).to_numpy()
+        if reversed_period.any():
+            reversed_rows = absences_df.loc[reversed_period].copy()
+            reversed_rows.insert(0, 'Строка_файла', pd.NA)
+            reversed_rows['Причина'] = 'Дата_окончания раньше Дата_начала'
+            rejects = pd.concat([rejects, reversed_rows], ignore_index=True)
+            absences_df = absences_df.loc[~reversed_period].reset_index(drop=True)
         
-        for target_col, alt_names in column_mapping.items():
-            if target_col not in visits_df.columns:
-                for alt_name in alt_names:
-                    if alt_name in visits_df.columns:
-                        visits_df = visits_df.rename(columns={alt_name: target_col})
-                        break
+        show_sheet_rejects('Отсутствия', rejects)
+        
+        return absences_df
+        
+    except Exception as e:
+        st.error(f"❌ Ошибка при обработке данных Отсутствия: {str(e)}")
+        return None
+
+# Форматы дат визитов: день-месяц-год и год-месяц-день с разделителями . / - (время после даты отбрасывается)
+DATE_DMY_PATTERN = r'^(\d{1,2})[./-](\d{1,2})[./-](\d{4})(?:[ T].*)?$'
+DATE_YMD_PATTERN = r'^(\d{4})[./-](\d{1,2})[./-](\d{1,2})(?:[ T].*)?$'
+# Серийный номер Excel в текстовой ячейке: 5 цифр (1927-2173 гг.)
+DATE_SERIAL_PATTERN = r'^\d{5}(?:\.\d+)?$'
+DATE_SEPARATORS = [ord('.'), ord('/'), ord('-')]
+EXCEL_EPOCH = np.datetime64('1899-12-30', 'ns')
+EXCEL_SERIAL_MAX = 2958465  # 31.12.9999
+
+def _excel_serial_to_datetime(numbers):
+    """Серийные номера Excel -> datetime64[ns]; вне диапазона - NaT"""
+    numbers = np.asarray(numbers, dtype=float)
+    valid = (numbers > 0) & (numbers <= EXCEL_SERIAL_MAX)
+    result = np.full(len(numbers), np.datetime64('NaT'), dtype='datetime64[ns]')
+    result[valid] = EXCEL_EPOCH + (numbers[valid] * 86400e9).astype('timedelta64[ns]')
+    return result
+
+def _dates_from_ymd(year, month, day):
+    """Даты из массивов год/месяц/день; несуществующие (31.02) -> NaT"""
+    year, month, day = (np.asarray(a, dtype=np.int64) for a in (year, month, day))
+    result = np.full(len(year), np.datetime64('NaT'), dtype='datetime64[ns]')
+    valid = (year >= 1678) & (year <= 2261) & (month >= 1) & (month <= 12) & (day >= 1)
+    month_start = ((year[valid] - 1970) * 12 + month[valid] - 1).astype('datetime64[M]')
+    days_in_month = ((month_start + 1).astype('datetime64[D]') - month_start.astype('datetime64[D]')).astype(np.int64)
+    in_month = day[valid] <= days_in_month
+    valid[valid] = in_month
+    result[valid] = (month_start[in_month].astype('datetime64[D]') + (day[valid] - 1)).astype('datetime64[ns]')
+    return result
+
+def _fixed_width_dates(text):
+    """
+    Быстрый путь для строк вида дд.мм.гггг и гггг-мм-дд (с любым из разделителей . / - и
+    необязательным временем): разбор по кодам символов в матрице NumPy, без регулярок.
+    Возвращает (даты, маска дд.мм.гггг, маска гггг-мм-дд).
+    """
+    # Нужны только первые 11 символов: фиксированная ширина U11 обрезает длинные значения,
+    # и одна длинная строка в колонке не раздувает матрицу на все строки
+    chars = np.asarray(text, dtype='<U11')
+    codes = np.ascontiguousarray(chars).view(np.uint32).reshape(len(chars), 11)
+    
+    digits = codes[:, :10].astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    tail = codes[:, 10]
+    tail_ok = (tail == 0) | (tail == ord(' ')) | (tail == ord('T'))
+    
+    is_dmy = (is_digit[:, [0, 1, 3, 4, 6, 7, 8, 9]].all(axis=1) & np.isin(codes[:, 2], DATE_SEPARATORS)
+              & (codes[:, 5] == codes[:, 2]) & tail_ok)
+    is_ymd = (is_digit[:, [0, 1, 2, 3, 5, 6, 8, 9]].all(axis=1) & np.isin(codes[:, 4], DATE_SEPARATORS)
+              & (codes[:, 7] == codes[:, 4]) & tail_ok)
+    
+    d = digits
+    dates = np.full(len(chars), np.datetime64('NaT'), dtype='datetime64[ns]')
+    dates[is_dmy] = _dates_from_ymd(
+        (d[is_dmy, 6] * 1000 + d[is_dmy, 7] * 100 + d[is_dmy, 8] * 10 + d[is_dmy, 9]),
+        d[is_dmy, 3] * 10 + d[is_dmy, 4], d[is_dmy, 0] * 10 + d[is_dmy, 1]
+    )
+    dates[is_ymd] = _dates_from_ymd(
+        (d[is_ymd, 0] * 1000 + d[is_ymd, 1] * 100 + d[is_ymd, 2] * 10 + d[is_ymd, 3]),
+        d[is_ymd, 5] * 10 + d[is_ymd, 6], d[is_ymd, 8] * 10 + d[is_ymd, 9]
+    )
+    return dates, is_dmy, is_ymd
+
+def parse_visit_dates(values):
+    """
+    Векторный разбор колонки дат смешанных форматов за один проход.
+    Каждое значение классифицируется масками (тип / коды символов / регулярка),
+    каждая группа разбирается целиком:
+    - datetime / Timestamp / date - без изменений;
+    - числа и 5-значные строки - серийные номера Excel;
+    - дд.мм.гггг, дд/мм/гггг, дд-мм-гггг и гггг-мм-дд, гггг/мм/дд (в т.ч. с временем);
+    - остальное - автоопределение pandas (день первым).
+    Возвращает (даты datetime64[ns] с исходным индексом, {формат: распознано}, отклоненные [Значение, Причина]).
+    """
+    values = pd.Series(values)
+    dates = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]')
+    present = values.notna().to_numpy()
+    groups = {}
+    
+    def add_group(label, positions):
+        mask = groups.setdefault(label, np.zeros(len(values), dtype=bool))
+        mask[positions] = True
+    
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates[present] = values[present].to_numpy(dtype='datetime64[ns]')
+        add_group('datetime', present)
+    elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        dates[present] = _excel_serial_to_datetime(values[present])
+        add_group('Excel-число', present)
+    else:
+        # Тип значений: для однородной колонки - сразу по infer_dtype, поэлементно - только для смешанной
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred in ('string', 'empty'):
+            kinds = np.zeros(len(values), dtype=np.int8)
+        elif inferred in ('datetime', 'datetime64', 'date'):
+            kinds = np.ones(len(values), dtype=np.int8)
+        else:
+            kinds = values.map(
+                lambda v: 1 if isinstance(v, (datetime, date, np.datetime64))
+                else 2 if isinstance(v, (int, float, np.number)) and not isinstance(v, bool)
+                else 3 if isinstance(v, str) else 4
+            ).to_numpy(dtype=np.int8)
+        
+        native_pos = np.flatnonzero(present & (kinds == 1))
+        if len(native_pos) > 0:
+            dates[native_pos] = pd.to_datetime(values.iloc[native_pos].tolist()).to_numpy(dtype='datetime64[ns]')
+            add_group('datetime', native_pos)
+        
+        number_pos = np.flatnonzero(present & (kinds == 2))
+        if len(number_pos) > 0:
+            dates[number_pos] = _excel_serial_to_datetime(values.iloc[number_pos])
+            add_group('Excel-число', number_pos)
+        
+        # Строки: сначала быстрый путь фиксированной ширины, остаток - регулярками
+        text_pos = np.flatnonzero(present & ((kinds == 0) | (kinds == 3)))
+        text = values.iloc[text_pos].astype(str).str.strip()
+        if len(text_pos) > 0:
+            fixed_dates, is_dmy, is_ymd = _fixed_width_dates(text.str[:11])
+            fixed = is_dmy | is_ymd
+            dates[text_pos[fixed]] = fixed_dates[fixed]
+            add_group('дд.мм.гггг', text_pos[is_dmy])
+            add_group('гггг-мм-дд', text_pos[is_ymd])
+            
+            rest_pos = text_pos[~fixed]
+            rest = text[~fixed]
+            
+            is_serial = rest.str.match(DATE_SERIAL_PATTERN).to_numpy(dtype=bool)
+            dates[rest_pos[is_serial]] = _excel_serial_to_datetime(rest[is_serial].astype(float))
+            add_group('Excel-число', rest_pos[is_serial])
+            
+            dmy = rest.str.extract(DATE_DMY_PATTERN)
+            is_dmy = dmy[0].notna().to_numpy() & ~is_serial
+            dates[rest_pos[is_dmy]] = _dates_from_ymd(dmy[2][is_dmy].astype(int), dmy[1][is_dmy].astype(int),
+                                                      dmy[0][is_dmy].astype(int))
+            add_group('дд.мм.гггг', rest_pos[is_dmy])
+            
+            ymd = rest.str.extract(DATE_YMD_PATTERN)
+            is_ymd = ymd[0].notna().to_numpy() & ~is_serial & ~is_dmy
+            dates[rest_pos[is_ymd]] = _dates_from_ymd(ymd[0][is_ymd].astype(int), ymd[1][is_ymd].astype(int),
+                                                      ymd[2][is_ymd].astype(int))
+            add_group('гггг-мм-дд', rest_pos[is_ymd])
+            
+            is_other = ~(is_serial | is_dmy | is_ymd)
+            if is_other.any():
+                dates[rest_pos[is_other]] = pd.to_datetime(
+                    rest[is_other], format='mixed', dayfirst=True, errors='coerce'
+                ).to_numpy(dtype='datetime64[ns]')
+                add_group('другой', rest_pos[is_other])
+    
+    parsed = ~np.isnat(dates)
+    counts = {label: int((mask & parsed).sum()) for label, mask in groups.items() if mask.any()}
+    
+    # Отклоненные строки: пустые, нераспознанные и несуществующие даты (31.02.2025)
+    failed = ~parsed
+    rejected = pd.DataFrame({
+        'Значение': values[failed],
+        'Причина': np.where(present[failed], 'Не удалось распознать дату', 'Пустая дата')
+    })
+    counts['отклонено'] = int(failed.sum())
+    
+    return pd.Series(dates, index=values.index), counts, rejected
+
+def load_and_process_visits(df):
+    """Обрабатывает данные из вкладки Факт_посещений"""
+    try:
+        if df.empty:
+            return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
         
-        # Проверяем обязательные колонки
-        required_cols = ['ID_Точки', 'Дата_визита', 'ID_Сотрудника']
-        missing_cols = [col for col in required_cols if col not in visits_df.columns]
+        # Даты смешанных форматов разбираются за один проход внутри normalize_sheet
+        stats = {}
+        visits_df, rejects, missing_cols = normalize_sheet(df, 'Факт_посещений', stats=stats)
         
         if missing_cols:
             st.warning(f"⚠️ В файле Факт_посещений отсутствуют колонки: {', '.join(missing_cols)}")
-            return pd.DataFrame(columns=required_cols)
-        
-        # Преобразуем даты (пробуем разные форматы)
-        date_formats = ['%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%Y/%m/%d']
-        
-        for date_format in date_formats:
-            try:
-                visits_df['Дата_визита'] = pd.to_datetime(visits_df['Дата_визита'], format=date_format, errors='raise')
-                break
-            except:
-                continue
-        else:
-            # Если ни один формат не подошел, пробуем автоопределение
-            visits_df['Дата_визита'] = pd.to_datetime(visits_df['Дата_визита'], errors='coerce')
-        
-        # Удаляем строки с невалидными датами
-        invalid_dates = visits_df['Дата_визита'].isna().sum()
-        if invalid_dates > 0:
-            st.warning(f"⚠️ Пропущено {invalid_dates} записей с невалидными датами")
+            return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
         
-        visits_df = visits_df.dropna(subset=['Дата_визита'])
+        st.session_state.visit_date_formats = stats['date_formats']['Дата_визита']
+        show_sheet_rejects('Факт_посещений', rejects)
         
-        return visits_df.reset_index(drop=True)
+        return visits_df
         
     except Exception as e:
         st.error(f"❌ Ошибка при обработке данных Факт_посещений: {str(e)}")
         return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
 
+# ==============================================
+# КОМПАКТНОЕ ПРЕДСТАВЛЕНИЕ ТАБЛИЦ В ПАМЯТИ
+# ==============================================
+
+# Повторяющиеся строки (города, типы, логины, полигоны) храним как category
+COMPACT_CATEGORY_COLUMNS = ['Город', 'Тип', 'Аудитор', 'ID_Сотрудника', 'Полигон']
+COMPACT_FLOAT_COLUMNS = ['Широта', 'Долгота']
+
+def build_point_id_dtype(*id_columns):
+    """
+    Общий справочник ID точек для всех таблиц сессии.
+    Коды category - интернированные ID, categories - таблица соответствия код -> ID.
+    Категории отсортированы, поэтому сортировка по ID дает тот же порядок, что и по исходным значениям.
+    """
+    values = [pd.Series(col).dropna() for col in id_columns if col is not None]
+    values = [col.astype(object) if isinstance(col.dtype, pd.CategoricalDtype) else col for col in values]
+    if not values:
+        return pd.CategoricalDtype([])
+
+    categories = pd.Index(pd.unique(pd.concat(values, ignore_index=True)))
+    try:
+        categories = categories.sort_values()
+    except TypeError:
+        # Смешанные числовые и строковые ID не сравниваются - оставляем порядок появления
+        pass
+    return pd.CategoricalDtype(categories)
+
+def compact_frame(df, point_id_dtype=None):
+    """
+    Приводит таблицу к компактным типам (на месте, без копии):
+    города/типы/логины/полигоны -> category, координаты -> float64,
+    ID_Точки -> category с общим справочником point_id_dtype
+    """
+    if df is None or df.empty:
+        return df
+
+    for col in COMPACT_CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+
+    for col in COMPACT_FLOAT_COLUMNS:
+        if col in df.columns and df[col].dtype != np.float64:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+
+    if point_id_dtype is not None and 'ID_Точки' in df.columns and df['ID_Точки'].dtype != point_id_dtype:
+        df['ID_Точки'] = df['ID_Точки'].astype(object).astype(point_id_dtype)
+
+    return df
+
+def point_id_codes(ids, point_id_dtype):
+    """Интернированные коды ID точек (-1 для ID вне справочника)"""
+    if isinstance(ids, pd.Series) and ids.dtype == point_id_dtype:
+        return ids.cat.codes.to_numpy()
+    return pd.Categorical(list(ids), dtype=point_id_dtype).codes
+
+def frames_memory_mb(*frames):
+    """Суммарный объем таблиц в памяти (МБ, с учетом строк)"""
+    total = sum(df.memory_usage(deep=True).sum() for df in frames if df is not None)
+    return total / (1024 * 1024)
+
 # ==============================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С ДАТАМИ И НЕДЕЛЯМИ
 # ==============================================
@@ -591,29 +2093,544 @@ def get_iso_week(date_obj):
     """Возвращает ISO номер недели для даты"""
     return date_obj.isocalendar()[1]
 
+# Производственный календарь РФ: праздничные (нерабочие) будни и рабочие
+# субботы по постановлениям Правительства о переносе выходных
+RU_PRODUCTION_CALENDAR = {
+    2023: {
+        'holidays': [
+            '2023-01-02', '2023-01-03', '2023-01-04', '2023-01-05', '2023-01-06',
+            '2023-02-23', '2023-02-24', '2023-03-08',
+            '2023-05-01', '2023-05-08', '2023-05-09',
+            '2023-06-12', '2023-11-06',
+        ],
+        'working_saturdays': [],
+    },
+    2024: {
+        'holidays': [
+            '2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05', '2024-01-08',
+            '2024-02-23', '2024-03-08',
+            '2024-04-29', '2024-04-30', '2024-05-01', '2024-05-09', '2024-05-10',
+            '2024-06-12', '2024-11-04', '2024-12-30', '2024-12-31',
+        ],
+        'working_saturdays': ['2024-04-27', '2024-11-02', '2024-12-28'],
+    },
+    2025: {
+        'holidays': [
+            '2025-01-01', '2025-01-02', '2025-01-03', '2025-01-06', '2025-01-07', '2025-01-08',
+            '2025-05-01', '2025-05-02', '2025-05-08', '2025-05-09',
+            '2025-06-12', '2025-06-13', '2025-11-03', '2025-11-04', '2025-12-31',
+        ],
+        'working_saturdays': ['2025-11-01'],
+    },
+    2026: {
+        'holidays': [
+            '2026-01-01', '2026-01-02', '2026-01-05', '2026-01-06', '2026-01-07', '2026-01-08',
+            '2026-01-09', '2026-02-23', '2026-03-09',
+            '2026-05-01', '2026-05-11', '2026-06-12', '2026-11-04', '2026-12-31',
+        ],
+        'working_saturdays': [],
+    },
+}
+
+# Нерабочие праздничные дни по ТК РФ (ст. 112) — для лет вне таблицы,
+# без переносов
+RU_FIXED_HOLIDAYS = [
+    (1, 1), (1, 2), (1, 3), (1, 4), (1, 5), (1, 6), (1, 7), (1, 8),
+    (2, 23), (3, 8), (5, 1), (5, 9), (6, 12), (11, 4),
+]
+
+
+def production_calendar_known(year):
+    """Есть ли год в таблице производственного календаря"""
+    return int(year) in RU_PRODUCTION_CALENDAR
+
+
+@lru_cache(maxsize=None)
+def production_calendar_arrays(years):
+    """
+    Праздники и рабочие субботы для набора лет (кортеж) в виде
+    отсортированных массивов datetime64[D] для np.is_busday.
+    Для лет вне таблицы берутся только фиксированные праздники.
+    """
+    holidays = []
+    working_saturdays = []
+    for year in years:
+        year_calendar = RU_PRODUCTION_CALENDAR.get(year)
+        if year_calendar is not None:
+            holidays.extend(year_calendar['holidays'])
+            working_saturdays.extend(year_calendar['working_saturdays'])
+        else:
+            holidays.extend(f"{year}-{month:02d}-{day:02d}" for month, day in RU_FIXED_HOLIDAYS)
+    holidays = np.unique(np.array(holidays, dtype='datetime64[D]'))
+    working_saturdays = np.unique(np.array(working_saturdays, dtype='datetime64[D]'))
+    holidays.setflags(write=False)
+    working_saturdays.setflags(write=False)
+    return holidays, working_saturdays
+
+
+def _calendar_years(*date_arrays):
+    """Кортеж лет, покрывающих все переданные даты"""
+    years = set()
+    for dates in date_arrays:
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        if dates.size:
+            first_year = dates.min().astype('datetime64[Y]').astype(int) + 1970
+            last_year = dates.max().astype('datetime64[Y]').astype(int) + 1970
+            years.update(range(first_year, last_year + 1))
+    return tuple(sorted(years))
+
+
+def is_working_day_array(dates):
+    """Векторная проверка: рабочий ли день для каждой даты массива"""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    holidays, working_saturdays = production_calendar_arrays(_calendar_years(dates))
+    return np.is_busday(dates, holidays=holidays) | np.isin(dates, working_saturdays)
+
+
+class QuarterCalendar:
+    """
+    Календарный индекс квартала: строится один раз на (год, квартал)
+    и дальше только нарезается.
+
+    days          — все дни квартала (datetime64[D])
+    working_mask  — признак рабочего дня для каждого из days
+    working_days  — рабочие дни квартала (datetime64[D])
+    week_offsets  — для каждой недели [начало, конец) в days
+    week_working  — для каждой недели [начало, конец) в working_days
+    iso_weeks     — ISO номер недели по первому дню каждой недели
+
+    Рабочие дни берутся из производственного календаря (праздники
+    и перенесенные рабочие субботы). Недели, как и раньше, режутся
+    по 7 дней от начала квартала, последняя может быть короче.
+    """
+
+    def __init__(self, year, quarter):
+        self.year = year
+        self.quarter = quarter
+        self.start, self.end = get_quarter_dates(year, quarter)
+
+        self.days = np.arange(np.datetime64(self.start, 'D'), np.datetime64(self.end, 'D') + 1)
+        self.calendar_known = production_calendar_known(year)
+        self.working_mask = is_working_day_array(self.days)
+        self.working_days = self.days[self.working_mask]
+
+        # Смещения недель в массиве дней и в массиве рабочих дней
+        starts = np.arange(0, len(self.days), 7)
+        ends = np.minimum(starts + 7, len(self.days))
+        self.week_offsets = np.column_stack([starts, ends])
+        working_before = np.concatenate([[0], np.cumsum(self.working_mask)])
+        self.week_working = np.column_stack([working_before[starts], working_before[ends]])
+
+        # ISO неделя: номер недели четверга, к которому относится день
+        week_days = self.days[starts]
+        weekday = (week_days.astype(np.int64) + 3) % 7  # 1970-01-01 — четверг
+        thursday = week_days + (3 - weekday)
+        year_start = thursday.astype('datetime64[Y]').astype('datetime64[D]')
+        self.iso_weeks = (thursday - year_start).astype(np.int64) // 7 + 1
+
+        for array in (self.days, self.working_mask, self.working_days,
+                      self.week_offsets, self.week_working, self.iso_weeks):
+            array.setflags(write=False)
+
+        self.weeks = []
+        for (start, end), iso_week in zip(self.week_offsets, self.iso_weeks):
+            week_start = self.days[start].astype(object)
+            week_end = self.days[end - 1].astype(object)
+            self.weeks.append({
+                'iso_week_number': int(iso_week),
+                'start_date': week_start,
+                'end_date': week_end,
+                'week_display': f"Неделя {iso_week} ({week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')})"
+            })
+
+    @property
+    def num_weeks(self):
+        return len(self.week_offsets)
+
+    def working_days_list(self):
+        """Рабочие дни квартала списком date"""
+        return self.working_days.tolist()
+
+    def week_working_days(self, week_idx):
+        """Рабочие дни недели (по индексу недели в квартале) списком date"""
+        if week_idx < 0 or week_idx >= self.num_weeks:
+            return []
+        start, end = self.week_working[week_idx]
+        return self.working_days[start:end].tolist()
+
+    def is_working_day(self, day):
+        """Рабочий ли день; day должен лежать внутри квартала"""
+        offset = (np.datetime64(day, 'D') - self.days[0]).astype(np.int64)
+        return bool(self.working_mask[offset])
+
+
+@lru_cache(maxsize=None)
+def get_quarter_calendar(year, quarter):
+    """Календарный индекс квартала (один объект на год и квартал)"""
+    return QuarterCalendar(int(year), int(quarter))
+
+
+def filter_working_days(dates):
+    """Оставляет рабочие дни из произвольного набора дат по производственному календарю"""
+    dates = [day for day in dates if hasattr(day, 'weekday')]
+    if not dates:
+        return []
+    day_array = np.array([day.date() if isinstance(day, datetime) else day for day in dates],
+                         dtype='datetime64[D]')
+    working = is_working_day_array(day_array)
+    return [day for day, is_working in zip(dates, working) if is_working]
+
+
 def get_weeks_in_quarter(year, quarter):
     """Возвращает список недель в квартале с ISO номерами"""
-    quarter_start, quarter_end = get_quarter_dates(year, quarter)
-    
-    weeks = []
-    current_date = quarter_start
-    
-    while current_date <= quarter_end:
-        week_start = current_date
-        week_end = min(current_date + timedelta(days=6), quarter_end)
-        
-        iso_week = get_iso_week(week_start)
-        
-        weeks.append({
-            'iso_week_number': iso_week,
-            'start_date': week_start,
-            'end_date': week_end,
-            'week_display': f"Неделя {iso_week} ({week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')})"
+    return [dict(week) for week in get_quarter_calendar(year, quarter).weeks]
+
+# ==============================================
+# ДОСТУПНОСТЬ АУДИТОРОВ: ОТСУТСТВИЯ И СТАВКА
+# ==============================================
+
+class AuditorAvailability:
+    """
+    Доступность аудиторов по дням квартала.
+
+    available — маска (аудитор × день квартала): рабочий день и нет отсутствия
+    prefix    — префиксные суммы маски по дням: доступные дни в любом
+                отрезке [начало, конец) считаются за O(1)
+    fte       — ставка аудитора (1.0 — полная)
+    week_days_count / week_capacity — доступные дни и емкость (дни × ставка)
+                по неделям календарного индекса
+
+    Аудитор без строки в таблице считается доступным все рабочие дни.
+    """
+
+    def __init__(self, calendar, auditor_ids, fte, absent):
+        self.calendar = calendar
+        self.auditor_ids = list(auditor_ids)
+        self._rows = {str(auditor): row for row, auditor in enumerate(self.auditor_ids)}
+        self.fte = np.asarray(fte, dtype=float)
+        self.available = calendar.working_mask[np.newaxis, :] & ~absent
+        self.absent_working = (calendar.working_mask[np.newaxis, :] & absent).sum(axis=1)
+
+        self.prefix = np.zeros((len(self.auditor_ids), len(calendar.days) + 1), dtype=np.int32)
+        np.cumsum(self.available, axis=1, out=self.prefix[:, 1:])
+
+        starts, ends = calendar.week_offsets[:, 0], calendar.week_offsets[:, 1]
+        self.week_days_count = self.prefix[:, ends] - self.prefix[:, starts]
+        self.week_capacity = self.week_days_count * self.fte[:, np.newaxis]
+
+    def _row(self, auditor):
+        return self._rows.get(str(auditor))
+
+    def available_days_between(self, auditor, start, end):
+        """Число доступных дней аудитора в [start, end) (смещения от начала квартала)"""
+        row = self._row(auditor)
+        if row is None:
+            return int(np.count_nonzero(self.calendar.working_mask[start:end]))
+        return int(self.prefix[row, end] - self.prefix[row, start])
+
+    def week_capacity_of(self, auditor, week_idx):
+        """Емкость недели: доступные дни × ставка"""
+        row = self._row(auditor)
+        if row is None:
+            start, end = self.calendar.week_working[week_idx]
+            return float(end - start)
+        return float(self.week_capacity[row, week_idx])
+
+    def week_days(self, auditor, week_idx):
+        """Доступные дни недели списком date"""
+        row = self._row(auditor)
+        if row is None:
+            return self.calendar.week_working_days(week_idx)
+        start, end = self.calendar.week_offsets[week_idx]
+        if self.prefix[row, end] == self.prefix[row, start]:
+            return []
+        days = self.calendar.days[start:end]
+        return days[self.available[row, start:end]].tolist()
+
+    def week_capacities(self, auditor):
+        """Емкость всех недель квартала для аудитора (строка таблицы, без копирования)"""
+        row = self._row(auditor)
+        if row is None:
+            return (self.calendar.week_working[:, 1] - self.calendar.week_working[:, 0]).astype(float)
+        return self.week_capacity[row]
+
+    def available_weeks(self, auditor):
+        """Индексы недель, в которые у аудитора есть хотя бы один доступный день"""
+        row = self._row(auditor)
+        if row is None:
+            counts = self.calendar.week_working[:, 1] - self.calendar.week_working[:, 0]
+        else:
+            counts = self.week_days_count[row]
+        return np.flatnonzero(counts > 0).tolist()
+
+    def is_constrained(self, auditor):
+        """Есть ли у аудитора отсутствия в рабочие дни или неполная ставка"""
+        row = self._row(auditor)
+        if row is None:
+            return False
+        return bool(self.absent_working[row] > 0 or self.fte[row] < 1)
+
+    def changed_auditors(self, other):
+        """Аудиторы, у которых доступность отличается от other (расчета с тем же календарем)"""
+        if other is None or other.calendar is not self.calendar:
+            return set(self.auditor_ids)
+        changed = set()
+        for auditor in set(self.auditor_ids) | set(other.auditor_ids):
+            row, other_row = self._row(auditor), other._row(auditor)
+            if row is None or other_row is None:
+                if self.is_constrained(auditor) or other.is_constrained(auditor):
+                    changed.add(auditor)
+            elif (self.fte[row] != other.fte[other_row] or
+                  not np.array_equal(self.available[row], other.available[other_row])):
+                changed.add(auditor)
+        return changed
+
+    def summary(self):
+        """Сводка по аудиторам: ставка, рабочие дни, отсутствия, емкость квартала"""
+        working_days = len(self.calendar.working_days)
+        return pd.DataFrame({
+            'Аудитор': self.auditor_ids,
+            'Ставка': self.fte,
+            'Рабочих_дней': working_days,
+            'Дней_отсутствия': self.absent_working,
+            'Доступно_дней': self.prefix[:, -1],
+            'Емкость_дней': np.round(self.prefix[:, -1] * self.fte, 1),
+            'Недель_без_емкости': (self.week_capacity <= 0).sum(axis=1)
         })
+
+
+def build_auditor_availability(auditors_df, absences_df, year, quarter):
+    """
+    Компилирует ставку (колонка Ставка вкладки Аудиторы) и периоды отсутствия
+    (вкладка Отсутствия) в маску доступности по дням квартала.
+    Периоды размечаются разностным массивом: +1 в начале, -1 после окончания,
+    накопленная сумма > 0 - день отсутствия.
+    """
+    calendar = get_quarter_calendar(year, quarter)
+    auditors = auditors_df.drop_duplicates('ID_Сотрудника')
+    auditor_ids = auditors['ID_Сотрудника'].astype(object).tolist()
+    if 'Ставка' in auditors.columns:
+        fte = auditors['Ставка'].fillna(1.0).to_numpy(dtype=float)
+    else:
+        fte = np.ones(len(auditor_ids))
+
+    n_days = len(calendar.days)
+    marks = np.zeros((len(auditor_ids), n_days + 1), dtype=np.int32)
+    if absences_df is not None and not absences_df.empty:
+        rows_by_id = {str(auditor): row for row, auditor in enumerate(auditor_ids)}
+        rows = absences_df['ID_Сотрудника'].astype(object).map(lambda a: rows_by_id.get(str(a), -1)).to_numpy()
+        first_day = calendar.days[0]
+        starts = (absences_df['Дата_начала'].to_numpy(dtype='datetime64[D]') - first_day).astype(np.int64)
+        ends = (absences_df['Дата_окончания'].to_numpy(dtype='datetime64[D]') - first_day).astype(np.int64) + 1
+        # Только известные аудиторы и периоды, пересекающиеся с кварталом
+        inside = (rows >= 0) & (ends > 0) & (starts < n_days)
+        rows, starts, ends = rows[inside], np.clip(starts[inside], 0, n_days), np.clip(ends[inside], 0, n_days)
+        np.add.at(marks, (rows, starts), 1)
+        np.add.at(marks, (rows, ends), -1)
+    absent = np.cumsum(marks[:, :n_days], axis=1) > 0
+
+    return AuditorAvailability(calendar, auditor_ids, fte, absent)
+
+# ==============================================
+# РАССТОЯНИЯ: ВЕКТОРНЫЕ МАТРИЦЫ ПОПАРНЫХ РАССТОЯНИЙ
+# ==============================================
+
+KM_PER_DEGREE = 111.0
+EARTH_RADIUS_KM = 6371.0
+# manhattan - прямоугольное расстояние с масштабом долготы по средней широте (км, для городов),
+# haversine - по дуге большого круга (км), equirectangular - евклидово на плоскости
+# с масштабом долготы (км), planar - евклидово в градусах (для разбиения полигонов)
+DISTANCE_METRICS = ('manhattan', 'haversine', 'equirectangular', 'planar')
+# Строк матрицы за один блок: блок (block_size × n) считается в float64 и пишется в результат
+DISTANCE_BLOCK_SIZE = 1024
+
+def as_coordinates(points):
+    """Список точек-словарей (Широта/Долгота) или массив (n, 2) -> массив float64 [широта, долгота]"""
+    if isinstance(points, np.ndarray):
+        return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    points = list(points)
+    if points and isinstance(points[0], dict):
+        return np.array([[p['Широта'], p['Долгота']] for p in points], dtype=np.float64).reshape(-1, 2)
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+def _distance_block(a, b, metric):
+    """Расстояния между строками a (m, 2) и b (n, 2) трансляцией NumPy -> (m, n) float64"""
+    lat1, lon1 = a[:, 0:1], a[:, 1:2]
+    lat2, lon2 = b[np.newaxis, :, 0], b[np.newaxis, :, 1]
+    
+    if metric == 'planar':
+        return np.hypot(lat2 - lat1, lon2 - lon1)
+    
+    if metric == 'haversine':
+        phi1, phi2 = np.radians(lat1), np.radians(lat2)
+        h = (np.sin((phi2 - phi1) / 2) ** 2 +
+             np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+    
+    lat_km = (lat2 - lat1) * KM_PER_DEGREE
+    lon_km = (lon2 - lon1) * (KM_PER_DEGREE * np.cos(np.radians((lat1 + lat2) / 2)))
+    if metric == 'manhattan':
+        return np.abs(lat_km) + np.abs(lon_km)
+    if metric == 'equirectangular':
+        return np.hypot(lat_km, lon_km)
+    raise ValueError(f"Неизвестная метрика расстояния: {metric} (доступны: {', '.join(DISTANCE_METRICS)})")
+
+def iter_distance_blocks(a, b=None, metric='manhattan', block_size=DISTANCE_BLOCK_SIZE):
+    """
+    Матрица расстояний по блокам строк: (начало, блок float64 (≤ block_size, n)).
+    В памяти одновременно только один блок - для больших наборов без полной матрицы.
+    """
+    a = as_coordinates(a)
+    b = a if b is None else as_coordinates(b)
+    block_size = max(int(block_size), 1)
+    for start in range(0, len(a), block_size):
+        yield start, _distance_block(a[start:start + block_size], b, metric)
+
+def pairwise_distances(a, b=None, metric='manhattan', dtype=np.float32, block_size=DISTANCE_BLOCK_SIZE):
+    """
+    Матрица попарных расстояний между точками a и b (по умолчанию b = a).
+    a, b - списки точек-словарей или массивы (n, 2) [широта, долгота].
+    Считается блоками по block_size строк в float64, хранится в dtype (по умолчанию float32).
+    """
+    a = as_coordinates(a)
+    b = a if b is None else as_coordinates(b)
+    result = np.empty((len(a), len(b)), dtype=dtype)
+    for start, block in iter_distance_blocks(a, b, metric=metric, block_size=block_size):
+        result[start:start + len(block)] = block
+    return result
+
+def nearest_indices(a, b, metric='manhattan', block_size=DISTANCE_BLOCK_SIZE):
+    """Для каждой точки a - индекс ближайшей точки b и расстояние до нее (блоками, без полной матрицы)"""
+    a = as_coordinates(a)
+    indices = np.zeros(len(a), dtype=np.int64)
+    distances = np.zeros(len(a), dtype=np.float64)
+    if len(a) == 0 or len(as_coordinates(b)) == 0:
+        return indices, distances
+    for start, block in iter_distance_blocks(a, b, metric=metric, block_size=block_size):
+        block_indices = block.argmin(axis=1)
+        indices[start:start + len(block)] = block_indices
+        distances[start:start + len(block)] = block[np.arange(len(block)), block_indices]
+    return indices, distances
+
+# ==============================================
+# ЛОКАЛЬНЫЙ ПОИСК: 2-OPT И OR-OPT ДЛЯ МАРШРУТОВ ДНЯ
+# ==============================================
+
+# Бюджет времени на улучшение одного маршрута (мс), 0 - без улучшения
+ROUTE_IMPROVE_BUDGET_MS = 50
+# Длины переносимых отрезков в Or-opt
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
+# Минимальный выигрыш хода (км): меньшие - шум округления
+LOCAL_SEARCH_EPSILON = 1e-6
+
+def _closed_route_matrix(matrix):
+    """
+    Матрица с фиктивной вершиной n (нулевые расстояния до всех):
+    открытый маршрут [0..n-1] = цикл n -> маршрут -> n, концы маршрута тоже можно менять
+    """
+    n = len(matrix)
+    closed = np.zeros((n + 1, n + 1), dtype=np.float64)
+    closed[:n, :n] = matrix
+    return closed
+
+def _best_two_opt_move(route, dist):
+    """
+    Лучший ход 2-opt для цикла route (фиктивная вершина в начале и конце):
+    разворот отрезка route[i+1..j] меняет ребра (i, i+1), (j, j+1) на (i, j), (i+1, j+1).
+    Выигрыш всех пар ребер считается одной матрицей. Возвращает (выигрыш, i, j).
+    """
+    a, b = route[:-1], route[1:]
+    edge = dist[a, b]
+    delta = dist[np.ix_(a, a)] + dist[np.ix_(b, b)] - edge[:, np.newaxis] - edge[np.newaxis, :]
+    # Только j > i + 1 (соседние ребра разворот не меняет)
+    delta[np.tril_indices(len(a), 1)] = 0.0
+    i, j = np.unravel_index(int(delta.argmin()), delta.shape)
+    return float(delta[i, j]), int(i), int(j)
+
+def _best_or_opt_move(route, dist):
+    """
+    Лучший ход Or-opt: отрезок из 1-3 вершин переносится на другое ребро (прямо или развернутым).
+    Для каждой длины отрезка выигрыш всех пар (отрезок, ребро вставки) - одна матрица.
+    Возвращает (выигрыш, начало отрезка, длина, ребро вставки, развернуть) или None.
+    """
+    n_inner = len(route) - 2
+    a, b = route[:-1], route[1:]
+    edge = dist[a, b]
+    best = None
+    for length in OR_OPT_SEGMENT_LENGTHS:
+        if length >= n_inner:
+            break
+        starts = np.arange(1, n_inner - length + 2)
+        first, last = route[starts], route[starts + length - 1]
+        before, after = route[starts - 1], route[starts + length]
+        removal = dist[before, first] + dist[last, after] - dist[before, after]
+        
+        # Вставка между u = a[k] и v = b[k]: u -> отрезок -> v
+        forward = dist[np.ix_(a, first)].T + dist[np.ix_(last, b)] - edge
+        backward = dist[np.ix_(a, last)].T + dist[np.ix_(first, b)] - edge
+        # Ребра внутри и по краям отрезка не подходят для вставки
+        edges = np.arange(len(a))
+        invalid = ((edges[np.newaxis, :] >= starts[:, np.newaxis] - 1) &
+                   (edges[np.newaxis, :] <= starts[:, np.newaxis] + length - 1))
+        for reverse, insertion in ((False, forward), (True, backward)):
+            delta = np.where(invalid, np.inf, insertion - removal[:, np.newaxis])
+            k = int(delta.argmin())
+            segment, target = np.unravel_index(k, delta.shape)
+            gain = float(delta[segment, target])
+            if best is None or gain < best[0]:
+                best = (gain, int(starts[segment]), length, int(target), reverse)
+    return best
+
+def _apply_or_opt(route, start, length, target, reverse):
+    """Переносит route[start:start+length] на ребро (target, target+1) исходного маршрута"""
+    segment = route[start:start + length]
+    if reverse:
+        segment = segment[::-1]
+    rest = np.concatenate([route[:start], route[start + length:]])
+    # Позиция ребра в маршруте без отрезка
+    insert_at = target + 1 if target < start else target + 1 - length
+    return np.concatenate([rest[:insert_at], segment, rest[insert_at:]])
+
+def local_search_route(order, matrix, time_budget=ROUTE_IMPROVE_BUDGET_MS / 1000):
+    """
+    Улучшает открытый маршрут order (индексы строк matrix) ходами 2-opt и Or-opt
+    (лучший ход за итерацию), пока есть выигрыш и не истек бюджет time_budget (секунды).
+    Возвращает (новый порядок, км до, км после, итераций, бюджет исчерпан).
+    """
+    order = np.asarray(order, dtype=np.int64)
+    n = len(order)
+    dist = _closed_route_matrix(np.asarray(matrix, dtype=np.float64))
+    dummy = len(matrix)
+    route = np.concatenate([[dummy], order, [dummy]])
+    
+    def length_of(r):
+        return float(dist[r[:-1], r[1:]].sum())
+    
+    km_before = length_of(route)
+    if n < 3 or time_budget <= 0:
+        return order.tolist(), km_before, km_before, 0, False
+    
+    deadline = time.perf_counter() + time_budget
+    iterations = 0
+    timed_out = False
+    while True:
+        if time.perf_counter() >= deadline:
+            timed_out = True
+            break
+        iterations += 1
+        
+        gain, i, j = _best_two_opt_move(route, dist)
+        if gain < -LOCAL_SEARCH_EPSILON:
+            route[i + 1:j + 1] = route[i + 1:j + 1][::-1]
+            continue
         
-        current_date = week_end + timedelta(days=1)
+        move = _best_or_opt_move(route, dist)
+        if move is not None and move[0] < -LOCAL_SEARCH_EPSILON:
+            route = _apply_or_opt(route, *move[1:])
+            continue
+        break
     
-    return weeks
+    return route[1:-1].tolist(), km_before, length_of(route), iterations, timed_out
 
 # ==============================================
 # КЛАСС ДЛЯ ОПТИМИЗАЦИИ МАРШРУТОВ ПО ДНЯМ
@@ -627,60 +2644,67 @@ class WeeklyRouteOptimizer:
     
     @staticmethod
     def calculate_distance(lat1, lon1, lat2, lon2):
-        """Расчет расстояния в КИЛОМЕТРАХ между точками"""
-        # 1 градус широты = 111 км
-        km_per_lat = 111.0
-        
-        # Средняя широта для расчета масштаба долготы
-        avg_lat = (lat1 + lat2) / 2
-        km_per_lon = 111.0 * math.cos(math.radians(avg_lat))
-        
-        # Разница в километрах
-        lat_km = (lat2 - lat1) * km_per_lat
-        lon_km = (lon2 - lon1) * km_per_lon
-        
-        # Прямоугольное расстояние (проще для городов)
-        distance_km = abs(lat_km) + abs(lon_km)
-        
-        return distance_km
+        """Расчет расстояния в КИЛОМЕТРАХ между точками (одна пара, метрика manhattan)"""
+        return float(pairwise_distances([[lat1, lon1]], [[lat2, lon2]], dtype=np.float64)[0, 0])
     
     @staticmethod
-    def greedy_route(points):
+    def greedy_route(points, metric='manhattan'):
         """
         Жадный алгоритм построения маршрута
         Начинает с самой дальней точки от центра
+        Небольшой день - одна матрица расстояний (float32), большой - строка расстояний на шаг
         """
         if len(points) <= 1:
             return points
         
-        # Вычисляем центр всех точек
-        center_lat = np.mean([p['Широта'] for p in points])
-        center_lon = np.mean([p['Долгота'] for p in points])
+        coords = as_coordinates(points)
+        n = len(coords)
         
-        # Находим самую дальнюю точку от центра
-        start_idx = max(range(len(points)),
-                       key=lambda i: WeeklyRouteOptimizer.calculate_distance(
-                           points[i]['Широта'], points[i]['Долгота'],
-                           center_lat, center_lon
-                       ))
+        # Самая дальняя точка от центра всех точек
+        center = coords.mean(axis=0, keepdims=True)
+        current = int(pairwise_distances(coords, center, metric=metric)[:, 0].argmax())
         
-        route = [points[start_idx]]
-        unvisited = points[:start_idx] + points[start_idx+1:]
+        matrix = pairwise_distances(coords, metric=metric) if n <= DISTANCE_BLOCK_SIZE else None
+        visited = np.zeros(n, dtype=bool)
+        order = [current]
+        visited[current] = True
         
-        while unvisited:
-            last_point = route[-1]
-            
-            # Находим ближайшую непосещенную точку
-            nearest_idx = min(range(len(unvisited)),
-                key=lambda i: WeeklyRouteOptimizer.calculate_distance(
-                    last_point['Широта'], last_point['Долгота'],
-                    unvisited[i]['Широта'], unvisited[i]['Долгота']
-                ))
-            
-            route.append(unvisited[nearest_idx])
-            unvisited.pop(nearest_idx)
+        for _ in range(n - 1):
+            if matrix is not None:
+                row = matrix[current].astype(np.float64)
+            else:
+                row = _distance_block(coords[current:current + 1], coords, metric)[0]
+            # Ближайшая непосещенная точка (при равенстве - первая по порядку)
+            row[visited] = np.inf
+            current = int(row.argmin())
+            order.append(current)
+            visited[current] = True
+        
+        return [points[i] for i in order]
+    
+    @staticmethod
+    def improve_route(route, time_budget=ROUTE_IMPROVE_BUDGET_MS / 1000, metric='manhattan', stats=None):
+        """
+        Улучшает готовый маршрут (список точек по порядку) локальным поиском 2-opt / Or-opt
+        по матрице расстояний маршрута. stats (dict) накапливает км до/после и время.
+        """
+        if len(route) < 3 or time_budget <= 0:
+            return route
+        
+        started = time.perf_counter()
+        matrix = pairwise_distances(route, metric=metric)
+        order, km_before, km_after, _, timed_out = local_search_route(
+            range(len(route)), matrix, time_budget=time_budget
+        )
+        
+        if stats is not None:
+            stats['routes'] = stats.get('routes', 0) + 1
+            stats['km_before'] = stats.get('km_before', 0.0) + km_before
+            stats['km_after'] = stats.get('km_after', 0.0) + km_after
+            stats['seconds'] = stats.get('seconds', 0.0) + time.perf_counter() - started
+            stats['timed_out'] = stats.get('timed_out', 0) + int(timed_out)
         
-        return route
+        return [route[i] for i in order]
     
     @staticmethod
     def distribute_points_to_days(points_list, visits_per_point, working_days):
@@ -724,13 +2748,8 @@ class WeeklyRouteOptimizer:
         """
         results = []
         
-        # Определяем рабочие дни (понедельник-пятница)
-        working_days = []
-        for day_date in week_dates:
-            # Проверяем что это datetime/date объект
-            if hasattr(day_date, 'weekday'):
-                if day_date.weekday() < 5:  # 0-4 = Пн-Пт
-                    working_days.append(day_date)
+        # Определяем рабочие дни по календарному индексу квартала
+        working_days = filter_working_days(week_dates)
         
         if not working_days:
             return results
@@ -745,8 +2764,10 @@ class WeeklyRouteOptimizer:
             if not day_points:
                 continue
             
-            # Строим оптимальный маршрут для дня
-            optimized_route = WeeklyRouteOptimizer.greedy_route(day_points)
+            # Строим маршрут для дня и улучшаем его локальным поиском
+            optimized_route = WeeklyRouteOptimizer.improve_route(
+                WeeklyRouteOptimizer.greedy_route(day_points)
+            )
             
             # Добавляем каждую точку в результат с указанием дня
             # Преобразуем в datetime если нужно
@@ -776,35 +2797,9 @@ class WeeklyRouteOptimizer:
 def get_working_days_for_quarter(year, quarter):
     """
     Возвращает список рабочих дней в квартале
-    с учетом российских праздников (использует workalendar если доступен)
+    с учетом российских праздников (встроенный производственный календарь)
     """
-    quarter_start, quarter_end = get_quarter_dates(year, quarter)
-    
-    if WORKALENDAR_AVAILABLE:
-        # Используем библиотеку workalendar для точного расчета
-        cal = Russia()
-        working_days = []
-        current_date = quarter_start
-        
-        while current_date <= quarter_end:
-            if cal.is_working_day(current_date):
-                working_days.append(current_date)
-            current_date += timedelta(days=1)
-        
-        return working_days
-    else:
-        # Простая версия: только понедельник-пятница
-        st.sidebar.warning("⚠️ Для учета праздников установите: pip install workalendar")
-        
-        working_days = []
-        current_date = quarter_start
-        
-        while current_date <= quarter_end:
-            if current_date.weekday() < 5:  # Пн-Пт
-                working_days.append(current_date)
-            current_date += timedelta(days=1)
-        
-        return working_days
+    return get_quarter_calendar(year, quarter).working_days_list()
 
 def simple_cluster_points(points, n_clusters):
     """
@@ -821,71 +2816,37 @@ def simple_cluster_points(points, n_clusters):
             clusters.append([])
         return clusters
     
-    # Выбираем начальные центры
-    centers = []
+    coords = as_coordinates(points)
     
-    # Первый центр - первая точка
-    if points:
-        centers.append(points[0])
+    # Начальные центры: первая точка, остальные - самые удаленные от уже выбранных
+    center_indices = [0]
+    is_center = (coords == coords[0]).all(axis=1)
+    min_dist = pairwise_distances(coords, coords[0:1], dtype=np.float64)[:, 0]
     
-    # Остальные центры - самые удаленные
     for _ in range(1, min(n_clusters, len(points))):
-        max_min_distance = -1
-        best_point = None
-        
-        for point in points:
-            if point in centers:
-                continue
-            
-            # Минимальное расстояние до существующих центров
-            min_dist = float('inf')
-            for center in centers:
-                dist = WeeklyRouteOptimizer.calculate_distance(
-                    point['Широта'], point['Долгота'],
-                    center['Широта'], center['Долгота']
-                )
-                min_dist = min(min_dist, dist)
-            
-            if min_dist > max_min_distance:
-                max_min_distance = min_dist
-                best_point = point
-        
-        if best_point:
-            centers.append(best_point)
-        else:
-            # Если не нашли, берем любую неиспользованную
-            for point in points:
-                if point not in centers:
-                    centers.append(point)
-                    break
+        # Минимальное расстояние до существующих центров (точки-центры не выбираются)
+        candidates = np.where(is_center, -np.inf, min_dist)
+        if not np.isfinite(candidates).any():
+            continue
+        best = int(candidates.argmax())
+        center_indices.append(best)
+        is_center |= (coords == coords[best]).all(axis=1)
+        min_dist = np.minimum(min_dist, pairwise_distances(coords, coords[best:best + 1], dtype=np.float64)[:, 0])
     
-    # Если не набрали достаточно центров
-    while len(centers) < n_clusters:
-        centers.append(points[0])  # дублируем первую точку
+    # Если не набрали достаточно центров - дублируем первую точку
+    while len(center_indices) < n_clusters:
+        center_indices.append(0)
     
     # Назначаем точки ближайшим центрам
+    nearest, _ = nearest_indices(coords, coords[center_indices])
     clusters = [[] for _ in range(n_clusters)]
-    
-    for point in points:
-        # Находим ближайший центр
-        min_dist = float('inf')
-        nearest_idx = 0
-        
-        for i, center in enumerate(centers):
-            dist = WeeklyRouteOptimizer.calculate_distance(
-                point['Широта'], point['Долгота'],
-                center['Широта'], center['Долгота']
-            )
-            if dist < min_dist:
-                min_dist = dist
-                nearest_idx = i
-        
-        if 0 <= nearest_idx < n_clusters:
-            clusters[nearest_idx].append(point)
+    for point, cluster in zip(points, nearest):
+        clusters[cluster].append(point)
     
     return clusters
 
-def create_daily_routes_for_auditor(auditor_points, working_days, auditor_id):
+def create_daily_routes_for_auditor(auditor_points, working_days, auditor_id,
+                                    route_budget_ms=ROUTE_IMPROVE_BUDGET_MS, route_stats=None):
 
         # ДИАГНОСТИКА
     print(f"=== create_daily_routes_for_auditor ===")
@@ -900,6 +2861,8 @@ def create_daily_routes_for_auditor(auditor_points, working_days, auditor_id):
     """
     УНИВЕРСАЛЬНЫЙ АЛГОРИТМ ДЛЯ ГОРОДОВ-МИЛЛИОННИКОВ РОССИИ
     С ПРОСТЫМ ГЕОГРАФИЧЕСКИМ РАЙОНИРОВАНИЕМ
+    Порядок точек дня: жадный маршрут + 2-opt / Or-opt в пределах route_budget_ms на маршрут;
+    route_stats (dict) накапливает км до и после улучшения
     """
     try:
         if not auditor_points or not working_days:
@@ -968,6 +2931,13 @@ def create_daily_routes_for_auditor(auditor_points, working_days, auditor_id):
             if not day_points:
                 continue
             
+            # Порядок обхода: жадный маршрут, затем локальный поиск
+            day_points = WeeklyRouteOptimizer.improve_route(
+                WeeklyRouteOptimizer.greedy_route(day_points),
+                time_budget=route_budget_ms / 1000,
+                stats=route_stats
+            )
+            
             # Обработка даты
             visit_datetime = day_date
             if isinstance(day_date, date) and not isinstance(day_date, datetime):
@@ -1248,10 +3218,7 @@ def simple_balanced_kmeans(points: np.ndarray, point_ids: List[str],
     # Простой k-means
     for iteration in range(30):  # Максимум 30 итераций
         # Шаг 1: Назначение точек по ближайшему центру
-        assignments = np.zeros(n_points, dtype=int)
-        for i, point in enumerate(points):
-            distances = np.sqrt(np.sum((centers - point) ** 2, axis=1))
-            assignments[i] = np.argmin(distances)
+        assignments, _ = nearest_indices(points, centers, metric='planar')
         
         # Шаг 2: Балансировка
         assignments = simple_balance_assignments(assignments, weekly_targets, points, centers)
@@ -1363,18 +3330,16 @@ def attach_outliers_simple(outlier_points: np.ndarray, outlier_ids: List[str],
     if len(outlier_points) == 0:
         return week_assignments
     
+    # Ближайший кластер для всех выбросов сразу
+    weeks = list(week_clusters.keys())
+    nearest = np.full(len(outlier_points), -1)
+    if weeks:
+        centroids = np.array([week_clusters[week]['centroid'] for week in weeks])
+        nearest, _ = nearest_indices(outlier_points, centroids, metric='planar')
+    
     for i, point in enumerate(outlier_points):
         point_id = outlier_ids[i]
-        min_dist = float('inf')
-        best_week = -1
-        
-        # Находим ближайший кластер
-        for week, cluster_info in week_clusters.items():
-            centroid = np.array(cluster_info['centroid'])
-            dist = np.sqrt(np.sum((point - centroid) ** 2))
-            if dist < min_dist:
-                min_dist = dist
-                best_week = week
+        best_week = weeks[nearest[i]] if weeks else -1
         
         # Добавляем точку к ближайшему кластеру
         if best_week != -1:
@@ -1389,7 +3354,10 @@ def fallback_geographic_split(points_coords: List[List[float]],
                              point_ids: List[str], 
                              num_weeks: int, 
                              coefficients: List[float]) -> Tuple[Dict, Dict]:
-    """Фолбэк: простое географическое разбиение"""
+    """
+    Фолбэк: простое географическое разбиение - точки по широте, затем долготе,
+    размеры недель пропорциональны коэффициентам этапов (по кругу), сумма - все точки
+    """
     if not points_coords or not point_ids or num_weeks <= 0:
         return {}, {}
     
@@ -1408,12 +3376,12 @@ def fallback_geographic_split(points_coords: List[List[float]],
     week_assignments = {}
     week_clusters = {}
     
-    points_per_week = len(points_coords) // num_weeks
-    remainder = len(points_coords) % num_weeks
+    week_coefficients = [coefficients[week % len(coefficients)] if coefficients else 1.0 for week in range(num_weeks)]
+    week_sizes = apportion_by_weights(len(points_coords), week_coefficients)
     
     start_idx = 0
     for week in range(num_weeks):
-        week_size = points_per_week + (1 if week < remainder else 0)
+        week_size = int(week_sizes[week])
         end_idx = min(start_idx + week_size, len(points_coords))
         
         if start_idx < len(points_coords):
@@ -1436,14 +3404,444 @@ def fallback_geographic_split(points_coords: List[List[float]],
     
     return week_assignments, week_clusters
                                  
+
+def _choose_seed_cells(centers, counts, num_regions):
+    """
+    Выбирает стартовые ячейки регионов: самые удаленные друг от друга занятые ячейки
+    (farthest-point), упорядоченные по углу вокруг центра - соседние недели рядом.
+    """
+    occupied = np.flatnonzero(counts > 0)
+    if len(occupied) == 0:
+        occupied = np.arange(len(centers))
+    num_regions = min(num_regions, len(occupied))
+    
+    occupied_centers = centers[occupied]
+    centroid = np.average(occupied_centers, axis=0, weights=np.maximum(counts[occupied], 1))
+    
+    # Первая - самая дальняя от центра, далее - самая дальняя от уже выбранных
+    seeds = [int(np.argmax(np.sum((occupied_centers - centroid) ** 2, axis=1)))]
+    min_dist = np.sum((occupied_centers - occupied_centers[seeds[0]]) ** 2, axis=1)
+    for _ in range(1, num_regions):
+        next_seed = int(np.argmax(min_dist))
+        seeds.append(next_seed)
+        min_dist = np.minimum(min_dist, np.sum((occupied_centers - occupied_centers[next_seed]) ** 2, axis=1))
+    
+    seed_centers = occupied_centers[seeds]
+    angles = np.arctan2(seed_centers[:, 0] - centroid[0], seed_centers[:, 1] - centroid[1])
+    return occupied[np.array(seeds)[np.argsort(angles)]]
+
+
+def grow_balanced_regions(neighbor_offsets, neighbor_positions, counts, seeds, targets):
+    """
+    Многоисточниковый BFS по графу соседства ячеек (CSR).
+    На каждом шаге растет регион с наименьшей заполненностью (нагрузка / цель),
+    поэтому регионы получаются связными и сбалансированными по числу точек.
+    Каждая ячейка занимается один раз - время линейно по числу ячеек.
+    Возвращает массив номеров регионов для ячеек (-1 - недостижимые ячейки).
+    """
+    n_cells = len(counts)
+    region = [-1] * n_cells
+    loads = [0] * len(seeds)
+    frontiers = [deque([int(seed)]) for seed in seeds]
+    heap = [(0.0, r) for r in range(len(seeds))]
+    
+    # Списки Python быстрее поэлементной индексации массивов NumPy
+    offsets = np.asarray(neighbor_offsets).tolist()
+    positions = np.asarray(neighbor_positions).tolist()
+    cell_counts = np.asarray(counts).tolist()
+    scales = [1.0 / max(int(target), 1) for target in targets]
+    
+    while heap:
+        _, r = heapq.heappop(heap)
+        frontier = frontiers[r]
+        
+        # Берем первую еще не занятую ячейку из очереди региона
+        while frontier and region[frontier[0]] >= 0:
+            frontier.popleft()
+        if not frontier:
+            continue  # регион больше не может расти
+        
+        cell = frontier.popleft()
+        region[cell] = r
+        loads[r] += cell_counts[cell]
+        
+        for neighbor in positions[offsets[cell]:offsets[cell + 1]]:
+            if region[neighbor] < 0:
+                frontier.append(neighbor)
+        
+        heapq.heappush(heap, (loads[r] * scales[r], r))
+    
+    return np.array(region, dtype=np.int64)
+
+
+def _stays_connected_without(cell, region, neighbor_offsets, neighbor_positions, max_visits=64):
+    """
+    Локальная проверка связности: соседи ячейки из ее региона должны оставаться
+    достижимыми друг из друга в обход ячейки (ограниченный BFS, O(1) на проверку).
+    """
+    r = region[cell]
+    same = [int(n) for n in neighbor_positions[neighbor_offsets[cell]:neighbor_offsets[cell + 1]]
+            if region[n] == r]
+    if len(same) <= 1:
+        return True
+    
+    targets = set(same[1:])
+    visited = {cell, same[0]}
+    queue = deque([same[0]])
+    while queue and targets and len(visited) < max_visits:
+        current = queue.popleft()
+        for n in neighbor_positions[neighbor_offsets[current]:neighbor_offsets[current + 1]]:
+            n = int(n)
+            if n not in visited and region[n] == r:
+                visited.add(n)
+                targets.discard(n)
+                queue.append(n)
+    return not targets
+
+
+# Допустимое отклонение нагрузки недельной области от цели (точек)
+REGION_BALANCE_TOLERANCE = 3
+
+
+def _region_border_cells(region, neighbor_offsets, neighbor_positions):
+    """
+    Граничные ячейки регионов по CSR соседства (векторно):
+    массивы (ячейка, ее регион, регион соседа) без повторов, только для занятых регионами ячеек.
+    """
+    src = np.repeat(np.arange(len(region)), np.diff(neighbor_offsets))
+    dst = np.asarray(neighbor_positions, dtype=np.int64)
+    border = (region[src] >= 0) & (region[dst] >= 0) & (region[src] != region[dst])
+    triples = np.unique(np.column_stack([src[border], region[src[border]], region[dst[border]]]), axis=0)
+    return triples[:, 0], triples[:, 1], triples[:, 2]
+
+
+def rebalance_region_boundaries(region, neighbor_offsets, neighbor_positions, counts, targets,
+                                tolerance=REGION_BALANCE_TOLERANCE, max_rounds=20):
+    """
+    Балансировка обменом граничных ячеек между соседними регионами.
+    Ячейка с точками переходит в соседний регион, если это уменьшает перекос нагрузки.
+    Пустая ячейка переходит к соседу, у которого перекос меньше больше чем на tolerance:
+    так регион прокладывает себе путь через пустое пространство к перегруженному региону
+    (иначе регионы, разделенные пустотой, не обмениваются нагрузкой).
+    Регион-донор должен оставаться связным (локальная проверка в обход ячейки).
+    Ячейки обрабатываются очередью фронта: в начале раунда - граница (векторно),
+    дальше - только ячейки, рядом с которыми сменился регион. Раундов не больше max_rounds;
+    остаток перекоса (плотные ячейки, застрявшие границы) доводит balance_region_points.
+    """
+    n_regions = len(targets)
+    if n_regions == 0:
+        return region
+    targets = np.asarray(targets, dtype=np.int64)
+    claimed = region >= 0
+    excess = (np.bincount(region[claimed], weights=counts[claimed], minlength=n_regions).astype(np.int64)
+              - targets).tolist()
+    sizes = np.bincount(region[claimed], minlength=n_regions).tolist()
+    
+    # Списки Python быстрее поэлементной индексации массивов NumPy
+    offsets = np.asarray(neighbor_offsets).tolist()
+    positions = np.asarray(neighbor_positions).tolist()
+    cell_counts = counts.tolist()
+    cell_region = region.tolist()
+    queued = bytearray(len(cell_region))
+    
+    for _ in range(max_rounds):
+        if max(abs(value) for value in excess) <= tolerance:
+            break
+        
+        border_cells = np.unique(_region_border_cells(region, neighbor_offsets, neighbor_positions)[0]).tolist()
+        queue = deque(border_cells)
+        for cell in border_cells:
+            queued[cell] = 1
+        
+        moved = 0
+        while queue:
+            cell = queue.popleft()
+            queued[cell] = 0
+            donor = cell_region[cell]
+            if donor < 0 or sizes[donor] <= 1:
+                continue
+            neighbors = positions[offsets[cell]:offsets[cell + 1]]
+            
+            # Выбираем самый недогруженный соседний регион, которому выгодно отдать ячейку
+            required_gap = cell_counts[cell] if cell_counts[cell] > 0 else tolerance
+            best_receiver = -1
+            for receiver in {cell_region[n] for n in neighbors}:
+                if receiver < 0 or receiver == donor:
+                    continue
+                if excess[donor] - excess[receiver] > required_gap and (
+                        best_receiver < 0 or excess[receiver] < excess[best_receiver]):
+                    best_receiver = receiver
+            
+            if best_receiver < 0:
+                continue
+            if not _stays_connected_without(cell, cell_region, offsets, positions):
+                continue
+            
+            cell_region[cell] = best_receiver
+            region[cell] = best_receiver
+            excess[donor] -= cell_counts[cell]
+            excess[best_receiver] += cell_counts[cell]
+            sizes[donor] -= 1
+            sizes[best_receiver] += 1
+            moved += 1
+            
+            # Регион сменился - пересматриваем ячейку и ее занятых соседей
+            for n in [cell] + neighbors:
+                if cell_region[n] >= 0 and not queued[n]:
+                    queued[n] = 1
+                    queue.append(n)
+        
+        if moved == 0:
+            break
+    
+    return region
+
+
+def balance_region_points(point_region, region, neighbor_offsets, neighbor_positions,
+                          coords, targets, tolerance=REGION_BALANCE_TOLERANCE):
+    """
+    Доводка баланса по точкам после обмена ячейками: в плотных ячейках по
+    несколько точек, и ячейкой не выровнять нагрузку точнее ее заполненности.
+    Лишние точки передаются пачкой по цепочке соседних регионов (кратчайший путь в графе
+    соседства регионов) от перегруженного к недогруженному: каждый регион цепочки
+    отдает следующему k своих точек, ближайших к центру получателя (то есть с общей
+    границы), промежуточные регионы сохраняют нагрузку.
+    Кандидаты для каждой пары соседних регионов сортируются один раз,
+    дальше берутся по указателю - без просмотра всех точек на каждом шаге.
+    Повторяется, пока все регионы не окажутся в пределах tolerance от цели.
+    """
+    n_regions = len(targets)
+    targets = np.asarray(targets, dtype=np.int64)
+    assigned = point_region >= 0
+    region_sizes = np.bincount(point_region[assigned], minlength=n_regions)[:n_regions]
+    excess = region_sizes - targets
+    if n_regions == 0 or np.abs(excess).max() <= tolerance:
+        return point_region
+    
+    # Точки по регионам (CSR)
+    order = np.flatnonzero(assigned)
+    order = order[np.argsort(point_region[order], kind='stable')]
+    region_offsets = np.zeros(n_regions + 1, dtype=np.int64)
+    np.cumsum(region_sizes, out=region_offsets[1:])
+    
+    # Пары соседних регионов (донор, получатель) и кандидаты пары - все точки донора
+    _, donors, receivers = _region_border_cells(region, neighbor_offsets, neighbor_positions)
+    pairs = np.unique(donors * n_regions + receivers)
+    pair_donors = pairs // n_regions
+    pair_sizes = region_sizes[pair_donors]
+    entry = np.repeat(np.arange(len(pairs)), pair_sizes)
+    within = np.arange(len(entry)) - np.repeat(np.cumsum(pair_sizes) - pair_sizes, pair_sizes)
+    candidate_points = order[region_offsets[pair_donors][entry] + within]
+    pair_codes = pairs[entry]
+    
+    # Внутри пары - по удаленности от центра получателя
+    centers = np.zeros((n_regions, 2))
+    for axis in range(2):
+        sums = np.bincount(point_region[assigned], weights=coords[assigned, axis], minlength=n_regions)[:n_regions]
+        centers[:, axis] = sums / np.maximum(region_sizes, 1)
+    distance = np.sum((coords[candidate_points] - centers[pair_codes % n_regions]) ** 2, axis=1)
+    ordering = np.lexsort((distance, pair_codes))
+    candidate_points = candidate_points[ordering].tolist()
+    pair_codes = pair_codes[ordering]
+    
+    codes, starts, pair_counts = np.unique(pair_codes, return_index=True, return_counts=True)
+    pointer = {}
+    end = {}
+    neighbors = {r: [] for r in range(n_regions)}
+    for code, start, count in zip(codes.tolist(), starts.tolist(), pair_counts.tolist()):
+        donor, receiver = divmod(code, n_regions)
+        pointer[(donor, receiver)] = start
+        end[(donor, receiver)] = start + count
+        neighbors[donor].append(receiver)
+        neighbors[receiver].append(donor)
+    
+    def remaining(edge):
+        return end[edge] - pointer[edge] if edge in end else 0
+    
+    def take(edge, k):
+        """Передает до k точек по ребру (донор -> получатель); возвращает число переданных"""
+        donor, receiver = edge
+        moved = 0
+        while moved < k and pointer[edge] < end[edge]:
+            point = candidate_points[pointer[edge]]
+            pointer[edge] += 1
+            # Точка могла уйти по другому ребру (ячейка на границе нескольких регионов)
+            if point_region[point] == donor:
+                point_region[point] = receiver
+                moved += 1
+        return moved
+    
+    def find_path(start, is_goal, forward):
+        """BFS по графу регионов; forward - от донора к получателю, иначе в обратную сторону"""
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            if current != start and is_goal(current):
+                path = [current]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                return path[::-1] if forward else path
+            for nxt in neighbors[current]:
+                edge = (current, nxt) if forward else (nxt, current)
+                if nxt not in previous and remaining(edge) > 0:
+                    previous[nxt] = current
+                    queue.append(nxt)
+        return None
+    
+    blocked = set()
+    while True:
+        candidates = [r for r in np.argsort(-np.abs(excess), kind='stable').tolist()
+                      if abs(excess[r]) > tolerance and r not in blocked]
+        if not candidates:
+            break
+        r = candidates[0]
+        if excess[r] > 0:
+            path = find_path(r, lambda x: excess[x] < 0, forward=True)
+        else:
+            path = find_path(r, lambda x: excess[x] > 0, forward=False)
+        if path is None:
+            blocked.add(r)
+            continue
+        
+        # Пачка: сколько нужно крайним регионам и сколько есть на ребрах цепочки
+        edges = list(zip(path[:-1], path[1:]))
+        k = min(int(excess[path[0]]), int(-excess[path[-1]]), min(remaining(edge) for edge in edges))
+        for edge in edges:
+            k = take(edge, k)
+            excess[edge[0]] -= k
+            excess[edge[1]] += k
+        if k > 0:
+            blocked.clear()
+    
+    return point_region
+
+
+# Порог числа ячеек bbox, выше которого плоская сетка заменяется квадродеревом
+MAX_FLAT_GRID_CELLS = 2_000_000
+
+
+def build_partition_grid(polygon, coords, grid_size, num_weeks):
+    """
+    Сетка для разбиения: плоская PolygonGrid, если bbox полигона дает разумное
+    число ячеек, иначе адаптивное QuadtreeGrid по точкам (крупные ячейки на
+    пустых территориях, мелкие в плотных центрах).
+    """
+    min_lat, max_lat, min_lon, max_lon = polygon.bbox
+    bbox_cells = ((max_lat - min_lat) / grid_size + 1) * ((max_lon - min_lon) / grid_size + 1)
+    
+    if bbox_cells <= MAX_FLAT_GRID_CELLS:
+        return create_grid_inside_polygon(polygon, grid_size=grid_size)
+    
+    # Около 50 листьев на неделю, чтобы было из чего выравнивать границы
+    capacity = max(4, len(coords) // max(num_weeks * 50, 1))
+    try:
+        return QuadtreeGrid(coords, capacity=capacity)
+    except ValueError:
+        return None
+
+
+def grid_region_growing_split(polygon_coords, points_coords, point_ids, num_weeks,
+                              coefficients, grid_size=None, logger=None):
+    """
+    Разбиение полигона на недельные области ростом регионов по сетке:
+    1. Сетка внутри полигона (или квадродерево для больших территорий)
+       + распределение точек по ячейкам (CSR)
+    2. Многоисточниковый BFS по занятым ячейкам с балансировкой по числу точек
+    3. Обмен граничными ячейками для выравнивания нагрузки
+    Возвращает: (week_assignment, week_clusters) в формате split_polygon_by_weeks
+    """
+    if logger is None:
+        logger = print
+    
+    coords = np.asarray(points_coords, dtype=float).reshape(-1, 2)
+    point_ids = np.asarray(point_ids)
+    
+    # Если полигона нет - строим сетку по bounding box точек
+    polygon = prepare_polygon(polygon_coords)
+    if polygon is None:
+        min_lat, min_lon = coords.min(axis=0)
+        max_lat, max_lon = coords.max(axis=0)
+        polygon = prepare_polygon([[min_lat, min_lon], [min_lat, max_lon], [max_lat, max_lon], [max_lat, min_lon]])
+    
+    # Автоматический шаг: в среднем ~4 ячейки на точку
+    if grid_size is None:
+        min_lat, max_lat, min_lon, max_lon = polygon.bbox
+        grid_size = max(math.sqrt((max_lat - min_lat) * (max_lon - min_lon) / (4 * len(coords))), 1e-4)
+    
+    grid = build_partition_grid(polygon, coords, grid_size, num_weeks)
+    if grid is None:
+        logger("⚠️ Не удалось построить сетку, используется географическое разбиение")
+        return fallback_geographic_split(coords.tolist(), point_ids.tolist(), num_weeks, coefficients)
+    
+    assignment = assign_points_to_grid_cells(coords, point_ids, grid)
+    counts = np.diff(assignment['offsets'])
+    neighbor_offsets, neighbor_positions = grid.neighbor_csr()
+    
+    # Цели по неделям: коэффициенты этапов по кругу, остаток округления - по наибольшим долям
+    week_coefficients = [coefficients[week % len(coefficients)] if coefficients else 1.0 for week in range(num_weeks)]
+    targets = apportion_by_weights(len(coords), week_coefficients)
+    seeds = _choose_seed_cells(grid.cell_centers(), counts, num_weeks)
+    if len(seeds) < num_weeks:
+        # Точки в нескольких местах: регион на неделю не вырастить, делим по точкам
+        logger(f"⚠️ Занятых ячеек ({len(seeds)}) меньше, чем недель ({num_weeks}), "
+               f"используется географическое разбиение")
+        return fallback_geographic_split(coords.tolist(), point_ids.tolist(), num_weeks, coefficients)
+    
+    region = grow_balanced_regions(neighbor_offsets, neighbor_positions, counts, seeds, targets)
+    region = rebalance_region_boundaries(region, neighbor_offsets, neighbor_positions, counts, targets)
+    
+    # Регион каждой точки через CSR
+    point_region = np.full(len(coords), -1, dtype=np.int64)
+    point_region[assignment['point_index']] = np.repeat(region, counts)
+    
+    # Точки вне сетки и в недостижимых ячейках - к ближайшей ячейке с регионом
+    unassigned = np.flatnonzero(point_region < 0)
+    if len(unassigned) > 0:
+        claimed = np.flatnonzero(region >= 0)
+        centers = grid.cell_centers(grid.cell_ids[claimed])
+        for idx in unassigned.tolist():
+            nearest = np.argmin(np.sum((centers - coords[idx]) ** 2, axis=1))
+            point_region[idx] = region[claimed[nearest]]
+        logger(f"Точек вне сетки прикреплено к ближайшим областям: {len(unassigned)}")
+    
+    # Остаток перекоса (плотные ячейки) - переносом точек по цепочкам регионов
+    point_region = balance_region_points(point_region, region, neighbor_offsets,
+                                         neighbor_positions, coords, targets)
+    
+    week_assignment = {}
+    week_clusters = {}
+    for week in range(len(seeds)):
+        week_mask = point_region == week
+        if not week_mask.any():
+            continue
+        week_assignment[week] = point_ids[week_mask].tolist()
+        week_clusters[week] = {
+            'centroid': coords[week_mask].mean(axis=0).tolist(),
+            'size': int(week_mask.sum()),
+            'points_count': int(week_mask.sum()),
+            'cells': int(np.count_nonzero(region == week))
+        }
+    
+    grid_label = "Квадродерево" if isinstance(grid, QuadtreeGrid) else f"Сетка {grid.width}x{grid.height}"
+    logger(f"{grid_label}, ячеек: {grid.n_cells}, "
+           f"занято: {int(np.count_nonzero(counts))}, областей: {len(week_assignment)}")
+    
+    return week_assignment, week_clusters
+
+
 # ==============================================
 # ФУНКЦИЯ ДЛЯ РАЗБИЕНИЯ ПОЛИГОНА ПО НЕДЕЛЯМ
 # ==============================================
 
 def split_polygon_by_weeks(polygon_coords, points_coords, point_ids, num_weeks, 
-                          coefficients, polygon_name="", auditor_id="", logger=None):
+                          coefficients, polygon_name="", auditor_id="", logger=None,
+                          method='sequential', week_weights=None):
     """
     Разбивает полигон аудитора на N компактных областей по неделям
+    method: 'sequential' - по порядку точек, 'grid' - рост регионов по сетке
+    week_weights - вес каждой из num_weeks недель (коэффициент этапа × емкость недели,
+    см. auditor_week_weights); без них недели взвешиваются коэффициентами этапов по кругу
     Возвращает: (week_assignment, week_clusters)
     """
     
@@ -1486,17 +3884,36 @@ def split_polygon_by_weeks(polygon_coords, points_coords, point_ids, num_weeks,
                         }
             return week_assignment, week_clusters
         
-        # 2. Распределяем точки по неделям
+        # Веса недель длины num_weeks по кругу не повторяются - это и есть вес каждой недели
+        if week_weights is not None:
+            coefficients = [float(weight) for weight in week_weights]
+        
+        # 2. Рост связных областей по сетке ячеек полигона
+        if method == 'grid':
+            week_assignment, week_clusters = grid_region_growing_split(
+                polygon_coords, points_coords, point_ids, num_weeks, coefficients, logger=logger
+            )
+            for week in sorted(week_assignment.keys()):
+                logger(f"  Неделя {week}: {len(week_assignment[week])} точек")
+            return week_assignment, week_clusters
+        
+        # 3. Распределяем точки по неделям
         total_points = len(point_ids)
         points_per_week = total_points // num_weeks
         remainder = total_points % num_weeks
         
+        # С весами недель размеры пропорциональны весам, иначе - поровну
+        week_sizes = apportion_by_weights(total_points, week_weights) if week_weights is not None else None
+        
         logger(f"Точек в неделю: {points_per_week}, остаток: {remainder}")
         
         start_idx = 0
         for week in range(num_weeks):
             # Определяем размер недели
-            week_size = points_per_week + (1 if week < remainder else 0)
+            if week_sizes is not None:
+                week_size = int(week_sizes[week])
+            else:
+                week_size = points_per_week + (1 if week < remainder else 0)
             end_idx = start_idx + week_size
             
             if start_idx >= total_points:
@@ -1531,7 +3948,7 @@ def split_polygon_by_weeks(polygon_coords, points_coords, point_ids, num_weeks,
             
             start_idx = end_idx
         
-        # 3. Проверяем результат
+        # 4. Проверяем результат
         total_assigned = sum(len(ids) for ids in week_assignment.values())
         logger(f"✅ Разбиение завершено: {total_assigned} точек распределено по {len(week_assignment)} неделям")
         
@@ -1553,7 +3970,8 @@ def split_polygon_by_weeks(polygon_coords, points_coords, point_ids, num_weeks,
 # ==============================================
 
 def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df, 
-                                 year, quarter, use_enhanced_split=True):
+                                 year, quarter, use_enhanced_split=True, split_method='sequential',
+                                 availability=None):
 
     # ========== ДИАГНОСТИКА ==========
     st.info("=== ДИАГНОСТИКА НАЧАТА ===")
@@ -1570,7 +3988,9 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
 
                                      
     """
-    Создает ежедневные маршруты для аудиторов в формате EasyMerch
+    Создает ежедневные маршруты для аудиторов в формате EasyMerch.
+    availability (AuditorAvailability) - дни отсутствия исключаются из маршрутов,
+    недели без доступных дней не получают точек
     """
     
     if points_df is None or points_df.empty:
@@ -1587,6 +4007,8 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
             return pd.DataFrame()
         num_weeks = len(weeks_info)
         weeks_dict = {i: weeks_info[i] for i in range(num_weeks)}
+        if availability is None:
+            availability = build_auditor_availability(auditors_df, None, year, quarter)
     except Exception as e:
         st.error(f"❌ Ошибка получения недель: {str(e)}")
         return pd.DataFrame()
@@ -1605,6 +4027,10 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
             st.session_state.get('sidebar_stage4', 0.9)
         ]
         
+        # Бюджет локального поиска на маршрут дня и итог улучшения
+        route_budget_ms = st.session_state.get('sidebar_route_budget_ms', ROUTE_IMPROVE_BUDGET_MS)
+        route_stats = {}
+        
         # Для каждого аудитора
         for auditor in auditors_df['ID_Сотрудника'].unique():
             try:
@@ -1623,6 +4049,12 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                 if auditor_points_data.empty:
                     continue
                 
+                # Недели, в которые аудитор может работать
+                auditor_weeks = availability.available_weeks(auditor)
+                if not auditor_weeks:
+                    st.warning(f"⚠️ {auditor}: нет доступных дней в квартале, маршруты не строятся")
+                    continue
+                
                 # Находим полигон аудитора
                 polygon_info = None
                 polygon_name = None
@@ -1655,22 +4087,15 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                             if not week_info:
                                 continue
                             
-                            week_start = week_info['start_date']
-                            week_end = week_info['end_date']
-                            
-                            # Только рабочие дни (Пн-Пт)
-                            working_days_this_week = []
-                            current_date = week_start
-                            while current_date <= week_end:
-                                if current_date.weekday() < 5:  # 0=Пн, 4=Пт
-                                    working_days_this_week.append(current_date)
-                                current_date += timedelta(days=1)
+                            # Доступные дни аудитора на неделе (рабочие дни без отсутствий)
+                            working_days_this_week = availability.week_days(auditor, week_idx)
                             
                             if working_days_this_week:
                                 st.info(f"📅 Неделя {week_idx}: {len(working_days_this_week)} рабочих дней")
                                 
                                 weekly_visits = create_daily_routes_for_auditor(
-                                    week_points_list, working_days_this_week, auditor
+                                    week_points_list, working_days_this_week, auditor,
+                                    route_budget_ms=route_budget_ms, route_stats=route_stats
                                 )
                                 
                                 if weekly_visits:
@@ -1680,8 +4105,8 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                                     st.warning(f"⚠️ Не создано ни одного визита для недели {week_idx}")
                         continue
                 
-                # Подготавливаем данные для разбиения
-                polygon_coords = polygon_info['coordinates']
+                # Подготавливаем данные для разбиения (полигон берется из кэша подготовленных)
+                polygon_coords = prepare_polygon(polygon_info['coordinates'])
                 points_coords = []
                 point_ids_list = []
                 
@@ -1707,16 +4132,20 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                 def auditor_logger(msg):
                     log_messages.append(f"{current_auditor}: {msg}")
                 
-                # Разбиваем полигон по неделям
+                # Разбиваем полигон по неделям: веса недель те же, что у плана
+                # (коэффициент этапа × доступные дни × ставка)
+                week_weights = auditor_week_weights(availability, auditor, weeks_info, coefficients)[auditor_weeks]
                 week_assignment, week_clusters = split_polygon_by_weeks(
                     polygon_coords=polygon_coords,
                     points_coords=points_coords,
                     point_ids=point_ids_list,
-                    num_weeks=num_weeks,
+                    num_weeks=len(auditor_weeks),
                     coefficients=coefficients,
                     polygon_name=polygon_name,
                     auditor_id=auditor,
-                    logger=auditor_logger
+                    logger=auditor_logger,
+                    method=split_method,
+                    week_weights=week_weights
                 )
                 
                 # Показываем логи
@@ -1731,11 +4160,12 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                     if not week_point_ids:
                         continue
                     
-                    # Преобразуем week_key в индекс (0-based)
+                    # Преобразуем week_key (номер среди доступных недель) в индекс недели квартала
                     try:
-                        week_idx = int(week_key)
-                        if week_idx >= num_weeks:
+                        week_slot = int(week_key)
+                        if week_slot >= len(auditor_weeks):
                             continue
+                        week_idx = auditor_weeks[week_slot]
                     except (ValueError, TypeError):
                         continue
                     
@@ -1766,22 +4196,15 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
                     if not week_info:
                         continue
                     
-                    week_start = week_info['start_date']
-                    week_end = week_info['end_date']
-                    
-                    # Только рабочие дни (Пн-Пт)
-                    working_days_this_week = []
-                    current_date = week_start
-                    while current_date <= week_end:
-                        if current_date.weekday() < 5:  # 0=Пн, 4=Пт
-                            working_days_this_week.append(current_date)
-                        current_date += timedelta(days=1)
+                    # Доступные дни аудитора на неделе (рабочие дни без отсутствий)
+                    working_days_this_week = availability.week_days(auditor, week_idx)
                     
                     if working_days_this_week:
                         st.info(f"📅 Неделя {week_idx}: {len(working_days_this_week)} рабочих дней")
                         
                         weekly_visits = create_daily_routes_for_auditor(
-                            week_points_list, working_days_this_week, auditor
+                            week_points_list, working_days_this_week, auditor,
+                            route_budget_ms=route_budget_ms, route_stats=route_stats
                         )
                         
                         if weekly_visits:
@@ -1793,6 +4216,16 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
             except Exception as e:
                 st.error(f"❌ {auditor}: ошибка: {str(e)[:100]}")
             continue
+        
+        if route_stats.get('routes'):
+            km_before, km_after = route_stats['km_before'], route_stats['km_after']
+            saved = (1 - km_after / km_before) * 100 if km_before > 0 else 0.0
+            st.info(
+                f"🛣️ Улучшение маршрутов (2-opt / Or-opt): {route_stats['routes']} маршрутов, "
+                f"{km_before:.1f} км → {km_after:.1f} км (−{saved:.1f}%), "
+                f"{route_stats['seconds']:.1f} с; бюджет исчерпан в {route_stats['timed_out']}"
+            )
+            st.session_state.route_improvement = route_stats
     
     
     
@@ -1815,7 +4248,7 @@ def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df,
     final_rows = []
     
     # Группируем по точкам и неделям
-    grouped = results_df.groupby(['ID_Точки', 'Неделя', 'Аудитор'])
+    grouped = results_df.groupby(['ID_Точки', 'Неделя', 'Аудитор'], observed=True)
     
     for (point_id, week_num, auditor), group in grouped:
         point_mask = points_df['ID_Точки'] == point_id
@@ -2114,8 +4547,192 @@ def create_simple_polygon(points):
 
         return polygon
 
-def generate_polygons(polygons_info):
-    """Генерирует полигоны на основе информации о точках"""
+def _close_ring(coords):
+    """Замыкает контур: первая вершина повторяется в конце"""
+    ring = np.asarray(coords, dtype=float).tolist()
+    if ring and ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return ring
+
+def _monotone_chain(coords):
+    """Выпуклая оболочка (Andrew's monotone chain) для уже отсортированных точек, против часовой"""
+    def build(ordered):
+        chain = []
+        for p in ordered:
+            while len(chain) >= 2:
+                (ax, ay), (bx, by) = chain[-2], chain[-1]
+                if (bx - ax) * (p[1] - ay) - (by - ay) * (p[0] - ax) > 0:
+                    break
+                chain.pop()
+            chain.append(p)
+        return chain
+    
+    ordered = coords.tolist()
+    lower = build(ordered)
+    upper = build(ordered[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+def convex_hull_numpy(coords):
+    """
+    Выпуклая оболочка на NumPy: фильтр Акла-Туссена (точки строго внутри
+    восьмиугольника крайних точек отбрасываются векторно), затем monotone chain
+    по оставшимся точкам. Возвращает вершины (k, 2) против часовой стрелки.
+    """
+    coords = np.unique(np.asarray(coords, dtype=float).reshape(-1, 2), axis=0)  # unique сортирует по x, затем y
+    if len(coords) < 3:
+        return coords
+    
+    # Крайние точки по 4 направлениям и их диагоналям
+    x, y = coords[:, 0], coords[:, 1]
+    extremes = np.unique(np.concatenate([
+        [x.argmin(), x.argmax(), y.argmin(), y.argmax()],
+        [(x + y).argmin(), (x + y).argmax(), (x - y).argmin(), (x - y).argmax()]
+    ]))
+    octagon = _monotone_chain(coords[extremes])
+    
+    if len(octagon) >= 3:
+        a = octagon
+        b = np.roll(octagon, -1, axis=0)
+        # Векторное произведение для всех пар (ребро, точка): > 0 - точка слева от ребра
+        cross = ((b[:, 0] - a[:, 0])[None, :] * (y[:, None] - a[:, 1][None, :])
+                 - (b[:, 1] - a[:, 1])[None, :] * (x[:, None] - a[:, 0][None, :]))
+        coords = coords[~(cross > 0).all(axis=1)]
+    
+    return _monotone_chain(coords)
+
+def convex_hull(coords):
+    """Выпуклая оболочка: SciPy (Qhull), если доступен, иначе NumPy"""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if SCIPY_AVAILABLE and len(coords) >= 3:
+        try:
+            hull = ConvexHull(coords)
+            return coords[hull.vertices]  # в 2D вершины уже против часовой
+        except Exception:
+            pass  # вырожденный набор (все точки на прямой) - считаем сами
+    return convex_hull_numpy(coords)
+
+def concave_hull(coords, concavity=3.0):
+    """
+    Вогнутая оболочка (chi-shape) по триангуляции Делоне (SciPy).
+    С внешней границы по одному снимаются треугольники с самым длинным граничным
+    ребром, пока оно длиннее concavity x медианы длин ребер. Треугольник не
+    снимается, если его третья вершина уже на границе - так контур остается
+    одним простым кольцом и ни одна точка не выпадает.
+    Без SciPy возвращается выпуклая оболочка.
+    """
+    coords = np.unique(np.asarray(coords, dtype=float).reshape(-1, 2), axis=0)
+    if not SCIPY_AVAILABLE or len(coords) < 4:
+        return convex_hull(coords)
+    
+    try:
+        tri = Delaunay(coords)
+    except Exception:
+        return convex_hull(coords)
+    
+    triangles = tri.simplices.copy()
+    neighbors = tri.neighbors.copy()  # neighbors[t, j] - треугольник напротив вершины j
+    
+    # Ориентируем треугольники против часовой - тогда граница обходится в одну сторону
+    corners = coords[triangles]
+    signed = ((corners[:, 1, 0] - corners[:, 0, 0]) * (corners[:, 2, 1] - corners[:, 0, 1])
+              - (corners[:, 2, 0] - corners[:, 0, 0]) * (corners[:, 1, 1] - corners[:, 0, 1]))
+    flip = signed < 0
+    triangles[flip] = triangles[flip][:, ::-1]
+    neighbors[flip] = neighbors[flip][:, ::-1]
+    
+    # Ребро напротив вершины j: (j+1, j+2); длины (t, 3)
+    corners = coords[triangles]
+    edge_len = np.linalg.norm(np.roll(corners, -1, axis=1) - np.roll(corners, -2, axis=1), axis=2)
+    threshold = concavity * np.median(edge_len)
+    
+    alive = np.ones(len(triangles), dtype=bool)
+    on_boundary = np.zeros(len(coords), dtype=bool)
+    on_boundary[np.unique(tri.convex_hull)] = True
+    
+    heap = [(-edge_len[t, j], t, j) for t, j in zip(*np.nonzero(neighbors < 0))]
+    heapq.heapify(heap)
+    
+    while heap:
+        neg_len, t, j = heapq.heappop(heap)
+        if -neg_len <= threshold:
+            break
+        apex = triangles[t, j]
+        if not alive[t] or on_boundary[apex]:
+            continue
+        
+        alive[t] = False
+        on_boundary[apex] = True
+        # Два других ребра становятся граничными для соседних треугольников
+        for k in ((j + 1) % 3, (j + 2) % 3):
+            other = neighbors[t, k]
+            if other >= 0 and alive[other]:
+                m = int(np.flatnonzero(neighbors[other] == t)[0])
+                neighbors[other, m] = -1
+                heapq.heappush(heap, (-edge_len[other, m], other, m))
+    
+    # Граничные ребра оставшихся треугольников в порядке обхода
+    t_idx, j_idx = np.nonzero((neighbors < 0) & alive[:, None])
+    starts = triangles[t_idx, (j_idx + 1) % 3]
+    ends = triangles[t_idx, (j_idx + 2) % 3]
+    next_vertex = dict(zip(starts.tolist(), ends.tolist()))
+    
+    ring = [int(starts[0])]
+    current = next_vertex[ring[0]]
+    while current != ring[0] and len(ring) <= len(next_vertex):
+        ring.append(current)
+        current = next_vertex[current]
+    
+    if len(ring) != len(next_vertex):
+        return convex_hull(coords)
+    
+    return coords[ring]
+
+def polygon_info_coords(points):
+    """Координаты [lat, lon] из списка точек полигона формата [ID, широта, долгота, ...]"""
+    points = np.asarray(points, dtype=object)
+    if points.ndim != 2 or points.shape[1] < 3 or len(points) == 0:
+        return np.empty((0, 2))
+    
+    coords = np.column_stack([
+        pd.to_numeric(pd.Series(points[:, 1]), errors='coerce').to_numpy(dtype=float),
+        pd.to_numeric(pd.Series(points[:, 2]), errors='coerce').to_numpy(dtype=float)
+    ])
+    return coords[np.isfinite(coords).all(axis=1)]
+
+def build_territory_polygon(points, method='convex', concavity=3.0):
+    """
+    Строит контур территории по точкам [ID, широта, долгота].
+    method: 'convex' - выпуклая оболочка, 'concave' - вогнутая оболочка,
+    'rectangle' - прямоугольник (create_simple_polygon).
+    Возвращает замкнутый список [[lat, lon], ...] в формате create_simple_polygon.
+    """
+    if method == 'rectangle':
+        return create_simple_polygon(points)
+    
+    coords = polygon_info_coords(points)
+    unique_coords = np.unique(coords, axis=0)
+    
+    if len(unique_coords) <= 1:
+        return []
+    if len(unique_coords) == 2:
+        return _close_ring(unique_coords)
+    
+    if method == 'concave':
+        hull = concave_hull(unique_coords, concavity=concavity)
+    else:
+        hull = convex_hull(unique_coords)
+    
+    # Все точки на одной прямой - контур из двух крайних точек
+    if len(hull) < 3:
+        hull = unique_coords[[0, -1]]
+    
+    return _close_ring(hull)
+
+def generate_polygons(polygons_info, method='convex'):
+    """
+    Генерирует полигоны на основе информации о точках
+    method: 'convex', 'concave' или 'rectangle' (см. build_territory_polygon)
+    """
     polygons = {}
     
     if not polygons_info or not isinstance(polygons_info, dict):
@@ -2148,7 +4765,7 @@ def generate_polygons(polygons_info):
                 }
                 continue
             
-            polygon_coords = create_simple_polygon(points)
+            polygon_coords = build_territory_polygon(points, method=method)
             
             polygons[polygon_name] = {
                 'auditor': info['auditor'],
@@ -2169,8 +4786,40 @@ def generate_polygons(polygons_info):
 # ФУНКЦИИ ДЛЯ РАСПРЕДЕЛЕНИЯ ПО НЕДЕЛЯМ
 # ==============================================
 
-def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, coefficients):
-    """Распределяет посещения по неделям на основе личных планов аудиторов"""
+def apportion_by_weights(total, weights):
+    """Делит целое total пропорционально весам (метод наибольших остатков); сумма частей равна total"""
+    weights = np.asarray(weights, dtype=float)
+    if total <= 0 or weights.sum() <= 0:
+        return np.zeros(len(weights), dtype=int)
+    shares = total * weights / weights.sum()
+    counts = np.floor(shares).astype(int)
+    remainder = int(total - counts.sum())
+    if remainder:
+        counts[np.argsort(-(shares - counts), kind='stable')[:remainder]] += 1
+    return counts
+
+def auditor_week_weights(availability, auditor, weeks_info, coefficients):
+    """
+    Веса недель квартала для нагрузки аудитора: коэффициент этапа (по ISO-номеру недели),
+    а при отсутствиях, неполной ставке или неделях без рабочих дней - коэффициент × емкость недели
+    (доступные дни × ставка, AuditorAvailability.week_capacities).
+    Одни и те же веса делят и план посещений, и точки маршрутов по неделям.
+    """
+    weights = np.array([coefficients[((week_info['iso_week_number'] - 1) % 4) % len(coefficients)]
+                        for week_info in weeks_info], dtype=float)
+    if availability is not None:
+        capacities = availability.week_capacities(auditor)
+        if availability.is_constrained(auditor) or (capacities <= 0).any():
+            weights = weights * capacities
+    return weights
+
+def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, coefficients, availability=None):
+    """
+    Распределяет посещения по неделям на основе личных планов аудиторов.
+    С availability (AuditorAvailability) план аудитора с отсутствиями, неполной ставкой
+    или неделями без рабочих дней делится пропорционально коэффициенту этапа × емкости недели:
+    недели без емкости не получают посещений.
+    """
     try:
         # 1. Получаем недели в квартале
         weeks_info = get_weeks_in_quarter(year, quarter)
@@ -2186,11 +4835,13 @@ def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, c
         )
         
         # 3. Рассчитываем личный план каждого аудитора
-        auditor_plans = merged_df.groupby(['Город', 'Аудитор', 'Полигон'])['Кол-во_посещений'].sum().reset_index()
+        auditor_plans = merged_df.groupby(['Город', 'Аудитор', 'Полигон'], observed=True)['Кол-во_посещений'].sum().reset_index()
         auditor_plans = auditor_plans.rename(columns={'Кол-во_посещений': 'Личный_план'})
         
         # 4. Распределяем каждый личный план по неделям
         weekly_plan = []
+        unavailable_auditors = []
+        undistributed = 0
         
         for _, auditor_row in auditor_plans.iterrows():
             city = auditor_row['Город']
@@ -2204,6 +4855,27 @@ def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, c
             # 5. Распределяем личный план аудитора по неделям с учетом коэффициентов
             weeks_in_quarter = len(weeks_info)
             
+            capacities = availability.week_capacities(auditor) if availability is not None else None
+            if capacities is not None and (availability.is_constrained(auditor) or (capacities <= 0).any()):
+                weekly_counts = apportion_by_weights(
+                    personal_plan, auditor_week_weights(availability, auditor, weeks_info, coefficients)
+                )
+                if weekly_counts.sum() == 0:
+                    unavailable_auditors.append(str(auditor))
+                    undistributed += personal_plan
+                for week_info, weekly_visits in zip(weeks_info, weekly_counts):
+                    if weekly_visits > 0:
+                        weekly_plan.append({
+                            'Город': city,
+                            'Полигон': polygon,
+                            'Аудитор': auditor,
+                            'ISO_Неделя': week_info['iso_week_number'],
+                            'Дата_начала': week_info['start_date'],
+                            'Дата_окончания': week_info['end_date'],
+                            'План_посещений': int(weekly_visits)
+                        })
+                continue
+            
             # Базовая нагрузка по неделям (равномерно)
             base_per_week = max(1, personal_plan // weeks_in_quarter)
             
@@ -2229,17 +4901,20 @@ def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, c
                         'План_посещений': weekly_visits
                     })
         
+        if unavailable_auditors:
+            st.warning(f"⚠️ Нет доступных дней в квартале, план не распределен: {', '.join(unavailable_auditors)}")
+        
         # 6. Создаем DataFrame и корректируем округления
-        result_df = pd.DataFrame(weekly_plan)
+        result_df = compact_frame(pd.DataFrame(weekly_plan))
         
         if not result_df.empty:
+            # Целевые личные планы по (город, аудитор) - один groupby вместо фильтра на каждого
+            target_plans = auditor_plans.groupby(['Город', 'Аудитор'], observed=True)['Личный_план'].sum()
+            
             # Группируем по аудиторам и перераспределяем остаток
-            for (city, auditor), group in result_df.groupby(['Город', 'Аудитор']):
+            for (city, auditor), group in result_df.groupby(['Город', 'Аудитор'], observed=True):
                 # Находим целевой личный план
-                target_plan = auditor_plans[
-                    (auditor_plans['Город'] == city) & 
-                    (auditor_plans['Аудитор'] == auditor)
-                ]['Личный_план'].sum()
+                target_plan = target_plans.get((city, auditor), 0)
                 
                 # Находим текущую сумму в распределении
                 current_sum = group['План_посещений'].sum()
@@ -2249,16 +4924,13 @@ def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, c
                 
                 if difference != 0:
                     # Добавляем/убираем разницу у первой недели этого аудитора
-                    first_week_idx = result_df[
-                        (result_df['Город'] == city) & 
-                        (result_df['Аудитор'] == auditor)
-                    ].index[0]
+                    first_week_idx = group.index[0]
                     
                     new_value = result_df.at[first_week_idx, 'План_посещений'] + difference
                     result_df.at[first_week_idx, 'План_посещений'] = max(0, new_value)
         
-        # 7. Проверяем итоговую сумму
-        total_expected = points_df['Кол-во_посещений'].sum()
+        # 7. Проверяем итоговую сумму (без плана аудиторов, у которых нет доступных дней)
+        total_expected = points_df['Кол-во_посещений'].sum() - undistributed
         total_distributed = result_df['План_посещений'].sum()
         
         if total_expected != total_distributed:
@@ -2474,13 +5146,12 @@ def distribute_points_to_auditors(points_df, auditors_df):
             
             polygon_name = direction
             
-            for _, point in point_group.iterrows():
-                results.append({
-                    'ID_Точки': point['ID_Точки'],
-                    'Аудитор': auditor,
-                    'Город': city,
-                    'Полигон': polygon_name
-                })
+            results.append(pd.DataFrame({
+                'ID_Точки': point_group['ID_Точки'].to_numpy(),
+                'Аудитор': auditor,
+                'Город': city,
+                'Полигон': polygon_name
+            }))
             
             polygons_info[polygon_name] = {
                 'auditor': auditor,
@@ -2492,88 +5163,381 @@ def distribute_points_to_auditors(points_df, auditors_df):
         st.warning("⚠️ Не удалось распределить точки по аудиторам")
         return None, None
     
-    return pd.DataFrame(results), polygons_info
+    # ID точек - в общем справочнике points_df, строки - category
+    assignment_df = pd.concat(results, ignore_index=True)
+    id_dtype = points_df['ID_Точки'].dtype
+    compact_frame(assignment_df, id_dtype if isinstance(id_dtype, pd.CategoricalDtype) else None)
+    
+    return assignment_df, polygons_info
 
 # ==============================================
-# ФУНКЦИИ ДЛЯ ОБРАБОТКИ ФАКТИЧЕСКИХ ПОСЕЩЕНИЙ И СТАТИСТИКИ
+# ДЕЛЬТА-РЕЖИМ: ПЕРЕСЧЕТ ТОЛЬКО ИЗМЕНИВШИХСЯ ГОРОДОВ
 # ==============================================
 
-def process_actual_visits(visits_df, points_df, year, quarter):
-    """Обрабатывает фактические посещения за квартал"""
+def _changed_values(old_values, new_values):
+    """Маска различий двух выровненных колонок (NaN == NaN)"""
+    old_values = old_values.astype(object)
+    new_values = new_values.astype(object)
+    both_missing = old_values.isna().to_numpy() & new_values.isna().to_numpy()
+    return (old_values.to_numpy() != new_values.to_numpy()) & ~both_missing
+
+def diff_plan_inputs(old_points, new_points, old_auditors, new_auditors):
+    """
+    Сравнивает вкладки Точки/Аудиторы с входом предыдущего расчета.
+    Возвращает dict:
+    - added / removed / moved / changed - ID новых, удаленных, перемещенных точек
+      и точек с измененными полями (тип, план, название, адрес, город)
+    - auditor_cities - города, где изменился состав или порядок аудиторов
+    - cities - все затронутые города (пересчитываются целиком)
+    """
+    old = old_points.assign(ID_Точки=old_points['ID_Точки'].astype(object))
+    new = new_points.assign(ID_Точки=new_points['ID_Точки'].astype(object))
+    old_city = old.drop_duplicates('ID_Точки').set_index('ID_Точки')['Город'].astype(object)
+    new_city = new.drop_duplicates('ID_Точки').set_index('ID_Точки')['Город'].astype(object)
+    
+    added = new_city.index.difference(old_city.index)
+    removed = old_city.index.difference(new_city.index)
+    common = new_city.index.intersection(old_city.index)
+    
+    cities = set(new_city.loc[added]) | set(old_city.loc[removed])
+    
+    # Повторяющиеся ID - города пересчитываются целиком
+    cities |= set(old.loc[old['ID_Точки'].duplicated(keep=False), 'Город'].astype(object))
+    cities |= set(new.loc[new['ID_Точки'].duplicated(keep=False), 'Город'].astype(object))
+    
+    moved, changed = pd.Index([]), pd.Index([])
+    if set(old.columns) != set(new.columns):
+        # Набор колонок изменился - сравнивать поля нечего, пересчитываются все города
+        changed = common
+    elif len(common) > 0:
+        old_common = old.drop_duplicates('ID_Точки').set_index('ID_Точки').loc[common]
+        new_common = new.drop_duplicates('ID_Точки').set_index('ID_Точки').loc[common]
+        
+        moved_mask = np.zeros(len(common), dtype=bool)
+        for col in ['Широта', 'Долгота']:
+            moved_mask |= _changed_values(old_common[col], new_common[col])
+        changed_mask = np.zeros(len(common), dtype=bool)
+        for col in old_common.columns.difference(['Широта', 'Долгота']):
+            changed_mask |= _changed_values(old_common[col], new_common[col])
+        
+        moved = common[moved_mask]
+        changed = common[changed_mask & ~moved_mask]
+    
+    # Перемещенная или измененная точка затрагивает и старый, и новый город
+    touched = moved.append(changed)
+    cities |= set(old_city.loc[touched]) | set(new_city.loc[touched])
+    
+    # Аудиторы: порядок в городе определяет, кому достается какое направление
+    def auditors_by_city(auditors_df):
+        logins = auditors_df['ID_Сотрудника'].astype(object)
+        return logins.groupby(auditors_df['Город'].astype(object), sort=False).agg(list).to_dict()
+    
+    old_by_city = auditors_by_city(old_auditors)
+    new_by_city = auditors_by_city(new_auditors)
+    auditor_cities = {city for city in set(old_by_city) | set(new_by_city)
+                      if old_by_city.get(city) != new_by_city.get(city)}
+    cities |= auditor_cities
+    
+    return {
+        'added': added.tolist(),
+        'removed': removed.tolist(),
+        'moved': moved.tolist(),
+        'changed': changed.tolist(),
+        'auditor_cities': auditor_cities,
+        'cities': {city for city in cities if pd.notna(city)}
+    }
+
+def splice_frames(old_df, new_df, column, keys):
+    """Строки old_df, у которых column входит в keys, заменяются строками new_df"""
+    parts = []
+    if old_df is not None and not old_df.empty:
+        parts.append(old_df[~old_df[column].astype(object).isin(keys)])
+    if new_df is not None and not new_df.empty:
+        parts.append(new_df)
+    
+    if not parts:
+        return pd.DataFrame(columns=old_df.columns) if old_df is not None else pd.DataFrame()
+    
+    return pd.concat(parts, ignore_index=True)
+
+def splice_city_dict(old_items, new_items, cities):
+    """Полигоны (dict по имени): записи затронутых городов заменяются новыми"""
+    spliced = {name: info for name, info in (old_items or {}).items()
+               if info.get('city') not in cities}
+    spliced.update(new_items or {})
+    return spliced
+
+def recompute_plan_delta(last_run, delta, points_df, auditors_df, year, quarter, coefficients,
+                         polygon_method='convex', use_enhanced_split=False, split_method='sequential',
+                         availability=None):
+    """
+    Пересчитывает распределение, полигоны, недельный план и маршруты только для
+    затронутых городов и вклеивает их в результаты предыдущего расчета.
+    Возвращает dict: points_assignment_df, polygons_info, polygons, detailed_plan_df, routes_df
+    """
+    cities = delta['cities']
+    city_points = points_df[points_df['Город'].astype(object).isin(cities)]
+    city_auditors = auditors_df[auditors_df['Город'].astype(object).isin(cities)]
     
-    if visits_df.empty:
-        return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
+    assignment_part, info_part = None, None
+    if not city_points.empty and not city_auditors.empty:
+        assignment_part, info_part = distribute_points_to_auditors(city_points, city_auditors)
+    
+    polygons_info = splice_city_dict(last_run['polygons_info'], info_part, cities)
+    polygons = splice_city_dict(last_run['polygons'], generate_polygons(info_part, method=polygon_method), cities)
+    
+    id_dtype = points_df['ID_Точки'].dtype
+    id_dtype = id_dtype if isinstance(id_dtype, pd.CategoricalDtype) else None
+    points_assignment_df = compact_frame(
+        splice_frames(last_run['points_assignment_df'], assignment_part, 'Город', cities), id_dtype
+    )
+    
+    plan_part = None
+    if assignment_part is not None:
+        plan_part = distribute_visits_by_weeks(assignment_part, city_points, year, quarter, coefficients,
+                                               availability=availability)
+    detailed_plan_df = compact_frame(splice_frames(last_run['detailed_plan_df'], plan_part, 'Город', cities))
+    
+    # Маршруты пересчитываются для всех аудиторов затронутых городов (прежних и новых);
+    # create_weekly_route_schedule берет полигоны из session_state
+    st.session_state.polygons = polygons
+    old_auditors = last_run['auditors_df']
+    stale_auditors = set(old_auditors.loc[old_auditors['Город'].astype(object).isin(cities), 'ID_Сотрудника'].astype(object))
+    stale_auditors |= set(city_auditors['ID_Сотрудника'].astype(object))
+    
+    routes_part = None
+    if assignment_part is not None:
+        routes_part = create_weekly_route_schedule(
+            city_points, assignment_part, city_auditors, year, quarter,
+            use_enhanced_split=use_enhanced_split, split_method=split_method,
+            availability=availability
+        )
+    routes_df = splice_frames(last_run.get('routes_df'), routes_part, 'Login пользователя', stale_auditors)
+    
+    return {
+        'points_assignment_df': points_assignment_df,
+        'polygons_info': polygons_info,
+        'polygons': polygons,
+        'detailed_plan_df': detailed_plan_df,
+        'routes_df': routes_df
+    }
+
+# ==============================================
+# ХРАНИЛИЩЕ ФАКТИЧЕСКИХ ПОСЕЩЕНИЙ
+# ==============================================
+
+VISIT_STORE_FILE = 'visits.sqlite'
+
+class VisitFactStore:
+    """
+    Хранилище фактических посещений в SQLite (только добавление).
+    Ключ (точка, дата, сотрудник) отсекает повторную загрузку тех же визитов,
+    индекс (год, квартал, ISO-неделя) - партиции: запрос квартала читает только его строки.
+    ID точек и сотрудников хранятся без приведения типа (колонки без affinity).
+    """
     
-    # Получаем даты квартала
-    quarter_start, quarter_end = get_quarter_dates(year, quarter)
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS visits (
+                    point_id,
+                    visit_date TEXT NOT NULL,
+                    employee_id,
+                    year INTEGER NOT NULL,
+                    quarter INTEGER NOT NULL,
+                    iso_week INTEGER NOT NULL,
+                    PRIMARY KEY (point_id, visit_date, employee_id)
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS visits_partition ON visits (year, quarter, iso_week)"
+            )
+    
+    def append(self, visits_df):
+        """Добавляет пачку визитов; возвращает (добавлено, пропущено дубликатов)"""
+        if visits_df is None or visits_df.empty:
+            return 0, 0
+        
+        dates = pd.to_datetime(visits_df['Дата_визита'], errors='coerce')
+        valid = dates.notna().to_numpy()
+        dates = dates[valid]
+        rows = list(zip(
+            visits_df['ID_Точки'].astype(object)[valid].tolist(),
+            dates.dt.strftime('%Y-%m-%d').tolist(),
+            visits_df['ID_Сотрудника'].astype(object)[valid].tolist(),
+            dates.dt.year.tolist(),
+            dates.dt.quarter.tolist(),
+            dates.dt.isocalendar().week.astype(int).tolist()
+        ))
+        
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO visits VALUES (?, ?, ?, ?, ?, ?)", rows)
+            inserted = self._conn.total_changes - before
+        
+        return inserted, len(rows) - inserted
+    
+    def query(self, year, quarter, weeks=None):
+        """Визиты квартала (и, если заданы, только указанных ISO-недель)"""
+        sql = ("SELECT point_id, visit_date, employee_id, iso_week FROM visits "
+               "WHERE year = ? AND quarter = ?")
+        params = [int(year), int(quarter)]
+        if weeks:
+            weeks = [int(week) for week in weeks]
+            sql += f" AND iso_week IN ({', '.join('?' * len(weeks))})"
+            params += weeks
+        
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        
+        result = pd.DataFrame(rows, columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
+        result['Дата_визита'] = pd.to_datetime(result['Дата_визита'], format='%Y-%m-%d')
+        result['ISO_Неделя'] = result['ISO_Неделя'].astype(int)
+        return result
+    
+    def stats(self):
+        """Всего визитов, диапазон дат и число визитов по кварталам"""
+        with self._lock:
+            total, first, last = self._conn.execute(
+                "SELECT COUNT(*), MIN(visit_date), MAX(visit_date) FROM visits"
+            ).fetchone()
+            quarters = self._conn.execute(
+                "SELECT year, quarter, COUNT(*) FROM visits GROUP BY year, quarter ORDER BY year, quarter"
+            ).fetchall()
+        return {
+            'total': total,
+            'first_date': first,
+            'last_date': last,
+            'quarters': {f"{year} Q{quarter}": count for year, quarter, count in quarters}
+        }
     
-    # Преобразуем даты для сравнения
-    # ИСПРАВЛЕНИЕ: используем уже импортированный datetime
-    quarter_start_dt = pd.Timestamp(datetime.combine(quarter_start, datetime.min.time()))
-    quarter_end_dt = pd.Timestamp(datetime.combine(quarter_end, datetime.max.time()))
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM visits")
+
+@st.cache_resource
+def get_visit_store():
+    """Одно хранилище фактов на процесс (общее для всех сессий)"""
+    return VisitFactStore(os.path.join(VISIT_PLAN_DATA_DIR, VISIT_STORE_FILE))
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ ОБРАБОТКИ ФАКТИЧЕСКИХ ПОСЕЩЕНИЙ И СТАТИСТИКИ
+# ==============================================
+
+def process_actual_visits(visits_df, points_df, year, quarter, store=None):
+    """
+    Обрабатывает фактические посещения за квартал.
+    С хранилищем (VisitFactStore) визиты квартала читаются из его партиции,
+    без фильтрации всей истории.
+    """
     
-    # Фильтруем посещения по кварталу
-    visits_in_quarter = visits_df[
-        (visits_df['Дата_визита'] >= quarter_start_dt) &
-        (visits_df['Дата_визита'] <= quarter_end_dt)
-    ].copy()
+    if store is not None:
+        visits_in_quarter = store.query(year, quarter)
+    elif visits_df is None or visits_df.empty:
+        return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
+    else:
+        # Получаем даты квартала
+        quarter_start, quarter_end = get_quarter_dates(year, quarter)
+        
+        # Преобразуем даты для сравнения
+        # ИСПРАВЛЕНИЕ: используем уже импортированный datetime
+        quarter_start_dt = pd.Timestamp(datetime.combine(quarter_start, datetime.min.time()))
+        quarter_end_dt = pd.Timestamp(datetime.combine(quarter_end, datetime.max.time()))
+        
+        # Фильтруем посещения по кварталу
+        visits_in_quarter = visits_df[
+            (visits_df['Дата_визита'] >= quarter_start_dt) &
+            (visits_df['Дата_визита'] <= quarter_end_dt)
+        ].copy()
+        
+        # Добавляем ISO неделю
+        visits_in_quarter['ISO_Неделя'] = visits_in_quarter['Дата_визита'].dt.isocalendar().week.astype(int)
     
     if visits_in_quarter.empty:
         return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
     
-    # Добавляем ISO неделю
-    visits_in_quarter['ISO_Неделя'] = visits_in_quarter['Дата_визита'].apply(get_iso_week)
-    
     # Проверяем соответствие точек (только те, что есть в файле Точки)
-    valid_point_ids = set(points_df['ID_Точки'].unique())
-    invalid_visits = visits_in_quarter[~visits_in_quarter['ID_Точки'].isin(valid_point_ids)]
+    id_dtype = points_df['ID_Точки'].dtype
+    if isinstance(id_dtype, pd.CategoricalDtype):
+        # Общий справочник ID: проверка по кодам через маску, без множеств строк
+        known_codes = np.zeros(len(id_dtype.categories) + 1, dtype=bool)
+        known_codes[point_id_codes(points_df['ID_Точки'], id_dtype)] = True
+        known_codes[-1] = False  # код -1: ID вне справочника
+        is_valid = known_codes[point_id_codes(visits_in_quarter['ID_Точки'], id_dtype)]
+    else:
+        valid_point_ids = set(points_df['ID_Точки'].unique())
+        is_valid = visits_in_quarter['ID_Точки'].isin(valid_point_ids).to_numpy()
     
-    if len(invalid_visits) > 0:
-        st.warning(f"⚠️ Найдено {len(invalid_visits)} посещений несуществующих точек")
+    n_invalid = int((~is_valid).sum())
+    if n_invalid > 0:
+        st.warning(f"⚠️ Найдено {n_invalid} посещений несуществующих точек")
     
     # Оставляем только валидные посещения
-    visits_in_quarter = visits_in_quarter[visits_in_quarter['ID_Точки'].isin(valid_point_ids)]
+    visits_in_quarter = visits_in_quarter[is_valid]
     
     return visits_in_quarter.reset_index(drop=True)
 
-def calculate_statistics(points_df, visits_df, detailed_plan_df, year, quarter):
-    """Минимальная версия - только самое необходимое"""
+def calculate_statistics(points_df, visits_df, detailed_plan_df, year, quarter, store=None):
+    """Минимальная версия - только самое необходимое (факт - из хранилища, если оно передано)"""
     
-    # 1. Статистика по городам
+    # 0. Факт квартала по точкам: город и тип точки
+    quarter_visits = process_actual_visits(visits_df, points_df, year, quarter, store=store)
+    fact_points = pd.merge(
+        quarter_visits[['ID_Точки']].astype(object),
+        points_df[['ID_Точки', 'Город', 'Тип']].astype({'ID_Точки': object}),
+        on='ID_Точки'
+    )
+    city_facts = fact_points.groupby('Город', observed=True).size()
+    type_facts = fact_points.groupby('Тип', observed=True).size()
+    
+    # 1. Статистика по городам (один groupby по category вместо фильтра на каждый город)
+    city_summary = points_df.groupby('Город', observed=True, sort=False)['Кол-во_посещений'].agg(['size', 'sum'])
     city_stats = []
-    for city in points_df['Город'].unique():
-        city_points = points_df[points_df['Город'] == city]
+    for city, n_points, plan in city_summary.itertuples():
         city_stats.append({
             'Город': city,
-            'Всего_точек': len(city_points),
-            'План_посещений': city_points['Кол-во_посещений'].sum(),
-            'Факт_посещений': 0,
-            '%_выполнения': 0.0
+            'Всего_точек': n_points,
+            'План_посещений': plan,
+            'Факт_посещений': int(city_facts.get(city, 0)),
+            '%_выполнения': round(city_facts.get(city, 0) / plan * 100, 1) if plan > 0 else 0.0
         })
     
     # 2. Статистика по типам
+    type_plans = points_df.groupby('Тип', observed=True, sort=False)['Кол-во_посещений'].sum()
     type_stats = []
-    for point_type in points_df['Тип'].unique():
-        type_points = points_df[points_df['Тип'] == point_type]
+    for point_type, plan in type_plans.items():
         type_stats.append({
             'Тип': point_type,
-            'План_посещений': type_points['Кол-во_посещений'].sum(),
-            'Факт_посещений': 0,
-            '%_выполнения': 0.0
+            'План_посещений': plan,
+            'Факт_посещений': int(type_facts.get(point_type, 0)),
+            '%_выполнения': round(type_facts.get(point_type, 0) / plan * 100, 1) if plan > 0 else 0.0
         })
     
-    # 3. Сводный план = detailed_plan_df (уже распределен по неделям и аудиторам)
-    summary_df = detailed_plan_df.copy()
-    
-    # Добавляем недостающие колонки
-    if 'Факт_посещений' not in summary_df.columns:
+    # 3. Сводный план = detailed_plan_df (уже распределен по неделям и аудиторам);
+    # поверхностная копия - новые колонки не попадают в исходную таблицу
+    summary_df = detailed_plan_df.copy(deep=False)
+    
+    # Факт по (аудитор, ISO-неделя): визиты сотрудника в эту неделю
+    if not summary_df.empty:
+        week_facts = quarter_visits.groupby(
+            [quarter_visits['ID_Сотрудника'].astype(object), quarter_visits['ISO_Неделя'].astype(int)]
+        ).size()
+        plan_keys = pd.MultiIndex.from_arrays(
+            [summary_df['Аудитор'].astype(object), summary_df['ISO_Неделя'].astype(int)]
+        )
+        summary_df['Факт_посещений'] = week_facts.reindex(plan_keys).fillna(0).astype(int).to_numpy()
+        plan = summary_df['План_посещений']
+        summary_df['%_выполнения'] = (summary_df['Факт_посещений'] / plan.where(plan > 0) * 100).round(1).fillna(0.0)
+    else:
         summary_df['Факт_посещений'] = 0
-    
-    if '%_выполнения' not in summary_df.columns:
         summary_df['%_выполнения'] = 0.0
     
-    # 4. Детализация = та же detailed_plan_df
-    detailed_with_fact = detailed_plan_df.copy()
+    # 4. Детализация = та же detailed_plan_df (без лишней копии в session_state)
+    detailed_with_fact = detailed_plan_df
     
     # Проверка
     total_expected = points_df['Кол-во_посещений'].sum()
@@ -3013,6 +5977,299 @@ def create_light_map(points_df, polygons, max_points=200):
     
     return m
 
+# ==============================================
+# БЕНЧМАРК ГЕОМЕТРИЧЕСКИХ ФУНКЦИЙ
+# ==============================================
+
+def generate_synthetic_city(n_points, center=(55.75, 37.62), radius_km=25.0,
+                            n_clusters=20, background_share=0.15, seed=0):
+    """
+    Синтетический город: кластеры магазинов разной плотности (центр плотнее окраин)
+    плюс равномерный фон. Возвращает массив (n_points, 2) - lat, lon.
+    """
+    rng = np.random.default_rng(seed)
+    lat_scale = radius_km / KM_PER_DEGREE
+    lon_scale = lat_scale / max(math.cos(math.radians(center[0])), 0.01)
+    
+    n_background = int(n_points * background_share)
+    n_clustered = n_points - n_background
+    
+    # Центры кластеров ближе к центру города, размеры и веса кластеров разные
+    cluster_r = np.sqrt(rng.uniform(0, 1, n_clusters)) * 0.8
+    cluster_angle = rng.uniform(0, 2 * np.pi, n_clusters)
+    cluster_centers = np.column_stack([cluster_r * np.cos(cluster_angle), cluster_r * np.sin(cluster_angle)])
+    cluster_spread = rng.uniform(0.01, 0.12, n_clusters)
+    cluster_weights = rng.pareto(1.5, n_clusters) + 0.1
+    
+    labels = rng.choice(n_clusters, size=n_clustered, p=cluster_weights / cluster_weights.sum())
+    clustered = cluster_centers[labels] + rng.normal(0, 1, (n_clustered, 2)) * cluster_spread[labels, None]
+    
+    background_r = np.sqrt(rng.uniform(0, 1, n_background))
+    background_angle = rng.uniform(0, 2 * np.pi, n_background)
+    background = np.column_stack([background_r * np.cos(background_angle), background_r * np.sin(background_angle)])
+    
+    unit = np.vstack([clustered, background])
+    rng.shuffle(unit)
+    return np.column_stack([center[0] + unit[:, 0] * lat_scale, center[1] + unit[:, 1] * lon_scale])
+
+def generate_synthetic_polygon(n_vertices, center=(55.75, 37.62), radius_km=25.0,
+                               roughness=0.3, seed=0):
+    """
+    Звездообразный полигон с n_vertices вершинами и "рваной" границей.
+    Возвращает замкнутый список [[lat, lon], ...].
+    """
+    rng = np.random.default_rng(seed)
+    n_vertices = max(int(n_vertices), 3)
+    lat_scale = radius_km / KM_PER_DEGREE
+    lon_scale = lat_scale / max(math.cos(math.radians(center[0])), 0.01)
+    
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+    radii = 1.0 - roughness * rng.uniform(0, 1, n_vertices)
+    coords = np.column_stack([center[0] + radii * np.cos(angles) * lat_scale,
+                              center[1] + radii * np.sin(angles) * lon_scale])
+    return _close_ring(coords)
+
+def _measure(func, *args, setup=None, **kwargs):
+    """
+    Время выполнения (с) и пиковая память (МБ) вызова.
+    Время и память меряются разными запусками: tracemalloc сильно замедляет Python-циклы.
+    setup() вызывается перед каждым запуском (например, сброс кэша).
+    """
+    if setup:
+        setup()
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak / 1024 ** 2
+
+def run_geometry_benchmark(point_counts=(1_000, 10_000, 100_000), vertex_counts=(4, 50, 500),
+                           grid_sizes=(0.0009, 0.0045), radius_km=25.0, seed=0, progress=None):
+    """
+    Замеряет геометрические функции на синтетических городах:
+    points_in_polygon / is_point_in_polygon, create_grid_inside_polygon,
+    assign_points_to_grid_cells, neighbor_csr / get_cell_neighbors.
+    Возвращает список строк (dict): функция, параметры, время, пропускная способность, пиковая память.
+    """
+    rows = []
+    
+    def record(function, seconds, peak_mb, items, unit, **params):
+        rows.append({
+            'Функция': function,
+            'Точек': params.get('points', 0),
+            'Вершин': params.get('vertices', 0),
+            'Шаг_сетки': params.get('grid_size', 0.0),
+            'Время_с': round(seconds, 5),
+            'Пропускная_способность': round(items / seconds, 1) if seconds > 0 else None,
+            'Единица': unit,
+            'Пик_памяти_МБ': round(peak_mb, 2)
+        })
+    
+    cases = [(n, v, g) for n in point_counts for v in vertex_counts for g in grid_sizes]
+    for case_idx, (n_points, n_vertices, grid_size) in enumerate(cases):
+        if progress:
+            progress(case_idx / len(cases), f"{n_points} точек, {n_vertices} вершин, шаг {grid_size}")
+        
+        points = generate_synthetic_city(n_points, radius_km=radius_km, seed=seed)
+        polygon = generate_synthetic_polygon(n_vertices, radius_km=radius_km, seed=seed)
+        params = {'points': n_points, 'vertices': n_vertices, 'grid_size': grid_size}
+        
+        # Подготовка полигона меряется отдельно (с пустым кэшем), дальше полигон берется из кэша
+        _, seconds, peak = _measure(prepare_polygon, polygon, setup=get_prepared_polygon_cache().clear)
+        record('prepare_polygon', seconds, peak, n_vertices, 'вершин/с', **params)
+        
+        _, seconds, peak = _measure(points_in_polygon, points, polygon)
+        record('points_in_polygon', seconds, peak, n_points, 'точек/с', **params)
+        
+        # Поштучная обертка - на ограниченной выборке
+        sample = points[:min(n_points, 2_000)]
+        _, seconds, peak = _measure(lambda: [is_point_in_polygon(p, polygon) for p in sample])
+        record('is_point_in_polygon', seconds, peak, len(sample), 'точек/с', **params)
+        
+        grid, seconds, peak = _measure(create_grid_inside_polygon, polygon, grid_size=grid_size)
+        if grid is None:
+            continue
+        bbox_cells = grid.width * grid.height
+        record('create_grid_inside_polygon', seconds, peak, bbox_cells, 'ячеек bbox/с', **params)
+        
+        _, seconds, peak = _measure(assign_points_to_grid_cells, points, np.arange(n_points), grid)
+        record('assign_points_to_grid_cells', seconds, peak, n_points, 'точек/с', **params)
+        
+        _, seconds, peak = _measure(grid.neighbor_csr)
+        record('neighbor_csr', seconds, peak, grid.n_cells, 'ячеек/с', **params)
+        
+        cell_sample = grid.cell_ids[:min(grid.n_cells, 2_000)].tolist()
+        _, seconds, peak = _measure(lambda: [get_cell_neighbors(cell_id, grid) for cell_id in cell_sample])
+        record('get_cell_neighbors', seconds, peak, len(cell_sample), 'ячеек/с', **params)
+    
+    if progress:
+        progress(1.0, "Готово")
+    
+    return rows
+
+def render_geometry_benchmark():
+    """Панель бенчмарка в боковой панели: параметры, запуск, таблица и выгрузка результатов в JSON"""
+    st.subheader("Бенчмарк геометрии")
+    
+    bench_points = st.multiselect(
+        "Число точек", [1_000, 10_000, 100_000, 1_000_000], default=[1_000, 10_000], key="bench_points"
+    )
+    bench_vertices = st.multiselect(
+        "Вершин полигона", [4, 50, 500, 5_000], default=[4, 500], key="bench_vertices"
+    )
+    bench_grid_sizes = st.multiselect(
+        "Шаг сетки (градусы)", [0.00045, 0.0009, 0.0045, 0.009], default=[0.0009], key="bench_grid_sizes"
+    )
+    
+    if st.button("Запустить бенчмарк", key="bench_run_btn"):
+        progress_bar = st.progress(0.0)
+        progress_text = st.empty()
+        
+        def bench_progress(fraction, message):
+            progress_bar.progress(min(fraction, 1.0))
+            progress_text.caption(message)
+        
+        st.session_state.benchmark_results = run_geometry_benchmark(
+            point_counts=bench_points, vertex_counts=bench_vertices,
+            grid_sizes=bench_grid_sizes, progress=bench_progress
+        )
+    
+    if st.session_state.get('benchmark_results'):
+        bench_df = pd.DataFrame(st.session_state.benchmark_results)
+        st.dataframe(bench_df, use_container_width=True)
+        st.download_button(
+            "📥 Скачать результаты (JSON)",
+            data=json.dumps(st.session_state.benchmark_results, ensure_ascii=False, indent=2),
+            file_name=f"geometry_benchmark_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
+            mime="application/json",
+            key="bench_download_btn"
+        )
+
+# ==============================================
+# БОКОВАЯ ПАНЕЛЬ - НАСТРОЙКИ
+# ==============================================
+
+with st.sidebar:
+    st.header("⚙️ Настройки")
+    
+    # Выбор квартала и года
+    col1, col2 = st.columns(2)
+    with col1:
+        quarter = st.selectbox("Квартал", [1, 2, 3, 4], index=0, key="sidebar_quarter")
+    with col2:
+        year = st.selectbox("Год", list(range(2023, 2027)), index=2, key="sidebar_year")
+    if not production_calendar_known(year):
+        st.warning(
+            f"⚠️ Производственного календаря на {year} год нет: "
+            "учтены только фиксированные праздники, без переносов"
+        )
+    
+    # Коэффициенты этапов
+    st.subheader("Коэффициенты нагрузки по этапам")
+    st.caption("Квартал делится на 4 этапа")
+    
+    stage1 = st.number_input("Этап 1 коэффициент", value=0.8, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage1")
+    stage2 = st.number_input("Этап 2 коэффициент", value=1.0, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage2")
+    stage3 = st.number_input("Этап 3 коэффициент", value=1.2, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage3")
+    stage4 = st.number_input("Этап 4 коэффициент", value=0.9, min_value=0.1, max_value=2.0, step=0.1, key="sidebar_stage4")
+    
+    coefficients = [stage1, stage2, stage3, stage4]
+    
+    st.markdown("---")
+    
+    st.info("""
+    **Инструкция:**
+    1. Загрузите файл с данными (1 файл, 3 вкладки)
+    2. Настройте квартал и коэффициенты
+    3. Нажмите кнопку "Рассчитать план"
+    4. Используйте вкладки для анализа
+    
+    *Настройки сохраняются автоматически*
+    """)
+
+    st.markdown("---")
+    
+    st.subheader("🎯 Алгоритм разбиения")
+    use_enhanced_split = st.checkbox(
+        "Использовать улучшенное разбиение по неделям", 
+        value=False,
+        help="Разбивает полигоны аудиторов на компактные недельные области с балансировкой ±3 точки"
+    )
+    
+    split_method_labels = {
+        "Последовательное": 'sequential',
+        "Рост регионов по сетке": 'grid'
+    }
+    split_method_label = st.selectbox(
+        "Метод разбиения по неделям",
+        list(split_method_labels.keys()),
+        index=0,
+        disabled=not use_enhanced_split,
+        help="Рост регионов по сетке строит связные недельные области, сбалансированные по числу точек",
+        key="sidebar_split_method"
+    )
+    split_method = split_method_labels[split_method_label]
+    
+    polygon_method_labels = {
+        "Выпуклая оболочка": 'convex',
+        "Вогнутая оболочка": 'concave',
+        "Прямоугольник": 'rectangle'
+    }
+    polygon_method_label = st.selectbox(
+        "Форма полигонов",
+        list(polygon_method_labels.keys()),
+        index=0,
+        help="Вогнутая оболочка плотнее облегает точки (нужен SciPy, иначе строится выпуклая)",
+        key="sidebar_polygon_method"
+    )
+    polygon_method = polygon_method_labels[polygon_method_label]
+    
+    route_budget_ms = st.number_input(
+        "Бюджет улучшения маршрута, мс",
+        value=50, min_value=0, max_value=2000, step=10,
+        help="Время локального поиска (2-opt / Or-opt) на один маршрут дня; 0 - только жадный маршрут",
+        key="sidebar_route_budget_ms"
+    )
+    
+    st.markdown("---")
+    st.subheader("🗄️ Хранилище фактов")
+    use_visit_store = st.checkbox(
+        "Сохранять факт посещений между запусками",
+        value=False,
+        help="Загруженные визиты добавляются в локальную базу на сервере (дубликаты отбрасываются), "
+             "статистика выполнения берется из нее только за выбранный квартал. "
+             "База общая для всех пользователей сервера",
+        key="use_visit_store"
+    )
+    if use_visit_store:
+        try:
+            store_stats = get_visit_store().stats()
+            if store_stats['total']:
+                st.caption(
+                    f"Визитов: {store_stats['total']} "
+                    f"({store_stats['first_date']} — {store_stats['last_date']})"
+                )
+            else:
+                st.caption("Хранилище пусто")
+            if st.button("🗑️ Очистить хранилище", key="clear_visit_store"):
+                get_visit_store().clear()
+                st.rerun()
+        except (OSError, sqlite3.Error) as e:
+            st.warning(f"⚠️ Хранилище недоступно: {e}")
+            use_visit_store = False
+    
+    st.markdown("---")
+    if st.checkbox("⏱️ Бенчмарк геометрии", False, key="benchmark_geo_functions"):
+        render_geometry_benchmark()
+
 # ==============================================
 # РАЗДЕЛ ЗАГРУЗКИ ФАЙЛОВ
 # ==============================================
@@ -3031,63 +6288,131 @@ with upload_tab1:
     st.info("""
     **📝 Формат файла:** 
     - Один файл Excel с тремя вкладками: "Точки", "Аудиторы", "Факт_посещений"
+    - Или отдельные файлы CSV / Parquet / Feather для каждой вкладки
+    - Или папка на сервере: большие файлы читаются прямо с диска, без загрузки через браузер
     - Скачайте шаблон справа, заполните данные и загрузите обратно
     """)
     
-    # Один загрузчик для всего файла
-    data_file = st.file_uploader(
-        "Файл с данными (Excel)", 
-        type=['xlsx', 'xls'], 
-        key="data_uploader_main",
-        help="Excel файл с тремя вкладками: Точки, Аудиторы, Факт_посещений"
-    )
-    
-    if data_file:
-        st.success(f"✅ Загружен файл: {data_file.name}")
-        
-        # Сохраняем файл в session state
-        st.session_state.data_file = data_file
+    data_source_modes = {
+        "Excel (одна книга, три вкладки)": 'excel',
+        "Отдельные файлы (CSV / Parquet / Feather)": 'tables',
+        "Папка на сервере": 'folder'
+    }
+    data_source_mode = data_source_modes[st.radio(
+        "Формат данных",
+        list(data_source_modes.keys()),
+        horizontal=True,
+        key="data_source_mode"
+    )]
+    
+    if data_source_mode == 'excel':
+        # Один загрузчик для всего файла
+        data_file = st.file_uploader(
+            "Файл с данными (Excel)", 
+            type=['xlsx', 'xls'], 
+            key="data_uploader_main",
+            help="Excel файл с тремя вкладками: Точки, Аудиторы, Факт_посещений"
+        )
         
-        # Пробуем загрузить и проверить вкладки
-        try:
-            # Читаем названия всех листов
-            xl = pd.ExcelFile(data_file)
-            sheets = xl.sheet_names
+        if data_file:
+            st.success(f"✅ Загружен файл: {data_file.name}")
             
-            # Проверяем наличие необходимых листов
-            required_sheets = ['Точки', 'Аудиторы', 'Факт_посещений']
-            missing_sheets = [sheet for sheet in required_sheets if sheet not in sheets]
+            # Сохраняем файл в session state
+            st.session_state.data_file = data_file
             
-            if missing_sheets:
-                st.warning(f"⚠️ В файле отсутствуют вкладки: {', '.join(missing_sheets)}")
-                st.info("Убедитесь, что файл содержит вкладки с названиями: 'Точки', 'Аудиторы', 'Факт_посещений'")
-            else:
-                st.success("✅ Все необходимые вкладки найдены!")
+            # Пробуем загрузить и проверить вкладки
+            try:
+                # Книга разбирается один раз на содержимое файла, дальше - из кэша
+                with st.spinner("🔄 Чтение файла..."):
+                    read_progress = st.empty()
+                    workbook = get_workbook(
+                        data_file,
+                        progress=lambda fraction, message: read_progress.progress(fraction, text=message)
+                    )
+                    read_progress.empty()
+                sheets = workbook['sheet_names']
                 
-                # Показываем предпросмотр каждой вкладки
-                with st.expander("📋 Предпросмотр данных", expanded=False):
-                    preview_tabs = st.tabs(["Точки", "Аудиторы", "Факт_посещений"])
-                    
-                    with preview_tabs[0]:
-                        points_preview = pd.read_excel(data_file, sheet_name='Точки', nrows=5)
-                        st.write(f"Точки: {len(points_preview)} строк")
-                        st.dataframe(points_preview, use_container_width=True)
-                    
-                    with preview_tabs[1]:
-                        auditors_preview = pd.read_excel(data_file, sheet_name='Аудиторы', nrows=5)
-                        st.write(f"Аудиторы: {len(auditors_preview)} строк")
-                        st.dataframe(auditors_preview, use_container_width=True)
+                # Проверяем наличие необходимых листов
+                missing_sheets = [sheet for sheet in WORKBOOK_SHEETS
+                                  if sheet not in sheets and sheet not in OPTIONAL_WORKBOOK_SHEETS]
+                
+                if missing_sheets:
+                    st.warning(f"⚠️ В файле отсутствуют вкладки: {', '.join(missing_sheets)}")
+                    st.info("Убедитесь, что файл содержит вкладки с названиями: 'Точки', 'Аудиторы', 'Факт_посещений'")
+                else:
+                    st.success("✅ Все необходимые вкладки найдены!")
+                    if 'Отсутствия' in sheets:
+                        st.info("📆 Найдена вкладка Отсутствия: отпуска учитываются в плане и маршрутах")
                     
-                    with preview_tabs[2]:
-                        visits_preview = pd.read_excel(data_file, sheet_name='Факт_посещений', nrows=5)
-                        st.write(f"Факт посещений: {len(visits_preview)} строк")
-                        st.dataframe(visits_preview, use_container_width=True)
+                    # Показываем предпросмотр каждой вкладки
+                    show_sheet_previews(workbook['sheets'])
+            
+            except Exception as e:
+                st.error(f"❌ Ошибка при чтении файла: {str(e)}")
+        
+        else:
+            st.warning("⚠️ Загрузите файл с данными для продолжения")
+        
+    elif data_source_mode == 'folder':
+        # Файлы кладутся в папку на сервере; фоновый поток разбирает новые и измененные
+        # Папка задается переменной окружения VISIT_PLAN_DROP_DIR, не из интерфейса
+        drop_folder = os.path.abspath(VISIT_PLAN_DROP_DIR)
+        st.caption(f"📁 Папка: {drop_folder}. Книга Excel с вкладками или файлы 'Точки', 'Аудиторы', "
+                   f"'Факт_посещений' (CSV / Parquet / Feather); папку задает переменная VISIT_PLAN_DROP_DIR")
+        
+        if not os.path.isdir(drop_folder):
+            st.warning(f"⚠️ Папка не найдена: {drop_folder}")
+        else:
+            watcher = get_drop_folder_watcher()
+            
+            if st.button("🔄 Проверить папку сейчас", key="drop_folder_scan"):
+                with st.spinner("🔄 Чтение файлов из папки..."):
+                    # Проверяет фоновый поток: новый файл разбирается на второй проверке,
+                    # когда его размер устоялся
+                    if not watcher.request_scan(timeout=DROP_FOLDER_SCAN_WAIT_SECONDS):
+                        st.info("⏳ Файлы еще разбираются, результат появится при следующем обновлении")
+            
+            status_rows, waiting_files = watcher.status()
+            if status_rows:
+                st.dataframe(pd.DataFrame(status_rows), use_container_width=True, hide_index=True)
+            if waiting_files:
+                st.info(f"⏳ Ожидают разбора: {', '.join(waiting_files)}")
+            
+            sheets = watcher.sheets()
+            if 'Точки' in sheets and 'Аудиторы' in sheets:
+                # В session_state - только ссылка на наблюдатель, данные уже разобраны в фоне
+                st.session_state.data_file = watcher
+                st.success(f"✅ Вкладки из папки: {', '.join(sheets)} (версия {watcher.version})")
+                show_sheet_previews(sheets)
+            else:
+                st.warning("⚠️ В папке пока нет данных Точки и Аудиторы")
         
-        except Exception as e:
-            st.error(f"❌ Ошибка при чтении файла: {str(e)}")
-    
     else:
-        st.warning("⚠️ Загрузите файл с данными для продолжения")
+        # По файлу на вкладку: CSV / Parquet / Feather читаются без openpyxl
+        table_files = {}
+        upload_columns = st.columns(len(WORKBOOK_SHEETS))
+        for column, sheet in zip(upload_columns, WORKBOOK_SHEETS):
+            with column:
+                table_files[sheet] = st.file_uploader(
+                    sheet,
+                    type=TABLE_FILE_TYPES,
+                    key=f"data_uploader_{sheet}",
+                    help="CSV (разделитель определяется автоматически), Parquet или Feather"
+                )
+        
+        if table_files['Точки'] and table_files['Аудиторы']:
+            sources = {sheet: table_file for sheet, table_file in table_files.items() if table_file}
+            st.session_state.data_file = sources
+            
+            try:
+                with st.spinner("🔄 Чтение файлов..."):
+                    sheets = get_source_sheets(sources)
+                st.success(f"✅ Загружено файлов: {len(sources)}")
+                show_sheet_previews(sheets)
+            except Exception as e:
+                st.error(f"❌ Ошибка при чтении файлов: {str(e)}")
+        else:
+            st.warning("⚠️ Загрузите как минимум файлы Точки и Аудиторы (Факт_посещений и Отсутствия - по желанию)")
 
 with upload_tab2:
     st.subheader("Шаблон файла")
@@ -3115,6 +6440,10 @@ with upload_tab2:
         # Вкладка 3: Факт_посещений
         visits_template = create_template_visits()
         visits_template.to_excel(writer, sheet_name='Факт_посещений', index=False)
+        
+        # Вкладка 4 (необязательная): Отсутствия
+        absences_template = create_template_absences()
+        absences_template.to_excel(writer, sheet_name='Отсутствия', index=False)
     
     excel_data = excel_buffer.getvalue()
     
@@ -3131,7 +6460,7 @@ with upload_tab2:
     st.markdown("---")
     st.markdown("**Предпросмотр шаблона:**")
     
-    template_tabs = st.tabs(["Точки", "Аудиторы", "Факт_посещений"])
+    template_tabs = st.tabs(["Точки", "Аудиторы", "Факт_посещений", "Отсутствия"])
     
     with template_tabs[0]:
         st.markdown("##### Вкладка 'Точки'")
@@ -3141,21 +6470,27 @@ with upload_tab2:
     with template_tabs[1]:
         st.markdown("##### Вкладка 'Аудиторы'")
         st.dataframe(auditors_template, use_container_width=True)
-        st.caption("Обязательные поля: ID_Сотрудника, Город")
+        st.caption("Обязательные поля: ID_Сотрудника, Город. Необязательное: Ставка (0–1, по умолчанию 1)")
     
     with template_tabs[2]:
         st.markdown("##### Вкладка 'Факт_посещений'")
         st.dataframe(visits_template, use_container_width=True)
         st.caption("Обязательные поля: ID_Точки, Дата_визита, ID_Сотрудника")
     
+    with template_tabs[3]:
+        st.markdown("##### Вкладка 'Отсутствия' (необязательная)")
+        st.dataframe(absences_template, use_container_width=True)
+        st.caption("Обязательные поля: ID_Сотрудника, Дата_начала. Дата_окончания включительно")
+    
     st.markdown("---")
-    st.success("✅ Шаблон содержит все три вкладки в одном файле Excel")
+    st.success("✅ Шаблон содержит все вкладки в одном файле Excel")
 
 with upload_tab3:
     st.subheader("Описание полей")
     
     # Используем st.tabs для трех вкладок внутри описания
-    desc_tabs = st.tabs(["Вкладка 'Точки'", "Вкладка 'Аудиторы'", "Вкладка 'Факт_посещений'"])
+    desc_tabs = st.tabs(["Вкладка 'Точки'", "Вкладка 'Аудиторы'", "Вкладка 'Факт_посещений'",
+                         "Вкладка 'Отсутствия'"])
     
     with desc_tabs[0]:
         st.markdown("""
@@ -3185,6 +6520,9 @@ with upload_tab3:
         **Обязательные поля:**
         - `ID_Сотрудника` - уникальный ID
         - `Город` - город работы
+        
+        **Необязательные:**
+        - `Ставка` - доля ставки от 0 до 1 (по умолчанию 1), уменьшает недельную емкость
         """)
     
     with desc_tabs[2]:
@@ -3200,6 +6538,23 @@ with upload_tab3:
         - Одна строка = один визит
         - Можно оставить пустым, если данных нет
         """)
+    
+    with desc_tabs[3]:
+        st.markdown("""
+        ### Вкладка 'Отсутствия' (необязательная)
+        
+        **Обязательные поля:**
+        - `ID_Сотрудника` - аудитор из вкладки Аудиторы
+        - `Дата_начала` - первый день отсутствия
+        
+        **Необязательные:**
+        - `Дата_окончания` - последний день отсутствия (по умолчанию = Дата_начала)
+        
+        **Как учитывается:**
+        - Дни отсутствия исключаются из маршрутов
+        - Недельный план делится пропорционально доступным дням × ставке
+        - Недели без доступных дней не получают посещений
+        """)
 
 st.markdown("---")
 
@@ -3209,6 +6564,13 @@ st.markdown("---")
 
 # ТОЛЬКО ОДНА КНОПКА ВСЕМ КОДЕ!
 calculate_button = st.button("🚀 Рассчитать план", type="primary", use_container_width=True, key="calculate_plan_btn")
+use_delta_mode = st.checkbox(
+    "⚡ Пересчитать только изменения (дельта-режим)",
+    value=False,
+    disabled=st.session_state.get('last_run') is None,
+    help="Сравнивает Точки и Аудиторы с предыдущим расчетом и пересчитывает только затронутые города",
+    key="delta_mode"
+)
 if calculate_button:
     
     if 'data_file' not in st.session_state or st.session_state.data_file is None:
@@ -3219,25 +6581,65 @@ if calculate_button:
     
     try:
         with st.spinner("🔄 Загрузка и обработка данных..."):
-            # Загружаем данные из одного файла
-            points_raw, auditors_raw, visits_raw = load_and_process_data(data_file)
+            # Вкладки разбираются параллельно; каждая проверяется, как только готова
+            sheet_loaders = {
+                'Точки': load_and_process_points,
+                'Аудиторы': load_and_process_auditors,
+                'Факт_посещений': load_and_process_visits,
+                'Отсутствия': load_and_process_absences
+            }
+            processed = {}
+            
+            def process_sheet(sheet, df):
+                if sheet in sheet_loaders:
+                    processed[sheet] = sheet_loaders[sheet](df)
+            
+            points_raw, auditors_raw, visits_raw = load_and_process_data(data_file, on_sheet=process_sheet)
             
             if points_raw is None or auditors_raw is None:
                 st.stop()
             
-            # Обрабатываем каждую таблицу
-            points_df = load_and_process_points(points_raw)
-            auditors_df = load_and_process_auditors(auditors_raw)
-            visits_df = load_and_process_visits(visits_raw)
+            # Вкладки, которых не было в источнике (пустой факт посещений);
+            # необязательная вкладка Отсутствия обрабатывается, только если она есть
+            for sheet, raw in zip(WORKBOOK_SHEETS, (points_raw, auditors_raw, visits_raw)):
+                if sheet not in processed:
+                    processed[sheet] = sheet_loaders[sheet](raw)
+            
+            points_df = processed['Точки']
+            auditors_df = processed['Аудиторы']
+            visits_df = processed['Факт_посещений']
+            absences_df = processed.get('Отсутствия')
+            
+            sheet_timings = st.session_state.get('sheet_timings') or {}
+            if sheet_timings:
+                st.caption("⏱️ Разбор вкладок: " + ", ".join(
+                    f"{sheet} {seconds:.1f} с" for sheet, seconds in sheet_timings.items()
+                ))
             
             if points_df is None or auditors_df is None:
                 st.stop()
-            
+
+            # Компактные типы: общий справочник ID точек, category для повторяющихся строк
+            memory_before = frames_memory_mb(points_df, auditors_df, visits_df)
+            point_id_dtype = build_point_id_dtype(points_df['ID_Точки'], visits_df.get('ID_Точки'))
+            compact_frame(points_df, point_id_dtype)
+            compact_frame(auditors_df)
+            compact_frame(visits_df, point_id_dtype)
+            st.session_state.point_id_dtype = point_id_dtype
+            st.caption(f"💾 Память таблиц: {memory_before:.1f} МБ -> "
+                       f"{frames_memory_mb(points_df, auditors_df, visits_df):.1f} МБ")
+
             # Сохраняем в session state
             st.session_state.points_df = points_df
             st.session_state.auditors_df = auditors_df
             st.session_state.visits_df = visits_df
             
+            # Новые визиты дописываются в хранилище фактов (повторы отбрасываются по ключу)
+            visit_store = get_visit_store() if use_visit_store else None
+            if visit_store is not None and not visits_df.empty:
+                inserted, duplicates = visit_store.append(visits_df)
+                st.info(f"🗄️ Хранилище фактов: добавлено {inserted} визитов, пропущено повторов {duplicates}")
+            
             # Проверяем соответствие городов
             cities_points = set(points_df['Город'].unique())
             cities_auditors = set(auditors_df['Город'].unique())
@@ -3250,6 +6652,18 @@ if calculate_button:
             
             if cities_without_points:
                 st.warning(f"⚠️ Аудиторы в городах {', '.join(cities_without_points)} не имеют точек")
+            
+            # Доступность аудиторов по дням квартала (отсутствия и ставка)
+            availability = build_auditor_availability(auditors_df, absences_df, year, quarter)
+            st.session_state.availability = availability
+            availability_summary = availability.summary()
+            constrained = availability_summary[
+                (availability_summary['Дней_отсутствия'] > 0) | (availability_summary['Ставка'] < 1)
+            ]
+            if not constrained.empty:
+                st.info(f"📆 Учтены отсутствия и неполная ставка у {len(constrained)} аудиторов")
+                with st.expander("📆 Доступность аудиторов", expanded=False):
+                    st.dataframe(constrained, use_container_width=True, hide_index=True)
         
         # Показываем предпросмотр данных
         st.success("✅ Данные успешно загружены!")
@@ -3275,30 +6689,74 @@ if calculate_button:
         st.markdown("---")
         st.header("📅 Расчет плана визитов")
         
+        # Дельта-режим: при тех же настройках пересчитываем только затронутые города
+        run_params = (year, quarter, tuple(coefficients), polygon_method, use_enhanced_split, split_method,
+                      route_budget_ms)
+        last_run = st.session_state.get('last_run')
+        delta_run = None
+        
+        if use_delta_mode and last_run is not None:
+            if last_run['params'] != run_params:
+                st.info("ℹ️ Настройки расчета изменились - выполняется полный пересчет")
+            else:
+                delta = diff_plan_inputs(last_run['points_df'], points_df, last_run['auditors_df'], auditors_df)
+                # Города аудиторов, у которых изменились отсутствия или ставка
+                availability_changed = availability.changed_auditors(last_run.get('availability'))
+                if availability_changed:
+                    changed_cities = set(auditors_df.loc[
+                        auditors_df['ID_Сотрудника'].astype(object).isin(availability_changed), 'Город'
+                    ].astype(object))
+                    delta['auditor_cities'] = set(delta['auditor_cities']) | changed_cities
+                    delta['cities'] = set(delta['cities']) | changed_cities
+                st.info(
+                    f"⚡ Изменения: +{len(delta['added'])} / -{len(delta['removed'])} точек, "
+                    f"перемещено {len(delta['moved'])}, изменено {len(delta['changed'])}, "
+                    f"аудиторы изменились в {len(delta['auditor_cities'])} городах. "
+                    f"Пересчитываются города: {', '.join(sorted(map(str, delta['cities']))) or 'нет'}"
+                )
+                with st.spinner("⚡ Пересчет затронутых городов..."):
+                    delta_run = recompute_plan_delta(
+                        last_run, delta, points_df, auditors_df, year, quarter, coefficients,
+                        polygon_method=polygon_method, use_enhanced_split=use_enhanced_split,
+                        split_method=split_method, availability=availability
+                    )
+        
         with st.spinner("🔄 Распределение точек по аудиторам..."):
-            # Распределяем точки по аудиторам
-            points_assignment_df, polygons_info = distribute_points_to_auditors(points_df, auditors_df)
-            
-            if points_assignment_df is None or polygons_info is None:
-                st.error("❌ Не удалось распределить точки по аудиторам")
-                st.stop()
+            if delta_run is not None:
+                points_assignment_df = delta_run['points_assignment_df']
+                polygons_info = delta_run['polygons_info']
+                polygons = delta_run['polygons']
+            else:
+                # Распределяем точки по аудиторам
+                points_assignment_df, polygons_info = distribute_points_to_auditors(points_df, auditors_df)
+                
+                if points_assignment_df is None or polygons_info is None:
+                    st.error("❌ Не удалось распределить точки по аудиторам")
+                    st.stop()
+                
+                # Генерируем полигоны
+                polygons = generate_polygons(polygons_info, method=polygon_method)
             
             # ✅ СОХРАНЯЕМ ДАННЫЕ ДЛЯ ВЫГРУЗКИ
             st.session_state.points_assignment_df = points_assignment_df
             st.session_state.polygons_info = polygons_info
-            
-            # Генерируем полигоны
-            polygons = generate_polygons(polygons_info)
             st.session_state.polygons = polygons
             
+            # Индекс полигонов для массовых запросов "точка -> полигон"
+            st.session_state.polygon_index = PolygonIndex(polygons)
+            
             st.success(f"✅ Точки распределены по {len(polygons_info)} полигонам")
             st.success(f"✅ Сохранено {len(points_assignment_df)} назначений точек")
         
         with st.spinner("🔄 Распределение посещений по неделям..."):
             # Распределяем посещения по неделям
-            detailed_plan_df = distribute_visits_by_weeks(
-                points_assignment_df, points_df, year, quarter, coefficients
-            )
+            if delta_run is not None:
+                detailed_plan_df = delta_run['detailed_plan_df']
+            else:
+                detailed_plan_df = distribute_visits_by_weeks(
+                    points_assignment_df, points_df, year, quarter, coefficients,
+                    availability=availability
+                )
             
             if detailed_plan_df.empty:
                 st.error("❌ Не удалось распределить посещения по неделям")
@@ -3326,14 +6784,19 @@ if calculate_button:
         with st.spinner("🗺️ Оптимизация маршрутов по дням недели..."):
             try:
                 # Создаем таблицу с маршрутами
-                routes_df = create_weekly_route_schedule(
-                    points_df,
-                    points_assignment_df,
-                    auditors_df,  # ← ТОЛЬКО 5 АРГУМЕНТОВ!
-                    year,
-                    quarter,
-                    use_enhanced_split=use_enhanced_split
-                )
+                if delta_run is not None:
+                    routes_df = delta_run['routes_df']
+                else:
+                    routes_df = create_weekly_route_schedule(
+                        points_df,
+                        points_assignment_df,
+                        auditors_df,  # ← ТОЛЬКО 5 АРГУМЕНТОВ!
+                        year,
+                        quarter,
+                        use_enhanced_split=use_enhanced_split,
+                        split_method=split_method,
+                        availability=availability
+                    )
                 
                 if not routes_df.empty:
                     st.session_state.routes_df = routes_df
@@ -3355,7 +6818,7 @@ if calculate_button:
             try:
                 # Рассчитываем полную статистику
                 city_stats_df, type_stats_df, summary_df, detailed_with_fact = calculate_statistics(
-                    points_df, visits_df, detailed_plan_df, year, quarter
+                    points_df, visits_df, detailed_plan_df, year, quarter, store=visit_store
                 )
                 
                 # Сохраняем результаты в session state
@@ -3365,6 +6828,19 @@ if calculate_button:
                 st.session_state.details_df = detailed_with_fact
                 st.session_state.plan_calculated = True  
                 
+                # Вход и результаты расчета для следующего пересчета в дельта-режиме (без копий)
+                st.session_state.last_run = {
+                    'params': run_params,
+                    'points_df': points_df,
+                    'auditors_df': auditors_df,
+                    'availability': availability,
+                    'points_assignment_df': points_assignment_df,
+                    'polygons_info': polygons_info,
+                    'polygons': polygons,
+                    'detailed_plan_df': detailed_plan_df,
+                    'routes_df': st.session_state.get('routes_df')
+                }
+                
                 st.success("✅ Полный расчет завершен! Статистика готова.")
                 
                 # Показываем итоговую статистику
@@ -3436,7 +6912,7 @@ if st.session_state.get('plan_partial', False):
     if st.session_state.get('points_assignment_df') is not None:
         with st.expander("👥 Предпросмотр распределения точек по аудиторам", expanded=False):
             assignment_df = st.session_state.points_assignment_df
-            summary = assignment_df.groupby(['Город', 'Аудитор', 'Полигон']).size().reset_index(name='Количество точек')
+            summary = assignment_df.groupby(['Город', 'Аудитор', 'Полигон'], observed=True).size().reset_index(name='Количество точек')
             st.dataframe(summary, use_container_width=True)
 
 elif st.session_state.get('data_loaded', False):
@@ -3549,7 +7025,7 @@ if st.session_state.plan_calculated:
                 st.subheader("📋 План посещений")
                 
                 if st.session_state.summary_df is not None:
-                    summary_df = st.session_state.summary_df.copy()
+                    summary_df = st.session_state.summary_df
                     
                     if not summary_df.empty:
                         # Фильтры
@@ -3577,8 +7053,8 @@ if st.session_state.plan_calculated:
                             all_polygons = ["Все"] + sorted(summary_df['Полигон'].unique().tolist())
                             selected_polygon = st.selectbox("Полигон", all_polygons, key="filter_polygon")
                         
-                        # Применяем фильтры
-                        filtered_df = summary_df.copy()
+                        # Применяем фильтры (булева индексация сама создает новые таблицы)
+                        filtered_df = summary_df
                         
                         if selected_city != "Все":
                             filtered_df = filtered_df[filtered_df['Город'] == selected_city]
@@ -4119,6 +7595,16 @@ if st.session_state.plan_calculated:
                     )
             else:
                 st.info("Нет данных о полигонах")
+            
+            # Точки, попавшие сразу в несколько полигонов
+            polygon_index = st.session_state.get('polygon_index')
+            if polygon_index is not None and st.session_state.points_df is not None:
+                overlaps_df = find_polygon_overlaps(st.session_state.points_df, polygon_index)
+                if overlaps_df.empty:
+                    st.success("✅ Нет точек, попадающих в несколько полигонов")
+                else:
+                    st.warning(f"⚠️ Точек в нескольких полигонах: {len(overlaps_df)}")
+                    st.dataframe(overlaps_df, use_container_width=True, hide_index=True)
         
         # Информация о данных
         st.markdown("---")
@@ -4167,8 +7653,8 @@ if st.sidebar.checkbox("🧪 Тест геометрических функци
         grid = create_grid_inside_polygon(test_polygon, grid_size=0.05)
         
         if grid:
-            st.sidebar.success(f"✅ Создана сетка: {len(grid['cells'])} ячеек")
-            st.sidebar.write(f"📐 Размер: {grid['width']}x{grid['height']}")
+            st.sidebar.success(f"✅ Создана сетка: {grid.n_cells} ячеек")
+            st.sidebar.write(f"📐 Размер: {grid.width}x{grid.height}")
             
             # Тест распределения точек
             test_points = [
@@ -4181,10 +7667,37 @@ if st.sidebar.checkbox("🧪 Тест геометрических функци
             assignment = assign_points_to_grid_cells(test_points, test_ids, grid)
             
             st.sidebar.write("📊 Распределение точек:")
-            for cell_key, points in assignment.items():
-                st.sidebar.write(f"Ячейка {cell_key}: {points}")
+            if assignment is not None:
+                occupied = np.flatnonzero(np.diff(assignment['offsets']))
+                for cell_id in grid.cell_ids[occupied].tolist():
+                    st.sidebar.write(f"Ячейка {cell_id}: {get_cell_point_ids(assignment, grid, cell_id)}")
+                if len(assignment['outside']) > 0:
+                    st.sidebar.write(f"Вне сетки: {assignment['point_ids'][assignment['outside']].tolist()}")
         else:
             st.sidebar.error("❌ Не удалось создать сетку")
+    
+    # Тест разбиения: точек много, мест мало (занятых ячеек меньше, чем недель)
+    st.sidebar.markdown("---")
+    
+    if st.sidebar.button("Тест: мало мест, много недель", key="test_few_cells_btn"):
+        few_locations = [[55.60, 37.40], [55.62, 37.70], [55.70, 37.50], [55.75, 37.65], [55.78, 37.35]]
+        few_points = [few_locations[i % len(few_locations)] for i in range(100)]
+        few_ids = [f"F{i:03d}" for i in range(100)]
+        few_assignment, _ = grid_region_growing_split(
+            test_polygon, few_points, few_ids, 13, [1.0], logger=lambda message: None
+        )
+        few_sizes = [len(few_assignment.get(week, [])) for week in range(13)]
+        st.sidebar.write(f"📊 Точек по неделям: {few_sizes}")
+        if sum(few_sizes) == 100 and min(few_sizes) >= 7 and max(few_sizes) <= 8:
+            st.sidebar.success("✅ Все 13 недель заполнены поровну")
+        else:
+            st.sidebar.error("❌ Недели заполнены неравномерно")
+    
+    cache_stats = get_prepared_polygon_cache().stats()
+    st.sidebar.caption(
+        f"Кэш полигонов: {cache_stats['entries']} шт., вершин {cache_stats['vertices']}, "
+        f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}"
+    )
 
 # ==============================================
 # КОНЕЦ ((удалить после реализации))